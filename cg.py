@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Single entry point for the cg_* utilities
+
+Runs any of the token/app/job/version/workflow utilities as a subcommand, taking
+the same arguments as the matching cg_<subcommand>.py script:
+
+    ./cg.py token --username <login> --password -
+    ./cg.py app --appname My_App --infofile appinfo.json
+    ./cg.py job monitor -df monitor_out.json
+    ./cg.py version
+    ./cg.py workflow test_workflow.json
+
+Many commands can run in one process, sharing the pooled connections and
+the cached token, either interactively or from a script:
+
+    # interactive prompt
+    ./cg.py shell
+
+    # one command per line from a file (or stdin), '#' starts a comment
+    ./cg.py batch test_script.cg
+    ./cg.py batch < test_script.cg
+
+Inside a shell or batch script, results are exported like the shell
+examples do by hand: 'token' (issue) sets CG_TOKEN, 'app' (register) sets
+CG_APP_NAME and 'job' (launch) sets CG_JOB_ID. Variables can also be set
+with 'export NAME=value'.
+"""
+
+import os
+import sys
+import cmd
+import shlex
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Module of each subcommand, imported when the subcommand first runs.
+COMMANDS = {
+    'token' : 'cg_token',
+    'app' : 'cg_app',
+    'job' : 'cg_job',
+    'version' : 'cg_version',
+    'workflow' : 'cg_workflow',
+}
+
+# Environment variable set from the result of (subcommand, action).
+RESULT_VARIABLES = {
+    ('token', 'issue') : 'CG_TOKEN',
+    ('app', 'register') : 'CG_APP_NAME',
+    ('job', 'launch') : 'CG_JOB_ID',
+}
+
+DEFAULT_ACTIONS = {
+    'token' : 'issue',
+    'app' : 'register',
+    'job' : 'launch',
+}
+
+USAGE = ("usage: cg.py {token,app,job,version,workflow} [arguments]\n"
+        "       cg.py shell\n"
+        "       cg.py batch [script]")
+
+def find_action(command, argv) :
+    """Returns the positional action in argv, or the command's default"""
+
+    positional = [arg for arg in argv if not arg.startswith('-')]
+    actions = ('issue', 'verify', 'revoke', 'register', 'configure',
+                'getinfo', 'getconfig', 'sync', 'launch', 'launch-batch',
+                'validate', 'monitor', 'watch', 'output', 'list', 'query')
+    for arg in positional :
+        if arg.lower() in actions :
+            return arg.lower()
+    return DEFAULT_ACTIONS.get(command)
+
+def run_command(argv) :
+    """Runs one subcommand line in this process.
+
+    Returns:
+        (int): exit status, 0 on success
+    """
+
+    if not argv :
+        return 0
+    command = argv[0]
+
+    if command == 'export' :
+        for assignment in argv[1:] :
+            name, _, value = assignment.partition('=')
+            os.environ[name] = value
+        return 0
+
+    if command not in COMMANDS :
+        logger.error("Unknown command '%s'\n%s" %(command, USAGE))
+        return 1
+
+    try :
+        result = __import__(COMMANDS[command]).main(argv[1:])
+    except SystemExit as e :
+        return e.code if isinstance(e.code, int) else 1
+    except Exception as e :
+        logger.error('%s: %s' %(command, e))
+        return 1
+
+    variable = RESULT_VARIABLES.get((command, find_action(command, argv[1:])))
+    if variable and result is not None :
+        os.environ[variable] = str(result)
+    return 0
+
+def run_batch(lines) :
+    """Runs every command line, continuing after failures.
+
+    Returns:
+        (int): 0 if all commands succeeded, 1 otherwise
+    """
+
+    status = 0
+    for number, line in enumerate(lines, 1) :
+        argv = shlex.split(line, comments=True)
+        if not argv :
+            continue
+        sys.stdout.flush()
+        if run_command(argv) != 0 :
+            logger.error('Line %d failed: %s' %(number, line.strip()))
+            status = 1
+    return status
+
+class Shell(cmd.Cmd) :
+    """Interactive prompt running one subcommand per line"""
+
+    prompt = 'cg> '
+    intro = 'GISolve utilities shell. Commands: %s, export, exit' \
+            %', '.join(sorted(COMMANDS))
+
+    def default(self, line) :
+        run_command(shlex.split(line, comments=True))
+
+    def emptyline(self) :
+        pass
+
+    def do_exit(self, line) :
+        return True
+
+    do_EOF = do_quit = do_exit
+
+def main(argv=None) :
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help') :
+        print USAGE
+        sys.exit(0 if argv else 1)
+
+    from cg_token import logger_initialize
+    logger_initialize(False)
+
+    if argv[0] == 'shell' :
+        Shell().cmdloop()
+    elif argv[0] == 'batch' :
+        if len(argv) > 1 and argv[1] != '-' :
+            with open(argv[1]) as f :
+                sys.exit(run_batch(f))
+        sys.exit(run_batch(sys.stdin))
+    else :
+        sys.exit(run_command(argv))
+
+if __name__ == '__main__' :
+    main()
@@ -6,7 +6,9 @@ Set of utilities to:
     Configure an App from a configuration file in JSON format
     Get App Info or config and write the response JSON to a destination file
 
-All calls require a valid token either from CG_TOKEN or command line --token
+All calls require a valid token either from CG_TOKEN or command line --token.
+Without one, a cached token is used (see cg_token_cache), issued with
+CG_USERNAME and CG_PASSWORD when the cache holds no valid token.
 
 Register App:
     # register an app with name "My_App" and store the name to CG_APP_NAME env var
@@ -22,26 +24,47 @@ Get App Info and Config and write to respective JSON files:
 
     # Get Config of app stored in CG_APP_NAME
     ./cg_app.py getconfig --destfile getconfig_out.json
+
+    # Append the info as a line of JSON to a gzip compressed file instead
+    # (see cg_sink for the other sinks)
+    ./cg_app.py getinfo --sink apps.jsonl.gz
+
+Register and configure every app of a manifest (see read_manifest), only
+calling the gateway for the apps that differ from it:
+    # print what would change, then apply it
+    ./cg_app.py sync --manifest apps.yaml --dry-run
+    ./cg_app.py sync --manifest apps.yaml
 """
 
-from cg_token import CGException, cg_rest, logger_initialize
+from cg_token import (CGException, cg_rest, logger_initialize,
+                        resolve_endpoint)
+from cg_token_cache import cached_token
+from cg_cache import app_cache
 import json
 import argparse
-import requests
 import os, sys, logging
-import getpass
-
-# This is used sed to disable InsecureRequestWarning.
-requests.packages.urllib3.disable_warnings()
 
 logger = logging.getLogger(__name__)
 
-def parse_args() :
+DEFAULT_WORKERS = int(os.getenv('CG_WORKERS', 16))
+
+# Error code of the gateway's answer for an app that is not registered, or
+# not configured.
+APP_NOT_FOUND = 2
+
+# App information fields compared by sync, with the app type.
+INFO_FIELDS = ('longname', 'version', 'info', 'tags')
+
+class ManifestError(ValueError) :
+    """Raised when an apps manifest is malformed"""
+
+def parse_args(argv=None) :
     """Defines command line positional and optional arguments and checks
         for valid action input if present. Additionally prompts with getpass
         if user specifies "--password -" to override CG_PASSWORD
         
-    Args: none
+    Args:
+        argv (list, optional): arguments to parse instead of sys.argv
 
     Returns: A (tuple) containing the following:
         args (namespace) : used to overwrite env variables when necessary
@@ -80,10 +103,25 @@ def parse_args() :
     parser.add_argument("-df","--destfile", 
         help="For actions 'getinfo' and 'getconfig' "
             "destination file path to write response")
+    parser.add_argument("--sink",
+        help="For actions 'getinfo' and 'getconfig', append the response "
+            "as a JSON line to a sink instead of --destfile: a file, '.gz' "
+            "or '.zst' compressed, '{run}' in its name for one file per "
+            "run, or '-' for stdout (see cg_sink)")
+    parser.add_argument("-m","--manifest",
+        help="For action 'sync', apps manifest in JSON (or YAML, with "
+            "PyYAML installed)")
+    parser.add_argument("-w","--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="For action 'sync', number of concurrent calls")
+    parser.add_argument("--dry-run",
+        action="store_true",
+        help="For action 'sync', print the plan without applying it")
     parser.add_argument("action", nargs='?', type=str, default='register',
-        help="register/configure/getinfo/getconfig")
+        help="register/configure/getinfo/getconfig/sync")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     logger_initialize(args.debug)
 
@@ -91,9 +129,10 @@ def parse_args() :
         logger.error('CG_API (API url for REST calls) '
                     'not specified\n')
         sys.exit(1)
+    args.endpoint = resolve_endpoint(args.endpoint)
 
     if args.action.lower() not in ['register','configure','getinfo',
-                                    'getinfo','getconfig'] :
+                                    'getinfo','getconfig','sync'] :
         logger.error('Invalid Action')
         sys.exit(1)
 
@@ -124,6 +163,26 @@ def register_app(endpoint, username, appname, token, apptype, info_filename) :
         logger.error("Info File incorrectly formatted")
         sys.exit(1)
 
+    return register_app_data(endpoint, username, appname, token, apptype,
+                            info)
+
+def register_app_data(endpoint, username, appname, token, apptype, info) :
+    """Calls the Gateway Register Application function with in-memory app
+    information and returns the app name
+
+    Args:
+        info (dict): app information with 'longname', 'version', 'info'
+                    and 'tags'
+
+        See register_app for the other arguments.
+
+    Returns:
+        (string): Registered App's name
+
+    Raise:
+        Passes any exceptions raised in cg_rest.
+    """
+
     data = {
         'token' : token,
         'app' : appname,
@@ -139,9 +198,30 @@ def register_app(endpoint, username, appname, token, apptype, info_filename) :
     logger.debug("Registering app '%s' from '%s'" %(appname,url))
 
     response = cg_rest('POST', url, **data)
+    app_cache.invalidate(app=appname)
     
     return response['result']['app']
 
+def fetch_app_info(endpoint, appname, token) :
+    """Calls the Gateway Get App Information function and returns the
+    response, answering from the app cache when possible (see cg_cache)
+
+    Args:
+        endpoint (string,  URL): the REST endpoint
+        appname (string): the name of the app
+        token (string): Valid token to allow user to manipulate applications
+
+    Returns:
+        (dict): the decoded app information response
+
+    Raises:
+        Passes any exceptions raised in cg_rest
+    """
+
+    url = endpoint.rstrip('/') + '/app'
+
+    return app_cache.get(url, token=token, app=appname)
+
 def get_app_info(endpoint, appname, token, dest_filename) :
     """Calls the Gateway Get App Information function and
     writes the Information to the destination file
@@ -161,14 +241,7 @@ def get_app_info(endpoint, appname, token, dest_filename) :
 
     logger.debug('Writing info to "' + dest_filename + '"')
 
-    params = {
-        'token' : token,
-        'app' : appname
-    }
-
-    url = endpoint.rstrip('/') + '/app'
-
-    response = cg_rest('GET', url, **params)
+    response = fetch_app_info(endpoint, appname, token)
 
     # Dump the response JSON (the app info) into the destination file.
     with open(dest_filename, 'w') as outfile :
@@ -204,6 +277,27 @@ def config_app(endpoint, appname, token, config_filename) :
         logger.error("Config File incorrectly formatted.")
         sys.exit(1)
 
+    config_app_data(endpoint, appname, token, config)
+
+    logger.debug('"%s" successfully configured from '
+                'config file "%s"' %(appname,config_filename))
+
+def config_app_data(endpoint, appname, token, config) :
+    """Calls the Gateway Configure App function with an in-memory app
+    configuration
+
+    Args:
+        config (dict): app configuration with 'description' and 'parameters'
+
+        See config_app for the other arguments.
+
+    Returns:
+        (void)
+
+    Raises:
+        Passes any exceptions raised in cg_rest
+    """
+
     data = {
         'token' : token,
         'app' : appname,
@@ -213,9 +307,27 @@ def config_app(endpoint, appname, token, config_filename) :
     url = endpoint.rstrip('/') + '/appconfig'
 
     response = cg_rest('POST', url, **data)
+    app_cache.invalidate(app=appname)
 
-    logger.debug('"%s" successfully configured from '
-                'config file "%s"' %(appname,config_filename))
+def fetch_app_config(endpoint, appname, token) :
+    """Calls the Gateway Get App Configuration function and returns the
+    response, answering from the app cache when possible (see cg_cache)
+
+    Args:
+        endpoint (string,  URL): the REST endpoint
+        appname (string): the name of the app
+        token (string): Valid token to allow user to manipulate applications
+
+    Returns:
+        (dict): the decoded app configuration response
+
+    Raises:
+        Passes any exceptions raised in cg_rest
+    """
+
+    url = endpoint.rstrip('/') + '/appconfig'
+
+    return app_cache.get(url, token=token, app=appname)
 
 def get_app_config(endpoint, appname, token, dest_filename) :
     """Calls the Gateway Get App Configuration function and writes
@@ -236,14 +348,7 @@ def get_app_config(endpoint, appname, token, dest_filename) :
 
     logger.debug('Writing config to "' + dest_filename + '"')
 
-    params = {
-        'token' : token,
-        'app' : appname
-    }
-
-    url = endpoint.rstrip('/') + '/appconfig'
-    
-    response = cg_rest('GET', url, **params)
+    response = fetch_app_config(endpoint, appname, token)
 
     # Dump the response JSON (the app config) into the destination file.
     with open(dest_filename, 'w') as outfile :
@@ -254,13 +359,273 @@ def get_app_config(endpoint, appname, token, dest_filename) :
     logger.debug('"%s" config successfully'
                 ' written to "%s"' %(appname,dest_filename))
 
-def main() :
-    (args,action) = parse_args()
+def _load_document(filename) :
+    with open(filename) as f :
+        if filename.endswith(('.yaml', '.yml')) :
+            try :
+                import yaml
+            except ImportError :
+                raise ManifestError('PyYAML is needed to read %s, '
+                                    'or give the manifest in JSON' %filename)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def read_manifest(filename) :
+    """Returns the apps of a manifest in JSON, or in YAML ('.yaml' or
+    '.yml') when PyYAML is installed.
+
+    The manifest maps app names to their type, information and
+    configuration, each given inline or as the path of a JSON file
+    (relative to the manifest). Entries of 'defaults' apply to every app:
+
+        {
+            "defaults" : {"type" : 0, "info" : "appinfo.json"},
+            "apps" : {
+                "My_App" : {"config" : "appconfig.json"},
+                "My_App_GPU" : {"type" : 2, "config" : "appconfig_gpu.json"}
+            }
+        }
+
+    Returns:
+        (dict): {appname : {'type' : int, 'info' : dict or None,
+                            'config' : dict or None}}
+
+    Raises:
+        ManifestError when the manifest or a file it names is malformed
+    """
+
+    try :
+        manifest = _load_document(filename)
+    except (IOError, ValueError) as e :
+        raise ManifestError('Cannot read manifest %s: %s' %(filename, e))
+    if not isinstance(manifest, dict) or \
+            not isinstance(manifest.get('apps'), dict) :
+        raise ManifestError("Manifest %s must have an 'apps' mapping"
+                            %filename)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    defaults = manifest.get('defaults') or {}
+    apps = {}
+    for appname, entry in manifest['apps'].items() :
+        spec = dict(defaults)
+        spec.update(entry or {})
+        unknown = set(spec) - set(['type', 'info', 'config'])
+        if unknown :
+            raise ManifestError("App '%s': unknown keys %s"
+                                %(appname, ', '.join(sorted(unknown))))
+        for key in ('info', 'config') :
+            value = spec.get(key)
+            if isinstance(value, basestring) :
+                try :
+                    value = _load_document(os.path.join(directory, value))
+                except (IOError, ValueError) as e :
+                    raise ManifestError("App '%s': cannot read %s: %s"
+                                        %(appname, key, e))
+            if value is not None and not isinstance(value, dict) :
+                raise ManifestError("App '%s': %s must be a mapping or the "
+                                    "path of a JSON file" %(appname, key))
+            spec[key] = value
+        try :
+            spec['type'] = int(spec.get('type', 0))
+        except (TypeError, ValueError) :
+            raise ManifestError("App '%s': type must be 0, 1 or 2"
+                                %appname)
+        if not 0 <= spec['type'] <= 2 :
+            raise ManifestError("App '%s': type must be 0, 1 or 2"
+                                %appname)
+        if spec['info'] is None and spec['config'] is None :
+            raise ManifestError("App '%s' has neither info nor config"
+                                %appname)
+        apps[appname] = spec
+    return apps
+
+def _current(fetch, endpoint, appname, token) :
+    """Returns the 'result' of a cached fetch, or None when the gateway
+    has no such app (or configuration)
+
+    Raises:
+        Passes any exceptions raised in cg_rest, including the gateway's
+        errors other than APP_NOT_FOUND (e.g. an invalid token)
+    """
+
+    try :
+        return fetch(endpoint, appname, token)['result']
+    except CGException as e :
+        if e.error_code != APP_NOT_FOUND :
+            raise
+        logger.debug("'%s' not found on the gateway: %s" %(appname, e))
+        return None
+
+def plan_app(endpoint, appname, token, spec) :
+    """Compares the desired state of one app with the gateway's.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        appname (string): the name of the app
+        token (string): Valid token to allow user to manipulate applications
+        spec (dict): the app's entry of read_manifest
+
+    Returns:
+        (list): (action, reason) pairs, 'register' before 'configure', or
+                an empty list when the app is up to date
+
+    Raises:
+        Passes any exceptions raised in cg_rest, see _current
+    """
+
+    changes = []
+    if spec['info'] is not None :
+        current = _current(fetch_app_info, endpoint, appname, token)
+        if current is None :
+            changes.append(('register', 'new app'))
+        else :
+            changed = [field for field in INFO_FIELDS
+                        if unicode(current.get(field, '')) !=
+                        unicode(spec['info'].get(field, ''))]
+            if str(current.get('type', 0)) != str(spec['type']) :
+                changed.append('type')
+            if changed :
+                changes.append(('register', '%s changed'
+                                %', '.join(changed)))
+    if spec['config'] is not None :
+        current = _current(fetch_app_config, endpoint, appname, token)
+        if current is None :
+            changes.append(('configure', 'not configured'))
+        elif (json.dumps(current, sort_keys=True) !=
+                json.dumps(spec['config'], sort_keys=True)) :
+            changes.append(('configure', 'config changed'))
+    return changes
+
+def apply_app(endpoint, username, appname, token, spec, changes) :
+    """Registers and/or configures one app as planned by plan_app
+
+    Raises:
+        Passes any exceptions raised in cg_rest
+    """
+
+    for action, reason in changes :
+        if action == 'register' :
+            register_app_data(endpoint, username, appname, token,
+                            spec['type'], spec['info'])
+        else :
+            config_app_data(endpoint, appname, token, spec['config'])
+        logger.debug("%s '%s' (%s)" %(action.capitalize(), appname, reason))
+
+def sync_apps(endpoint, username, token, apps, workers=DEFAULT_WORKERS,
+                dry_run=False) :
+    """Brings the gateway's apps to the state of a manifest, concurrently
+    over the pooled session. The gateway state is fetched through the app
+    cache (see cg_cache), and only the apps that differ are registered or
+    configured again.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        username (string): the user's login, author of registered apps
+        token (string): Valid token to allow user to manipulate applications
+        apps (dict): the apps of read_manifest
+        workers (int, optional): number of concurrent calls
+        dry_run (bool, optional): only plan, change nothing
+
+    Returns:
+        (list): (appname, changes, exception) per app in name order, with
+                changes from plan_app and exception None unless the app
+                failed to be planned or applied
+    """
+
+    import cg_session
+    from multiprocessing.pool import ThreadPool
+
+    cg_session.configure_endpoint(endpoint, pool_size=workers)
+    pool = ThreadPool(workers)
+
+    def sync(appname) :
+        spec = apps[appname]
+        changes = []
+        try :
+            changes = plan_app(endpoint, appname, token, spec)
+            if changes and not dry_run :
+                apply_app(endpoint, username, appname, token, spec, changes)
+            return (appname, changes, None)
+        except Exception as e :
+            return (appname, changes, e)
+
+    try :
+        return pool.map(sync, sorted(apps))
+    finally :
+        pool.close()
+        pool.join()
+
+def write_to_sink(args, action) :
+    """Runs 'getinfo' or 'getconfig' with --sink, appending the response
+    to the shared sink of the spec"""
+
+    import cg_sink
+
+    try :
+        sink = cg_sink.get_sink(args.sink)
+    except cg_sink.SinkError as e :
+        logger.error(e)
+        sys.exit(1)
+    fetch = fetch_app_info if action == 'getinfo' else fetch_app_config
+    response = fetch(args.endpoint, args.appname, args.token)
+    sink.write(cg_sink.make_record(action, response, app=args.appname))
+
+def sync_manifest(args) :
+    """Runs the 'sync' action, printing one line per planned change (or
+    unchanged app) and a summary; exits with 1 when an app failed"""
+
+    if not args.manifest :
+        logger.error("No manifest given for 'sync'")
+        sys.exit(1)
+    try :
+        apps = read_manifest(args.manifest)
+    except ManifestError as e :
+        logger.error(e)
+        sys.exit(1)
+
+    results = sync_apps(args.endpoint, args.username, args.token, apps,
+                        args.workers, args.dry_run)
+    counts = {'register' : 0, 'configure' : 0, 'unchanged' : 0,
+                'failed' : 0}
+    for appname, changes, error in results :
+        for action, reason in changes :
+            print '%-10s %-32s %s' %(action, appname, reason)
+        if error is not None :
+            print '%-10s %-32s %s' %('failed', appname, error)
+            counts['failed'] += 1
+        elif not changes :
+            print '%-10s %s' %('unchanged', appname)
+            counts['unchanged'] += 1
+        else :
+            for action, reason in changes :
+                counts[action] += 1
+    counts['apps'] = len(results)
+    counts['verb'] = 'to be ' if args.dry_run else ''
+    print ('%(apps)d apps: %(register)d %(verb)sregistered, %(configure)d '
+            '%(verb)sconfigured, %(unchanged)d unchanged, %(failed)d failed'
+            %counts)
+    sys.stdout.flush()
+    if counts['failed'] :
+        sys.exit(1)
+    return results
+
+def main(argv=None) :
+    (args,action) = parse_args(argv)
     
+    if not args.token :
+        try :
+            args.token = cached_token(args.endpoint, args.username)
+        except CGException as e :
+            logger.error(e)
+            sys.exit(1)
+
     if not args.token :
             logger.error('No valid CG_TOKEN given')
             sys.exit(1)
 
+    if action == 'sync' :
+        return sync_manifest(args)
+
     if not args.appname :
         logger.error('No CG_APP_NAME found or '
                     'command line argument specified')
@@ -275,9 +640,11 @@ def main() :
                                 '2: Parallel(GPU)')
                     sys.exit(1)
 
-                print register_app(args.endpoint, args.username, 
-                                    args.appname, args.token, 
-                                    args.type, args.infofile) 
+                appname = register_app(args.endpoint, args.username,
+                                    args.appname, args.token,
+                                    args.type, args.infofile)
+                print appname
+                return appname
 
             else :
                 logger.error("No valid App Info file path given")
@@ -291,6 +658,9 @@ def main() :
                     logger.error("Config File Doesn't Exist")
                     sys.exit(1)
 
+        elif action in ('getinfo', 'getconfig') and args.sink :
+            write_to_sink(args, action)
+
         elif action == 'getinfo' :
             if args.destfile :
                 get_app_info(args.endpoint, args.appname, 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Concurrent client for the whole GISolve API surface
+
+Every call returns immediately with an AsyncResult; call .get() on it to
+wait for the decoded result. Errors are raised from .get() exactly as the
+blocking functions raise them (CGException when the gateway returns an
+'error' status). All calls share one bounded connection pool, and the
+number of calls in flight can be limited per endpoint path:
+
+    from cg_async import CGAsyncClient
+
+    with CGAsyncClient(endpoint, workers=32, limits={'/job' : 8}) as client :
+        pending = [client.launch_job(token, 'job%d' %i, appname, owner,
+                                    'jobconfig.json', {})
+                    for i in range(100)]
+        job_ids = [p.get() for p in pending]
+"""
+
+import os
+import logging
+from multiprocessing.pool import ThreadPool
+import cg_session
+import cg_token
+import cg_app
+import cg_job
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = int(os.getenv('CG_WORKERS', 16))
+
+class CGAsyncClient(object) :
+    """Runs GISolve API calls on a shared thread pool.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        workers (int, optional): number of calls to paths without a limit
+                                that can run at once
+        limits (dict, optional): maximum calls in flight per endpoint path,
+                                e.g. {'/job' : 8, '/token' : 2}; calls to
+                                a limited path queue on their own threads,
+                                not on the workers
+    """
+
+    def __init__(self, endpoint, workers=DEFAULT_WORKERS, limits=None) :
+        self.endpoint = endpoint
+        self.workers = workers
+        # A limited path runs on its own pool of limit threads, so calls
+        # waiting for the limit queue there and never hold a shared worker.
+        self.limits = dict(limits or {})
+        self.pools = dict((path, ThreadPool(limit))
+                        for path, limit in self.limits.items())
+        cg_session.configure_endpoint(endpoint, pool_size=workers +
+                                    sum(self.limits.values()))
+        self.pool = ThreadPool(workers)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc_info) :
+        self.close()
+
+    def close(self) :
+        """Waits for all pending calls and stops the worker threads"""
+
+        for pool in [self.pool] + self.pools.values() :
+            pool.close()
+        for pool in [self.pool] + self.pools.values() :
+            pool.join()
+
+    def submit(self, path, func, *args) :
+        """Schedules func(*args) under the concurrency limit for path.
+
+        Returns:
+            (AsyncResult): .get() returns func's result or raises its error
+        """
+
+        return self.pools.get(path, self.pool).apply_async(func, args)
+
+    def issue_token(self, username, password, lifetime, binding) :
+        return self.submit('/token', cg_token.issue_token, self.endpoint,
+                            username, password, lifetime, binding)
+
+    def verify_token(self, username, token, client_id, client_ip) :
+        return self.submit('/token', cg_token.verify_token, self.endpoint,
+                            username, token, client_id, client_ip)
+
+    def revoke_token(self, username, password, token) :
+        return self.submit('/token', cg_token.revoke_token, self.endpoint,
+                            username, password, token)
+
+    def register_app(self, username, appname, token, apptype,
+                    info_filename) :
+        return self.submit('/app', cg_app.register_app, self.endpoint,
+                            username, appname, token, apptype, info_filename)
+
+    def get_app_info(self, appname, token, dest_filename) :
+        return self.submit('/app', cg_app.get_app_info, self.endpoint,
+                            appname, token, dest_filename)
+
+    def config_app(self, appname, token, config_filename) :
+        return self.submit('/appconfig', cg_app.config_app, self.endpoint,
+                            appname, token, config_filename)
+
+    def get_app_config(self, appname, token, dest_filename) :
+        return self.submit('/appconfig', cg_app.get_app_config,
+                            self.endpoint, appname, token, dest_filename)
+
+    def launch_job(self, token, jobname, appname, owner,
+                    config_filename, computation) :
+        return self.submit('/job', cg_job.launch_job, self.endpoint, token,
+                            jobname, appname, owner, config_filename,
+                            computation)
+
+    def monitor_job(self, token, job_id, dest_filename) :
+        return self.submit('/job', cg_job.monitor_job, self.endpoint,
+                            token, job_id, dest_filename)
+
+    def get_job_output(self, token, job_id) :
+        return self.submit('/joboutput', cg_job.get_job_output,
+                            self.endpoint, token, job_id)
+
+def gather(results) :
+    """Waits for a list of AsyncResults and returns their values in order.
+
+    Raises:
+        The first exception raised by any of the calls.
+    """
+
+    return [result.get() for result in results]
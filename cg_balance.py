@@ -0,0 +1,333 @@
+"""
+Client-side load balancing and failover across gateway replicas
+
+CG_API (or --endpoint) may list several replicas of the same gateway,
+separated by commas:
+
+    export CG_API="https://gw1.example.org/,https://gw2.example.org/"
+
+The list is replaced by one virtual endpoint, 'http://<hash>.cgpool.invalid/',
+so every function keeps building its URLs with endpoint.rstrip('/') + '/job'.
+Calls to the virtual endpoint are sent to one replica, chosen by a strategy:
+
+    round_robin         each replica in turn
+    least_outstanding   the replica with the fewest calls in progress
+    ewma                the lowest EWMA of response time, weighted by the
+                        calls in progress (default)
+
+A replica is ejected after eject_after consecutive failures (connection
+errors, timeouts, 5xx and 429 answers), and for longer each time it is
+ejected again. A background thread checks every replica with GET /version
+and brings healthy ones back. Idempotent calls (GET, PUT, DELETE) that
+fail are sent again to another replica at once; other calls only when the
+failed replica never received them. When every replica is ejected, calls
+still go to the one ejected the longest ago.
+
+Replicas must share their state (tokens, apps and jobs), as successive
+calls may go to different replicas.
+
+Settings come from the bash environment:
+
+    CG_BALANCE          strategy (default ewma)
+    CG_EJECT_AFTER      consecutive failures that eject a replica (default 3)
+    CG_EJECT_TIME       seconds of the first ejection, doubled on each
+                        ejection in a row, up to 16 times as long
+                        (default 10)
+    CG_HEALTH_INTERVAL  seconds between health checks, 0 disables them
+                        (default 5)
+
+Pools can also be made at run time:
+
+    import cg_balance
+    endpoint = cg_balance.pool_endpoint(['http://gw1/', 'http://gw2/'],
+                                        strategy='least_outstanding')
+    print cg_balance.get_pool(endpoint).stats()
+"""
+
+import os
+import time
+import atexit
+import random
+import hashlib
+import logging
+import threading
+import itertools
+from requests import exceptions as rex
+from requests.adapters import BaseAdapter
+import cg_session
+import cg_retry
+
+logger = logging.getLogger(__name__)
+
+# Host suffix of virtual endpoints; '.invalid' names never resolve, so a
+# virtual URL cannot leave the process by mistake. The scheme is http for
+# requests to encode query parameters.
+VIRTUAL_DOMAIN = 'cgpool.invalid'
+STRATEGIES = ('round_robin', 'least_outstanding', 'ewma')
+
+DEFAULT_STRATEGY = os.getenv('CG_BALANCE', 'ewma')
+DEFAULT_EJECT_AFTER = int(os.getenv('CG_EJECT_AFTER', 3))
+DEFAULT_EJECT_TIME = float(os.getenv('CG_EJECT_TIME', 10))
+DEFAULT_HEALTH_INTERVAL = float(os.getenv('CG_HEALTH_INTERVAL', 5))
+
+# Weight of the newest response time in a replica's EWMA.
+EWMA_WEIGHT = 0.3
+
+class NoReplicaError(rex.ConnectionError) :
+    """Raised when every replica of a pool failed the same call"""
+
+class Replica(object) :
+    """Health and load of one gateway replica"""
+
+    def __init__(self, url) :
+        self.url = url
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def healthy(self, now) :
+        return now >= self.ejected_until
+
+class ReplicaPool(object) :
+    """Replicas of one gateway and the strategy choosing between them.
+
+    Args:
+        urls (list of string): endpoints of the replicas
+        strategy (string, optional): one of STRATEGIES
+        eject_after (int, optional): consecutive failures ejecting a replica
+        eject_time (float, optional): seconds of the first ejection
+        health_interval (float, optional): seconds between health checks,
+                                            0 disables them
+    """
+
+    def __init__(self, urls, strategy=DEFAULT_STRATEGY,
+                eject_after=DEFAULT_EJECT_AFTER,
+                eject_time=DEFAULT_EJECT_TIME,
+                health_interval=DEFAULT_HEALTH_INTERVAL) :
+        if strategy not in STRATEGIES :
+            raise ValueError("Unknown balancing strategy '%s', expected one "
+                            "of %s" %(strategy, ', '.join(STRATEGIES)))
+        self.replicas = [Replica(url.rstrip('/') + '/') for url in urls]
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_time = eject_time
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.turn = itertools.count()
+        self.checker = None
+        self.stopped = threading.Event()
+
+    def choose(self, exclude=()) :
+        """Returns the replica the next call goes to, counted as
+        outstanding until release, or None when every one is excluded"""
+
+        now = time.time()
+        with self.lock :
+            candidates = [r for r in self.replicas if r not in exclude]
+            if not candidates :
+                return None
+            healthy = [r for r in candidates if r.healthy(now)]
+            if not healthy :
+                # Fail open on the replica most likely to have recovered.
+                healthy = [min(candidates, key=lambda r : r.ejected_until)]
+            if self.strategy == 'round_robin' :
+                replica = healthy[next(self.turn) % len(healthy)]
+            elif self.strategy == 'least_outstanding' :
+                least = min(r.outstanding for r in healthy)
+                replica = random.choice([r for r in healthy
+                                        if r.outstanding == least])
+            else :
+                replica = min(healthy, key=lambda r :
+                            (r.ewma * (r.outstanding + 1), r.outstanding,
+                            random.random()))
+            replica.outstanding += 1
+            replica.calls += 1
+        return replica
+
+    def release(self, replica, seconds, failed) :
+        """Records the outcome of a call sent to replica by choose"""
+
+        with self.lock :
+            replica.outstanding -= 1
+            if failed :
+                self._failure(replica)
+            else :
+                replica.ewma = (seconds if not replica.ewma else
+                                EWMA_WEIGHT * seconds +
+                                (1 - EWMA_WEIGHT) * replica.ewma)
+                self._success(replica)
+
+    def _success(self, replica) :
+        if replica.ejected_until :
+            logger.info('Replica %s is back' %replica.url)
+        replica.consecutive = 0
+        replica.ejections = 0
+        replica.ejected_until = 0.0
+
+    def _failure(self, replica) :
+        replica.failures += 1
+        replica.consecutive += 1
+        if replica.consecutive >= self.eject_after :
+            seconds = self.eject_time * 2 ** min(replica.ejections, 4)
+            replica.ejected_until = time.time() + seconds
+            replica.ejections += 1
+            replica.consecutive = 0
+            logger.warning('Replica %s ejected for %g seconds'
+                            %(replica.url, seconds))
+
+    def check(self, timeout=5) :
+        """Checks every replica with GET /version once"""
+
+        for replica in self.replicas :
+            try :
+                r = cg_session.get_session().get(replica.url + 'version',
+                                                timeout=timeout)
+                failed = cg_retry.is_failure(r)
+            except (rex.ConnectionError, rex.Timeout) :
+                failed = True
+            with self.lock :
+                if failed :
+                    self._failure(replica)
+                elif replica.ejected_until :
+                    self._success(replica)
+
+    def _check_periodically(self) :
+        while not self.stopped.wait(self.health_interval) :
+            try :
+                self.check(timeout=min(self.health_interval, 5))
+            except Exception as e :
+                logger.warning('Health check failed: %s' %e)
+
+    def start(self) :
+        """Starts the background health checks, if enabled"""
+
+        if self.health_interval and self.checker is None :
+            self.checker = threading.Thread(target=self._check_periodically)
+            self.checker.daemon = True
+            self.checker.start()
+        return self
+
+    def stop(self) :
+        """Stops the health checks, waiting for the one in progress"""
+
+        self.stopped.set()
+        if self.checker is not None :
+            self.checker.join(5)
+
+    def stats(self) :
+        """Returns the calls, failures, outstanding calls, EWMA (ms) and
+        health of every replica"""
+
+        now = time.time()
+        with self.lock :
+            return dict((r.url, {'calls' : r.calls, 'failures' : r.failures,
+                                'outstanding' : r.outstanding,
+                                'ewma_ms' : r.ewma * 1000,
+                                'healthy' : r.healthy(now)})
+                        for r in self.replicas)
+
+class PoolAdapter(BaseAdapter) :
+    """Transport adapter of a virtual endpoint, sending each request to a
+    replica of its pool through the adapter mounted for that replica"""
+
+    def __init__(self, prefix, pool) :
+        BaseAdapter.__init__(self)
+        self.prefix = prefix
+        self.pool = pool
+
+    def send(self, request, **kwargs) :
+        path = request.url[len(self.prefix):]
+        idempotent = request.method in cg_retry.IDEMPOTENT_METHODS
+        tried = []
+        while True :
+            replica = self.pool.choose(exclude=tried)
+            if replica is None :
+                raise NoReplicaError('Every replica of %s failed: %s'
+                                    %(self.prefix, error), request=request)
+            tried.append(replica)
+            prepared = request.copy()
+            prepared.url = replica.url + path
+            adapter = cg_session.get_session().get_adapter(prepared.url)
+            start = time.time()
+            try :
+                r = adapter.send(prepared, **kwargs)
+            except (rex.ConnectionError, rex.Timeout) as e :
+                self.pool.release(replica, time.time() - start, True)
+                if not (idempotent or cg_retry.not_sent(e)) :
+                    raise
+                logger.debug('%s failed on %s, trying another replica: %s'
+                            %(request.method, replica.url, e))
+                error = e
+                continue
+            failed = cg_retry.is_failure(r)
+            self.pool.release(replica, time.time() - start, failed)
+            if (failed and len(tried) < len(self.pool.replicas) and
+                    (idempotent or
+                    r.status_code in cg_retry.REJECTED_STATUSES)) :
+                logger.debug('%s answered %d on %s, trying another replica'
+                            %(request.method, r.status_code, replica.url))
+                error = 'HTTP %d' %r.status_code
+                r.close()
+                continue
+            return r
+
+    def close(self) :
+        pass
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def pool_endpoint(urls, strategy=DEFAULT_STRATEGY, **options) :
+    """Returns the virtual endpoint balancing calls over urls, making its
+    ReplicaPool on first use.
+
+    The virtual endpoint only depends on the URLs and the strategy, so it
+    is the same in every process (e.g. for cached tokens and the job
+    ledger).
+
+    Args:
+        urls (list of string): endpoints of the replicas
+        strategy (string, optional): one of STRATEGIES
+
+        See ReplicaPool for the other options.
+    """
+
+    urls = [url.rstrip('/') + '/' for url in urls]
+    digest = hashlib.sha1(','.join(urls + [strategy])).hexdigest()
+    prefix = 'http://%s.%s/' %(digest[:12], VIRTUAL_DOMAIN)
+    with _pools_lock :
+        if prefix not in _pools :
+            if not _pools :
+                atexit.register(stop_pools)
+            pool = ReplicaPool(urls, strategy, **options).start()
+            _pools[prefix] = pool
+            cg_session.mount_pool(prefix, PoolAdapter(prefix, pool),
+                                urls)
+            logger.debug('%s balances over %s (%s)'
+                        %(prefix, ', '.join(urls), strategy))
+    return prefix
+
+def resolve(endpoint) :
+    """Returns endpoint, or the virtual endpoint of a comma separated list
+    of replicas"""
+
+    urls = [url.strip() for url in endpoint.split(',') if url.strip()]
+    if len(urls) < 2 :
+        return endpoint
+    return pool_endpoint(urls)
+
+def stop_pools() :
+    """Stops the health checks of every pool, before the interpreter
+    exits under their threads"""
+
+    for pool in _pools.values() :
+        pool.stop()
+
+def get_pool(endpoint) :
+    """Returns the ReplicaPool of a virtual endpoint, or None"""
+
+    return _pools.get(endpoint.rstrip('/') + '/')
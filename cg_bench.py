@@ -0,0 +1,784 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the cg_* utilities, run against the local stub gateway
+
+Each benchmark is selected by name and prints its results to stdout:
+
+    # compare a fresh connection per call with the pooled session
+    ./cg_bench.py pool --calls 2000
+
+    # cg_rest overhead on a large response with debug logging off and on
+    ./cg_bench.py logging --calls 500
+
+    # calls succeeding with and without retries at a 30% injected 503 rate,
+    # then how fast calls fail once the gateway is down
+    ./cg_bench.py retry --calls 500
+
+    # p50/p99 latency and throughput of every API function, one thread and
+    # 8 threads, with 5ms of simulated gateway latency
+    ./cg_bench.py suite --calls 200 --threads 8 --latency 0.005
+
+    # job configs checked per second by the compiled parameter schema
+    ./cg_bench.py validate --calls 100000
+
+    # job configs streamed per second from a million-point sweep, whole
+    # and as shard 3 of 8 (random access by index)
+    ./cg_bench.py sweep --calls 100000
+
+    # job ledger records/sec committed one by one and in batches, then
+    # the time of an indexed query over the recorded jobs
+    ./cg_bench.py ledger --calls 20000
+
+    # 50 apps registered and configured one by one, then synced from a
+    # manifest when nothing changed, 20ms of gateway latency
+    ./cg_bench.py sync --calls 1000 --latency 0.02
+
+    # test_workflow.json run one step at a time (like test_script.sh) and
+    # with independent steps run concurrently, 50ms of gateway latency
+    ./cg_bench.py workflow --runs 3 --latency 0.05
+
+    # cg_rest calls/sec with no metrics listener and with every exporter
+    ./cg_bench.py metrics --calls 2000
+
+    # calls/sec against one stub replica serving 2 calls at a time, then
+    # balanced over 3 replicas with each strategy, 50ms of gateway latency
+    ./cg_bench.py balance --calls 300 --threads 12
+
+    # per-job cost of launch_job from a config file one at a time, of
+    # launch_batch, and of launch_jobs without and with a bulk endpoint
+    ./cg_bench.py bulk --calls 2000 --threads 8 --latency 0.005
+
+    # configs/sec built, validated, serialized and hashed from a sweep of
+    # large configs in this process, then in 1, 2, 4, ... processes up to
+    # the number of CPUs; then launched end to end
+    ./cg_bench.py launcher --calls 20000 --threads 16
+
+    # monitor responses/sec written one JSON file per call, then appended
+    # to a JSONL sink, plain and gzip compressed
+    ./cg_bench.py sink --calls 20000
+
+    # token checks/sec of 32 callers, one gateway call per check vs the
+    # coalescing cache of cg_verify, 5ms of gateway latency
+    ./cg_bench.py verify --calls 5000 --threads 32 --latency 0.005
+
+    # test_script.cg flow: one interpreter per command vs one cg.py batch
+    ./cg_bench.py cli --runs 5
+
+    # '--help' time of each cg_* CLI and the import time of its module
+    ./cg_bench.py startup --runs 20
+
+    # run against a gateway that is already running instead of the stub
+    ./cg_bench.py pool --endpoint http://127.0.0.1:8000/
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import requests
+from multiprocessing.pool import ThreadPool
+import cg
+import cg_app
+import cg_job
+import cg_session
+import cg_retry
+import cg_token
+import cg_validate
+import cg_sweep
+import cg_ledger
+import cg_workflow
+import cg_metrics
+import cg_balance
+import cg_sink
+import cg_verify
+import cg_launcher
+from cg_token import cg_rest, logger_initialize, issue_token, verify_token
+from cg_stub import StubGateway
+
+logger = logging.getLogger(__name__)
+
+def report(label, calls, elapsed) :
+    print ("%-28s %8d calls %8.3f s %10.1f calls/sec"
+            %(label, calls, elapsed, calls / max(elapsed, 1e-9)))
+
+def timed(func, calls) :
+    start = time.time()
+    for i in xrange(calls) :
+        func()
+    return time.time() - start
+
+def bench_pool(endpoint, args) :
+    """Calls/sec of GET /version with and without the pooled session"""
+
+    url = endpoint.rstrip('/') + '/version'
+
+    def unpooled() :
+        r = requests.request('GET', url, timeout=50, verify=False)
+        r.raise_for_status()
+        return r.json()
+
+    report('requests.request (before)', args.calls,
+            timed(unpooled, args.calls))
+    cg_session.close_session()
+    report('cg_rest, pooled (after)', args.calls,
+            timed(lambda : cg_rest('GET', url), args.calls))
+
+def large_config(nparams) :
+    parameters = {}
+    for i in xrange(nparams) :
+        parameters['param%d' %i] = {'datatype' : 'integer',
+                                    'default' : '500', 'min' : '50',
+                                    'max' : '1000', 'name' : 'param%d' %i,
+                                    'description' : 'Parameter %d' %i,
+                                    'optional' : False}
+    return {'name' : 'BENCH', 'parameters' : parameters}
+
+def bench_logging(endpoint, args) :
+    """cg_rest overhead on a large /appconfig response, logging off and on"""
+
+    base = endpoint.rstrip('/')
+    token = issue_token(endpoint, 'bench', 'bench', 3600, 0)
+    cg_rest('POST', base + '/app', token=token, app='BENCH')
+    cg_rest('POST', base + '/appconfig', token=token, app='BENCH',
+            config=json.dumps(large_config(500)))
+    request = {'token' : token, 'app' : 'BENCH', 'password' : 'secret'}
+    response = cg_rest('GET', base + '/appconfig', **request)
+
+    token_logger = logging.getLogger(cg_token.__name__)
+    token_logger.propagate = False
+    token_logger.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+    for name, level in (('off', logging.WARNING), ('on', logging.DEBUG)) :
+        token_logger.setLevel(level)
+        report('log_response, debug %s' %name, args.calls,
+                timed(lambda : cg_token.log_response('GET',
+                        base + '/appconfig', response, request), args.calls))
+        report('cg_rest, debug %s' %name, args.calls,
+                timed(lambda : cg_rest('GET', base + '/appconfig',
+                                        **request), args.calls))
+
+def bench_validate(endpoint, args) :
+    """Job configs per second checked by a compiled parameter schema"""
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'appconfig.json')) as f :
+        app_config = json.load(f)
+    start = time.time()
+    validator = cg_validate.compile_schema(app_config)
+    print 'compile_schema %32.6f s' %(time.time() - start)
+
+    base = {'param0' : '500', 'param1' : '500', 'param2' : '5',
+            'param3' : 'http://cybergis.org/sampledata/somedata.dat'}
+    configs = []
+    for i in xrange(args.calls) :
+        parameters = dict(base, param0=str(10 + i % 1000))
+        configs.append({'parameters' : parameters})
+
+    start = time.time()
+    violations = validator.validate_batch(configs)
+    report('validate_batch', args.calls, time.time() - start)
+    print '%d violations' %len(violations)
+
+def bench_sweep(endpoint, args) :
+    """Job configs per second streamed from grid and sampled sweeps"""
+
+    base = {'parameters' : {'param3' : 'http://cybergis.org/sampledata/'
+                                        'somedata.dat'}}
+    axes = {'param0' : {'range' : [50, 1000]},
+            'param1' : {'range' : [50, 1000, 1]},
+            'param2' : {'min' : 1, 'max' : 100, 'type' : 'integer'}}
+    for sampling, shards in (('grid', 1), ('grid', 8), ('lhs', 1)) :
+        sweep = cg_sweep.load_sweep({'parameters' : axes,
+                                    'sampling' : sampling,
+                                    'samples' : 10 ** 6}, base)
+        configs = sweep.configs(3 % shards, shards)
+        start = time.time()
+        for i in xrange(args.calls) :
+            next(configs)
+        report('%s sweep, shard %d/%d' %(sampling, 3 % shards, shards),
+                args.calls, time.time() - start)
+
+def bench_ledger(endpoint, args) :
+    """Ledger records per second, unbatched and batched, and query time"""
+
+    workdir = tempfile.mkdtemp()
+    try :
+        for label, batch_size in (('per record', 1), ('batched', 500)) :
+            ledger = cg_ledger.Ledger(os.path.join(workdir, label + '.db'),
+                                        batch_size=batch_size)
+            calls = args.calls if batch_size > 1 else args.calls // 10
+            start = time.time()
+            for i in xrange(calls) :
+                ledger.record('job%d' %i, app='APP%d' %(i % 10),
+                                name='bench_%d' %i, state='QUEUED')
+                ledger.record('job%d' %i,
+                                state=('RUNNING', 'FINISHED')[i % 2])
+            ledger.flush()
+            report('ledger, commit %s' %label, 2 * calls,
+                    time.time() - start)
+
+        start = time.time()
+        jobs = ledger.query(state='FINISHED', app='APP3')
+        print ('query state=FINISHED app=APP3 %5d jobs %8.3f ms'
+                %(len(jobs), (time.time() - start) * 1000))
+        ledger.close()
+    finally :
+        shutil.rmtree(workdir)
+
+def bench_workflow(endpoint, args) :
+    """Wall time of test_workflow.json run serially and concurrently"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    workflow = cg_workflow.load_workflow(os.path.join(here,
+                                                    'test_workflow.json'))
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try :
+        for name in ('appinfo.json', 'appconfig.json', 'jobconfig.json') :
+            shutil.copy(os.path.join(here, name), workdir)
+        os.chdir(workdir)
+        for label, workers in (('serial (before)', 1),
+                                ('concurrent (after)', 8)) :
+            start = time.time()
+            for i in xrange(args.runs) :
+                status = cg_workflow.Runner(workflow, endpoint, 'bench',
+                                            'bench', workers=workers,
+                                            emit=lambda event : None).run()
+                assert set(status.values()) == set(['done'])
+            elapsed = time.time() - start
+            print ('workflow, %-20s %4d runs %8.3f s %8.3f s/run'
+                    %(label, args.runs, elapsed, elapsed / args.runs))
+    finally :
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+def bench_sync(endpoint, args) :
+    """Provisioning a manifest of apps: every app registered and configured
+    one after the other (before), then 'sync' of the same manifest when
+    nothing changed"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    token = issue_token(endpoint, 'bench', 'bench', 43200, None)
+    with open(os.path.join(here, 'appinfo.json')) as f :
+        info = json.load(f)
+    with open(os.path.join(here, 'appconfig.json')) as f :
+        config = json.load(f)
+    count = max(args.calls // 20, 1)
+    apps = dict(('Bench_App_%d' %i, {'type' : 0, 'info' : info,
+                                    'config' : config})
+                for i in xrange(count))
+
+    def provision() :
+        for appname in sorted(apps) :
+            cg_app.register_app_data(endpoint, 'bench', appname, token, 0,
+                                    info)
+            cg_app.config_app_data(endpoint, appname, token, config)
+
+    for label, func in (('register + configure each', provision),
+                        ('sync, nothing changed', lambda :
+                            cg_app.sync_apps(endpoint, 'bench', token, apps,
+                                            args.threads))) :
+        elapsed = timed(func, args.runs)
+        print ("%-28s %8d apps  %8.3f s per run"
+                %(label, count, elapsed / args.runs))
+
+def bench_verify(endpoint, args) :
+    """Token checks/sec of --threads callers verifying 10 tokens, calling
+    the gateway each time and through a TokenVerifier"""
+
+    tokens = [issue_token(endpoint, 'bench', 'bench', 3600, 0)
+                for i in xrange(10)]
+    verifier = cg_verify.TokenVerifier(endpoint)
+    cg_session.configure_endpoint(endpoint, pool_size=args.threads)
+    pool = ThreadPool(args.threads)
+
+    for label, verify in (('verify_token (before)', lambda token :
+                                verify_token(endpoint, 'bench', token,
+                                            'bench', '127.0.0.1')),
+                            ('TokenVerifier (after)', lambda token :
+                                verifier.verify('bench', token, 'bench',
+                                                '127.0.0.1'))) :
+        start = time.time()
+        pool.map(verify, (tokens[i % len(tokens)]
+                            for i in xrange(args.calls)))
+        report(label, args.calls, time.time() - start)
+    pool.close()
+    pool.join()
+    stats = verifier.stats()
+    print ('%d gateway calls, %d coalesced, hit rate %.4f'
+            %(stats['misses'], stats['coalesced'], stats['hit_rate']))
+
+def bench_sink(endpoint, args) :
+    """Monitor responses/sec written one pretty-printed file per call (like
+    monitor_job), then appended to JSONL sinks, with the bytes on disk"""
+
+    token = issue_token(endpoint, 'bench', 'bench', 3600, 0)
+    job_id = cg_job.launch_job_data(endpoint, token, 'bench', 'bench',
+                                    'bench', {'parameters' : {}}, {})
+    response = cg_job.get_job_status(endpoint, token, job_id)
+    workdir = tempfile.mkdtemp()
+
+    def size(paths) :
+        return sum(os.path.getsize(path) for path in paths)
+
+    try :
+        def per_file(i) :
+            with open(os.path.join(workdir, 'monitor_%d.json' %i), 'w') as f :
+                json.dump(response, f, indent=4, separators=(',', ': '))
+                f.write('\n')
+        start = time.time()
+        for i in xrange(args.calls) :
+            per_file(i)
+        report('one file per call (before)', args.calls, time.time() - start)
+        print '%-28s %8d files %8d bytes' %('', args.calls,
+                size(os.path.join(workdir, 'monitor_%d.json' %i)
+                    for i in xrange(args.calls)))
+
+        for name in ('monitor.jsonl', 'monitor.jsonl.gz') :
+            path = os.path.join(workdir, name)
+            start = time.time()
+            sink = cg_sink.open_sink(path)
+            for i in xrange(args.calls) :
+                sink.write(cg_sink.make_record('monitor', response, id=job_id))
+            sink.close()
+            report('sink %s' %name, args.calls, time.time() - start)
+            print '%-28s %8d files %8d bytes' %('', 1, size([path]))
+    finally :
+        shutil.rmtree(workdir)
+
+def bench_balance(endpoint, args) :
+    """Calls/sec of GET /job with --threads callers against one stub
+    replica and against 3 replicas of the same gateway, each serving 2
+    calls at a time, for every balancing strategy. The stubs run in this
+    process, so their latency must keep them below its own limit."""
+
+    primary = StubGateway(latency=max(args.latency, 0.05), capacity=2).start()
+    replicas = [primary] + [StubGateway(capacity=2, state=primary.state).start()
+                            for i in xrange(2)]
+    token = issue_token(primary.url, 'bench', 'bench', 3600, 0)
+    job_id = cg_job.launch_job_data(primary.url, token, 'bench', 'bench',
+                                    'bench', {'parameters' : {}}, {})
+    pool = ThreadPool(args.threads)
+
+    def run(label, url) :
+        cg_session.configure_endpoint(url, pool_size=args.threads)
+        start = time.time()
+        pool.map(lambda i : cg_job.get_job_status(url, token, job_id),
+                xrange(args.calls))
+        report(label, args.calls, time.time() - start)
+
+    try :
+        run('1 replica (before)', primary.url)
+        for strategy in cg_balance.STRATEGIES :
+            url = cg_balance.pool_endpoint([r.url for r in replicas],
+                                            strategy, health_interval=0)
+            run('3 replicas, %s' %strategy, url)
+    finally :
+        pool.close()
+        for replica in replicas :
+            replica.stop()
+
+def bench_bulk(endpoint, args) :
+    """Per-job cost of launching --calls jobs: launch_job reading each
+    config file one after the other (before), launch_batch with --threads
+    concurrent calls, then launch_jobs on a gateway without and with a
+    bulk launch endpoint"""
+
+    bulk_stub = StubGateway(latency=args.latency, bulk=True).start()
+    token = issue_token(endpoint, 'bench', 'bench', 3600, 0)
+    bulk_token = issue_token(bulk_stub.url, 'bench', 'bench', 3600, 0)
+    configs = [{'parameters' : {'param0' : str(i), 'param1' : '500'}}
+                for i in xrange(args.calls)]
+    workdir = tempfile.mkdtemp()
+
+    def run(label, func) :
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        print ("%-28s %8d jobs  %8.3f s %10.1f us/job"
+                %(label, args.calls, elapsed, elapsed * 1e6 / args.calls))
+
+    try :
+        paths = []
+        for i, config in enumerate(configs) :
+            paths.append(os.path.join(workdir, 'config%d.json' %i))
+            with open(paths[-1], 'w') as f :
+                json.dump(config, f)
+
+        run('launch_job (before)', lambda : [
+                cg_job.launch_job(endpoint, token, 'bench', 'bench', 'bench',
+                                path, {}) for path in paths])
+        run('launch_batch', lambda : list(cg_job.launch_batch(
+                endpoint, token, 'bench', 'bench', 'bench', configs, {},
+                args.threads)))
+        run('launch_jobs, no bulk', lambda : cg_job.launch_jobs(
+                endpoint, token, 'bench', 'bench', 'bench', configs, {},
+                workers=args.threads, bulk=False))
+        run('launch_jobs, bulk of %d' %cg_job.DEFAULT_BULK_SIZE,
+            lambda : cg_job.launch_jobs(bulk_stub.url, bulk_token, 'bench',
+                                        'bench', 'bench', configs, {},
+                                        workers=args.threads))
+    finally :
+        shutil.rmtree(workdir)
+        bulk_stub.stop()
+
+def bench_launcher(endpoint, args) :
+    """Preparation of --calls jobs of a sweep over a 200 parameter config:
+    in this process (before), then in a cg_launcher pool of 1, 2, 4, ...
+    processes up to the number of CPUs, with the speedup over one
+    process. Then the same jobs launched end to end with launch_batch and
+    with a Launcher of every CPU and --threads submitting threads."""
+
+    schema = large_config(200)['parameters']
+    base = {'parameters' : dict(('param%d' %i, str(50 + i))
+                                for i in xrange(200)),
+            'options' : {'output' : 'result.tar.gz'}}
+    sweep = cg_sweep.load_sweep({'parameters' : {
+                                    'param0' : {'range' : [50, 1000]},
+                                    'param1' : {'range' : [50, 1000]},
+                                    'param2' : {'min' : 50, 'max' : 1000}},
+                                'sampling' : 'lhs',
+                                'samples' : args.calls}, base)
+
+    start = time.time()
+    cg_launcher.prepare_serially(sweep, sweep.indexes(), schema, 'bench', {})
+    report('in process (before)', args.calls, time.time() - start)
+
+    processes = [1]
+    while processes[-1] * 2 <= multiprocessing.cpu_count() :
+        processes.append(processes[-1] * 2)
+    if processes[-1] != multiprocessing.cpu_count() :
+        processes.append(multiprocessing.cpu_count())
+    single = None
+    for count in processes :
+        launcher = cg_launcher.Launcher(endpoint, None, 'bench', 'bench',
+                                        'bench', {}, schema, count)
+        start = time.time()
+        for chunk in launcher.prepare(sweep) :
+            pass
+        elapsed = time.time() - start
+        single = single or elapsed
+        report('%d process%s' %(count, 's' if count > 1 else ''),
+                args.calls, elapsed)
+        print '%28s speedup %.2f, efficiency %.2f' %('', single / elapsed,
+                                                    single / elapsed / count)
+
+    token = issue_token(endpoint, 'bench', 'bench', 3600, 0)
+    start = time.time()
+    for index, job_id, error in cg_job.launch_batch(endpoint, token, 'bench',
+                                    'bench', 'bench', sweep.configs(), {},
+                                    args.threads) :
+        pass
+    report('launch_batch', args.calls, time.time() - start)
+    launcher = cg_launcher.Launcher(endpoint, token, 'bench', 'bench',
+                                    'bench', {}, schema, processes[-1],
+                                    args.threads)
+    start = time.time()
+    for index, job_id, error in launcher.launch(sweep) :
+        pass
+    report('Launcher, %d processes' %processes[-1], args.calls,
+            time.time() - start)
+
+def bench_metrics(endpoint, args) :
+    """cg_rest overhead of the cg_metrics instrumentation"""
+
+    url = endpoint.rstrip('/') + '/version'
+    cg_rest('GET', url)
+    workdir = tempfile.mkdtemp()
+    try :
+        report('cg_rest, no listeners', args.calls,
+                timed(lambda : cg_rest('GET', url), args.calls))
+        exporters = [cg_metrics.SummaryExporter(open(os.devnull, 'w')),
+                    cg_metrics.PrometheusExporter(os.path.join(workdir,
+                                                                'cg.prom')),
+                    cg_metrics.TraceExporter(os.path.join(workdir,
+                                                        'trace.jsonl'))]
+        for exporter in exporters :
+            cg_metrics.add_listener(exporter)
+        report('cg_rest, all exporters', args.calls,
+                timed(lambda : cg_rest('GET', url), args.calls))
+        cg_metrics.close()
+    finally :
+        shutil.rmtree(workdir)
+
+def bench_cli(endpoint, args) :
+    """Wall time of the test_script.cg flow run as one interpreter per
+    command (like test_script.sh) and as a single 'cg.py batch' process"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, 'test_script.cg')
+    with open(script) as f :
+        lines = [shlex.split(line, comments=True) for line in f]
+    lines = [argv for argv in lines if argv]
+
+    workdir = tempfile.mkdtemp()
+    for name in ('appinfo.json', 'appconfig.json', 'jobconfig.json') :
+        shutil.copy(os.path.join(here, name), workdir)
+    env = dict(os.environ, CG_API=endpoint, CG_USERNAME='bench',
+                CG_PASSWORD='bench',
+                CG_TOKEN_CACHE=os.path.join(workdir, 'token_cache'))
+    devnull = open(os.devnull, 'w')
+
+    def per_command() :
+        run_env = dict(env)
+        for argv in lines :
+            out = subprocess.check_output([sys.executable,
+                        os.path.join(here, 'cg_%s.py' %argv[0])] + argv[1:],
+                        cwd=workdir, env=run_env, stderr=devnull)
+            variable = cg.RESULT_VARIABLES.get((argv[0],
+                                    cg.find_action(argv[0], argv[1:])))
+            if variable :
+                run_env[variable] = out.strip()
+
+    def batch() :
+        subprocess.check_call([sys.executable, os.path.join(here, 'cg.py'),
+                        'batch', script], cwd=workdir, env=env,
+                        stdout=devnull, stderr=devnull)
+
+    try :
+        for label, func in (('one process per command', per_command),
+                            ('cg.py batch', batch)) :
+            elapsed = timed(func, args.runs)
+            print ("%-28s %8d runs  %8.3f s per run (%d commands)"
+                    %(label, args.runs, elapsed / args.runs, len(lines)))
+    finally :
+        shutil.rmtree(workdir)
+
+# Imports one cg_* module in a fresh interpreter, printing the time it took
+# (ms) and whether the requests package came with it.
+STARTUP_PROBE = """
+import os, sys, time
+sys.path.insert(0, os.path.dirname(sys.argv[1]))
+start = time.time()
+__import__(os.path.basename(sys.argv[1])[:-3])
+print '%.1f %s' %((time.time() - start) * 1000, 'requests' in sys.modules)
+"""
+
+def bench_startup(endpoint, args) :
+    """Wall time of '--help' of each cg_* CLI, a bare interpreter for
+    reference, and the import time of each module. Python 2 has no
+    '-X importtime', so imports are timed from a probe script."""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    devnull = open(os.devnull, 'w')
+
+    def run(argv) :
+        return lambda : subprocess.call([sys.executable] + argv,
+                                        stdout=devnull, stderr=devnull)
+
+    elapsed = timed(run(['-c', 'pass']), args.runs)
+    print ("%-28s %8d runs  %8.1f ms per run"
+            %('python (no cg module)', args.runs, elapsed / args.runs * 1000))
+    for name in ('cg', 'cg_token', 'cg_app', 'cg_job', 'cg_version',
+                'cg_workflow') :
+        path = os.path.join(here, name + '.py')
+        elapsed = timed(run([path, '--help']), args.runs)
+        probe = subprocess.check_output([sys.executable, '-c',
+                                        STARTUP_PROBE, path]).split()
+        print ("%-28s %8d runs  %8.1f ms per run  import %6s ms%s"
+                %(name + '.py --help', args.runs, elapsed / args.runs * 1000,
+                probe[0], '  (loads requests)' if probe[1] == 'True' else ''))
+
+def bench_retry(endpoint, args, stub=None) :
+    """Success rate of GET /version under injected 503s, without and with
+    retries, then the cost of calls while the gateway is down"""
+
+    if stub is None :
+        print 'The retry benchmark needs the local stub gateway'
+        return
+
+    url = endpoint.rstrip('/') + '/version'
+
+    def attempt() :
+        try :
+            cg_rest('GET', url)
+            return True
+        except Exception :
+            return False
+
+    # Keep circuits closed while comparing retries; streaks of failures
+    # would otherwise open them.
+    threshold = cg_retry.FAILURE_THRESHOLD
+    cg_retry.FAILURE_THRESHOLD = args.calls * 3
+    stub.state.error_rate = 0.3
+    for attempts in (1, 3) :
+        cg_retry.set_policy(cg_retry.RetryPolicy(max_attempts=attempts,
+                                                base_delay=0.01))
+        cg_retry.reset_breakers()
+        start = time.time()
+        succeeded = sum(attempt() for i in xrange(args.calls))
+        print ("%-28s %8d calls %8.3f s %9.1f%% succeeded"
+                %('%d attempt(s) per call' %attempts, args.calls,
+                time.time() - start, 100.0 * succeeded / args.calls))
+
+    cg_retry.FAILURE_THRESHOLD = threshold
+    stub.state.error_rate = 1.0
+    cg_retry.reset_breakers()
+    report('gateway down, breaker', args.calls,
+            timed(attempt, args.calls))
+    stub.state.error_rate = 0.0
+
+def percentile(samples, p) :
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+def measure(func, calls, threads) :
+    """Runs func(i) for i in range(calls) on threads threads.
+
+    Returns:
+        (tuple): per-call latencies (s) and total elapsed time (s)
+    """
+
+    def one(i) :
+        start = time.time()
+        func(i)
+        return time.time() - start
+
+    start = time.time()
+    if threads == 1 :
+        latencies = [one(i) for i in xrange(calls)]
+    else :
+        pool = ThreadPool(threads)
+        latencies = pool.map(one, xrange(calls))
+        pool.close()
+    return (latencies, time.time() - start)
+
+def api_functions(endpoint, workdir) :
+    """(name, func(i)) for every API function, against a fresh app/job"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    infofile = os.path.join(here, 'appinfo.json')
+    configfile = os.path.join(here, 'appconfig.json')
+    jobfile = os.path.join(here, 'jobconfig.json')
+    dest = os.path.join(workdir, 'out.json')
+
+    token = issue_token(endpoint, 'bench', 'bench', 3600, 0)
+    cg_app.register_app(endpoint, 'bench', 'BENCH', token, 0, infofile)
+    cg_app.config_app(endpoint, 'BENCH', token, configfile)
+    job_id = cg_job.launch_job(endpoint, token, 'bench', 'BENCH', 'bench',
+                                jobfile, {})
+    version_url = endpoint.rstrip('/') + '/version'
+
+    return [
+        ('version', lambda i : cg_rest('GET', version_url)),
+        ('issue_token', lambda i : issue_token(endpoint, 'bench', 'bench',
+                                                3600, 0)),
+        ('verify_token', lambda i : verify_token(endpoint, 'bench', token,
+                                                '', '')),
+        ('register_app', lambda i : cg_app.register_app(endpoint, 'bench',
+                                    'BENCH%d' %i, token, 0, infofile)),
+        ('get_app_info', lambda i : cg_app.get_app_info(endpoint, 'BENCH',
+                                                        token, dest)),
+        ('config_app', lambda i : cg_app.config_app(endpoint, 'BENCH',
+                                                    token, configfile)),
+        ('get_app_config', lambda i : cg_app.get_app_config(endpoint,
+                                                    'BENCH', token, dest)),
+        ('launch_job', lambda i : cg_job.launch_job(endpoint, token,
+                                'bench%d' %i, 'BENCH', 'bench', jobfile, {})),
+        ('monitor_job', lambda i : cg_job.get_job_status(endpoint, token,
+                                                        job_id)),
+        ('get_job_output', lambda i : cg_job.get_job_output(endpoint,
+                                                        token, job_id)),
+    ]
+
+def bench_suite(endpoint, args) :
+    """p50/p99 latency and throughput of every API function, single-threaded
+    and with --threads concurrent callers"""
+
+    cg_session.configure_endpoint(endpoint, pool_size=args.threads)
+    workdir = tempfile.mkdtemp()
+    try :
+        print ("%-16s %8s %10s %10s %12s"
+                %('function', 'threads', 'p50 (ms)', 'p99 (ms)', 'calls/sec'))
+        for name, func in api_functions(endpoint, workdir) :
+            for threads in sorted(set([1, args.threads])) :
+                latencies, elapsed = measure(func, args.calls, threads)
+                print ("%-16s %8d %10.2f %10.2f %12.1f"
+                        %(name, threads, percentile(latencies, 50) * 1000,
+                        percentile(latencies, 99) * 1000,
+                        args.calls / max(elapsed, 1e-9)))
+    finally :
+        shutil.rmtree(workdir)
+
+BENCHMARKS = {
+    'pool' : bench_pool,
+    'logging' : bench_logging,
+    'metrics' : bench_metrics,
+    'cli' : bench_cli,
+    'startup' : bench_startup,
+    'ledger' : bench_ledger,
+    'retry' : bench_retry,
+    'validate' : bench_validate,
+    'suite' : bench_suite,
+    'workflow' : bench_workflow,
+    'sweep' : bench_sweep,
+    'balance' : bench_balance,
+    'bulk' : bench_bulk,
+    'launcher' : bench_launcher,
+    'sink' : bench_sink,
+    'sync' : bench_sync,
+    'verify' : bench_verify,
+}
+
+def parse_args() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--debug",
+        action="store_true",
+        help='Allow debug info to be written to stderr')
+    parser.add_argument("-e", "--endpoint",
+        help="Gateway to benchmark, defaults to a local stub gateway")
+    parser.add_argument("-n", "--calls",
+        type=int,
+        default=1000,
+        help="Number of calls per measurement")
+    parser.add_argument("-r", "--runs",
+        type=int,
+        default=5,
+        help="Number of runs of a whole flow, for the 'cli', 'startup', "
+            "'sync' and 'workflow' benchmarks")
+    parser.add_argument("-t", "--threads",
+        type=int,
+        default=8,
+        help="Concurrent callers, for the 'balance', 'bulk', 'launcher', "
+            "'suite', 'sync' and 'verify' benchmarks")
+    parser.add_argument("--latency",
+        type=float,
+        default=0.0,
+        help="Seconds each call takes in the local stub gateway")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS),
+        help="Benchmark to run")
+
+    args = parser.parse_args()
+
+    logger_initialize(args.debug)
+
+    return args
+
+def main() :
+    args = parse_args()
+
+    stub = None
+    endpoint = args.endpoint
+    if not endpoint :
+        stub = StubGateway(latency=args.latency).start()
+        endpoint = stub.url
+
+    try :
+        if args.benchmark == 'retry' :
+            bench_retry(endpoint, args, stub)
+        else :
+            BENCHMARKS[args.benchmark](endpoint, args)
+    finally :
+        cg_session.close_session()
+        if stub :
+            stub.stop()
+
+if __name__ == '__main__' :
+    main()
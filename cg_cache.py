@@ -0,0 +1,160 @@
+"""
+LRU cache of GET responses for app information and configuration
+
+get_app_info and get_app_config answer from this cache while an entry is
+younger than its TTL. Once an entry is stale, it is revalidated with a
+conditional GET (If-None-Match / If-Modified-Since) when the gateway sent
+an ETag or Last-Modified header. A '304 Not Modified' then costs no body
+transfer or decoding. Entries are kept per token, so one user is never
+answered with what was fetched for another. The cache holds at most
+max_entries responses and max_bytes of response bodies, and evicts the
+least recently used first. register_app and config_app invalidate the
+entries of the app they change.
+
+Settings come from the bash environment:
+
+    CG_CACHE_TTL      seconds a response is used without revalidation,
+                      0 disables the cache (default 300)
+    CG_CACHE_ENTRIES  largest number of cached responses (default 256)
+    CG_CACHE_BYTES    largest total size of cached bodies (default 16 MB)
+
+Counters are available from app_cache.stats().
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from cg_token import cg_request, decode_response
+import cg_metrics
+
+logger = logging.getLogger(__name__)
+
+class CacheEntry(object) :
+
+    def __init__(self, response, size, etag, last_modified) :
+        self.response = response
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = time.time()
+
+class ResponseCache(object) :
+    """LRU cache of decoded GET responses with TTL and size limits.
+
+    Args:
+        ttl (float): seconds an entry is used without revalidation
+        max_entries (int): largest number of entries
+        max_bytes (int): largest total size of the cached response bodies
+    """
+
+    def __init__(self, ttl, max_entries, max_bytes) :
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.counters = {'hits' : 0, 'misses' : 0, 'revalidated' : 0,
+                        'evictions' : 0, 'invalidations' : 0}
+
+    def key(self, url, params) :
+        # Entries are scoped per token, as the gateway answers each user
+        # with what they may see. Only a digest of the token is kept.
+        token = params.get('token')
+        return (url.rstrip('/'), tuple(sorted((k, v) for k, v in
+                                    params.items() if k != 'token')),
+                hashlib.sha1(token).hexdigest() if token else None)
+
+    def _remove(self, key) :
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+
+    def _store(self, key, entry) :
+        if key in self.entries :
+            self._remove(key)
+        if entry.size > self.max_bytes :
+            return
+        self.entries[key] = entry
+        self.size += entry.size
+        while (len(self.entries) > self.max_entries or
+                self.size > self.max_bytes) :
+            self._remove(next(iter(self.entries)))
+            self.counters['evictions'] += 1
+
+    def get(self, url, **params) :
+        """Returns the decoded response of GET url, from the cache when
+        possible.
+
+        Raises:
+            Passes any exceptions raised in cg_rest.
+        """
+
+        if not self.ttl :
+            return decode_response('GET', url, cg_request('GET', url,
+                                    **params), params)
+
+        key = self.key(url, params)
+        with self.lock :
+            entry = self.entries.get(key)
+            if entry is not None :
+                self.entries[key] = self.entries.pop(key)
+                if time.time() - entry.stored < self.ttl :
+                    self.counters['hits'] += 1
+                    return entry.response
+
+        headers = {}
+        if entry is not None and entry.etag :
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified :
+            headers['If-Modified-Since'] = entry.last_modified
+
+        r = cg_request('GET', url, headers, **params)
+        with self.lock :
+            if r.status_code == 304 and entry is not None :
+                cg_metrics.end(getattr(r, 'cg_call', None))
+                self.counters['revalidated'] += 1
+                entry.stored = time.time()
+                self._store(key, entry)
+                return entry.response
+            self.counters['misses'] += 1
+
+        response = decode_response('GET', url, r, params)
+        with self.lock :
+            self._store(key, CacheEntry(response, len(r.content),
+                                        r.headers.get('ETag'),
+                                        r.headers.get('Last-Modified')))
+        return response
+
+    def invalidate(self, **params) :
+        """Drops every entry whose parameters include all of params,
+        e.g. invalidate(app='My_App')"""
+
+        wanted = set(params.items())
+        with self.lock :
+            for key in [k for k in self.entries if wanted <= set(k[1])] :
+                self._remove(key)
+                self.counters['invalidations'] += 1
+
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) :
+        """Returns the counters, the number of entries and their size"""
+
+        with self.lock :
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.size
+        lookups = stats['hits'] + stats['revalidated'] + stats['misses']
+        stats['hit_rate'] = ((stats['hits'] + stats['revalidated']) /
+                            float(lookups) if lookups else 0.0)
+        return stats
+
+app_cache = ResponseCache(float(os.getenv('CG_CACHE_TTL', 300)),
+                        int(os.getenv('CG_CACHE_ENTRIES', 256)),
+                        int(os.getenv('CG_CACHE_BYTES', 16 * 1024 * 1024)))
@@ -0,0 +1,168 @@
+"""
+Opt-in deduplication of job submissions
+
+A submission is identified by the hash of its normalized job config, app
+and computation (cg_ledger.config_hash). With dedup on, launching a job
+first looks the hash up in the job ledger (see cg_ledger): if a job of the
+same endpoint was already launched with it and has not failed, its Job ID
+is returned and nothing is submitted. A job only recorded as submitted,
+never seen in a status answer, is first checked with the gateway when the
+caller can (launch's refresh), and otherwise not reused unless the caller
+opts in (unconfirmed=True). Re-running a sweep after a partial
+failure then only resubmits the configs whose jobs failed or never ran:
+
+    ./cg_job.py launch-batch --dedup --jobname My_Sweep -bf configs.jsonl
+
+Identical submissions made by the threads of one process are collapsed
+too: one of them calls the gateway and the others reuse its Job ID.
+
+The ledger is committed once, at the first lookup; later lookups read it
+without committing the records buffered meanwhile, which are the jobs
+this process launched and are known without the ledger. Without a ledger
+(CG_LEDGER empty), only the submissions of this process are collapsed.
+"""
+
+import logging
+import threading
+import cg_ledger
+
+logger = logging.getLogger(__name__)
+
+# Jobs in these states are launched again rather than reused.
+FAILED_STATES = frozenset(['FAILED', 'ERROR', 'CANCELLED', 'CANCELED',
+                            'KILLED'])
+
+# Jobs in these states were never seen by a status poll: they may have
+# failed since.
+UNCONFIRMED_STATES = frozenset([None, '', 'SUBMITTED'])
+
+class InFlight(object) :
+    """Submission of one hash in progress, awaited by its duplicates"""
+
+    def __init__(self) :
+        self.done = threading.Event()
+        self.job_id = None
+        self.error = None
+
+class Deduplicator(object) :
+    """Reuses prior jobs and collapses concurrent duplicate submissions.
+
+    Args:
+        ledger (cg_ledger.Ledger, optional): store of prior jobs, defaults
+                                            to the ledger of CG_LEDGER
+    """
+
+    def __init__(self, ledger=None) :
+        self.ledger = ledger
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        # Job IDs of the submissions made through this deduplicator
+        self.launched = {}
+        self.flushed = False
+        self.counters = {'submitted' : 0, 'reused' : 0, 'collapsed' : 0}
+
+    def prior_job(self, endpoint, params_hash, refresh=None,
+                unconfirmed=False) :
+        """Returns the ledger record of the newest job launched with
+        params_hash that has not failed, or None.
+
+        Args:
+            refresh (function, optional): returns the current state of a
+                                        job from its Job ID, used for the
+                                        jobs in UNCONFIRMED_STATES
+            unconfirmed (bool, optional): without refresh, reuse the jobs
+                                        in UNCONFIRMED_STATES too
+        """
+
+        ledger = self.ledger or cg_ledger.get_ledger()
+        if ledger is None :
+            return None
+        with self.lock :
+            flush, self.flushed = not self.flushed, True
+        if flush :
+            ledger.flush()
+        for job in ledger.query(endpoint=endpoint, params_hash=params_hash,
+                                flush=False) :
+            if job['state'] in UNCONFIRMED_STATES and refresh is not None :
+                try :
+                    job['state'] = refresh(job['id'])
+                except Exception as e :
+                    logger.debug('Job %s not reused, its state is unknown: '
+                                '%s' %(job['id'], e))
+                    continue
+            if job['state'] in UNCONFIRMED_STATES and not unconfirmed :
+                continue
+            if job['state'] not in FAILED_STATES :
+                return job
+        return None
+
+    def launch(self, endpoint, params_hash, submit, refresh=None,
+                unconfirmed=False) :
+        """Returns the Job ID of a prior or in-flight job with the same
+        params_hash, or of a new one from submit().
+
+        Args:
+            endpoint (string, URL): the REST endpoint
+            params_hash (string): hash of the submission (see
+                                    cg_ledger.config_hash)
+            submit (function): launches the job and returns its Job ID
+            refresh, unconfirmed (optional): see prior_job
+
+        Raises:
+            Passes any exceptions raised in submit, also to the duplicates
+            waiting for it.
+        """
+
+        key = (endpoint, params_hash)
+        with self.lock :
+            if key in self.launched :
+                self.counters['collapsed'] += 1
+                return self.launched[key]
+            flight = self.in_flight.get(key)
+            owner = flight is None
+            if owner :
+                flight = self.in_flight[key] = InFlight()
+
+        if not owner :
+            flight.done.wait()
+            with self.lock :
+                self.counters['collapsed'] += 1
+            if flight.error is not None :
+                raise flight.error
+            logger.debug('Submission %s collapsed into job %s'
+                        %(params_hash, flight.job_id))
+            return flight.job_id
+
+        try :
+            job = self.prior_job(endpoint, params_hash, refresh,
+                                unconfirmed)
+            if job is not None :
+                flight.job_id = job['id']
+                with self.lock :
+                    self.counters['reused'] += 1
+                logger.debug('Reusing job %s (%s) for submission %s'
+                            %(job['id'], job['state'], params_hash))
+            else :
+                flight.job_id = submit()
+                with self.lock :
+                    self.launched[key] = flight.job_id
+                    self.counters['submitted'] += 1
+            return flight.job_id
+        except Exception as e :
+            flight.error = e
+            raise
+        finally :
+            with self.lock :
+                del self.in_flight[key]
+            flight.done.set()
+
+    def stats(self) :
+        with self.lock :
+            return dict(self.counters)
+
+_deduplicator = Deduplicator()
+
+def get_deduplicator() :
+    """Returns the Deduplicator shared by this process"""
+
+    return _deduplicator
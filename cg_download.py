@@ -0,0 +1,244 @@
+"""
+Streaming, resumable download of job output archives
+
+Archives are written to '<dest>.part' chunk by chunk, so memory use does
+not depend on the archive size. If a transfer is interrupted, the next
+attempt asks only for the missing bytes with an HTTP Range request and
+appends them. Once complete, the size (and checksum, when given) is checked
+before the file is renamed to its final name.
+
+Outputs of many jobs are fetched in parallel over the pooled session,
+with an optional global bandwidth cap shared by all transfers:
+
+    from cg_download import download_outputs
+
+    for job_id, path, error in download_outputs(endpoint, token, job_ids,
+                                        'outputs/', workers=4,
+                                        max_rate=50 * 1024 * 1024) :
+        ...
+"""
+
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+from requests import exceptions as rex
+import cg_session
+import cg_job
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+MAX_ATTEMPTS = 5
+
+class DownloadError(Exception) :
+    pass
+
+class BandwidthLimiter(object) :
+    """Caps the combined rate (bytes/second) of every transfer using it"""
+
+    def __init__(self, rate) :
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.next_free = time.time()
+
+    def consume(self, nbytes) :
+        """Blocks until nbytes may be transferred within the rate"""
+
+        with self.lock :
+            now = time.time()
+            start = max(self.next_free, now)
+            self.next_free = start + nbytes / self.rate
+        if start > now :
+            time.sleep(start - now)
+
+def parse_checksum(checksum) :
+    """Splits 'sha256:<hex>' (or md5/sha1) into (hash object, hex digest)"""
+
+    if not checksum :
+        return (None, None)
+    algorithm, _, digest = checksum.partition(':')
+    if not digest :
+        raise ValueError("Checksum must look like '<algorithm>:<hex digest>'")
+    return (hashlib.new(algorithm.lower()), digest.lower())
+
+def _hash_file(hasher, path) :
+    with open(path, 'rb') as f :
+        for chunk in iter(lambda : f.read(CHUNK_SIZE), '') :
+            hasher.update(chunk)
+
+def _content_range(response) :
+    """(first byte, full size) from a Content-Range header, each None when
+    missing or unknown, e.g. 'bytes */1024' gives (None, 1024)"""
+
+    match = re.match(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)',
+                    response.headers.get('Content-Range', ''))
+    if not match :
+        return (None, None)
+    first, size = match.groups()
+    return (int(first) if first is not None else None,
+            int(size) if size != '*' else None)
+
+def _remote_size(uri, response) :
+    """Full archive size of a 416 answer, asking with HEAD when the answer
+    does not give it"""
+
+    size = _content_range(response)[1]
+    if size is None :
+        r = cg_session.request('HEAD', uri, allow_redirects=True)
+        if r.ok and r.headers.get('Content-Length') is not None :
+            size = int(r.headers['Content-Length'])
+    return size
+
+def _total_size(response, offset) :
+    """Full archive size from Content-Range or Content-Length, or None"""
+
+    size = _content_range(response)[1]
+    if size is not None :
+        return size
+    length = response.headers.get('Content-Length')
+    if length is not None :
+        return int(length) + offset
+    return None
+
+def download(uri, dest_filename, checksum=None, limiter=None,
+            chunk_size=CHUNK_SIZE, max_attempts=MAX_ATTEMPTS) :
+    """Streams uri to dest_filename, resuming from '<dest>.part' if present.
+
+    Args:
+        uri (string, URL): HTTP URL of the archive
+        dest_filename (string, path): where to write the archive
+        checksum (string, optional): expected '<algorithm>:<hex digest>'
+        limiter (BandwidthLimiter, optional): shared bandwidth cap
+        chunk_size (int, optional): bytes read and written at a time
+        max_attempts (int, optional): transfers tried before giving up
+
+    Returns:
+        (int): size of the archive in bytes
+
+    Raises:
+        DownloadError when the size or checksum does not match, or the
+        transfer keeps failing.
+    """
+
+    part = dest_filename + '.part'
+    hasher, digest = parse_checksum(checksum)
+    total = None
+
+    for attempt in xrange(1, max_attempts + 1) :
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range' : 'bytes=%d-' %offset} if offset else {}
+        try :
+            r = cg_session.request('GET', uri, headers=headers, stream=True)
+            if r.status_code == 416 and offset :
+                r.close()
+                total = _remote_size(uri, r)
+                if total == offset :
+                    # The partial file already holds the whole archive.
+                    break
+                # Larger than the archive, or of another file: start over.
+                logger.warning('Discarding %s: %d bytes, archive has %s'
+                                %(part, offset, total))
+                os.remove(part)
+                continue
+            r.raise_for_status()
+            if r.status_code == 206 :
+                first = _content_range(r)[0]
+                if first != offset :
+                    r.close()
+                    logger.warning('Discarding %s: asked for byte %d, got '
+                                    'byte %s' %(part, offset, first))
+                    os.remove(part)
+                    continue
+            else :
+                offset = 0
+            total = _total_size(r, offset)
+            logger.debug('Downloading %s from byte %d of %s (attempt %d)'
+                        %(uri, offset, total, attempt))
+
+            with open(part, 'ab' if offset else 'wb') as f :
+                for chunk in r.iter_content(chunk_size) :
+                    if limiter :
+                        limiter.consume(len(chunk))
+                    f.write(chunk)
+            r.close()
+            break
+
+        except (rex.ConnectionError, rex.ChunkedEncodingError,
+                rex.Timeout, rex.HTTPError) as e :
+            if (isinstance(e, rex.HTTPError) and
+                    not 500 <= e.response.status_code < 600) :
+                raise
+            logger.debug('Transfer of %s interrupted: %s' %(uri, e))
+            if attempt == max_attempts :
+                raise DownloadError('Download of %s failed after %d '
+                                    'attempts: %s' %(uri, attempt, e))
+            time.sleep(min(2 ** attempt, 30))
+    else :
+        raise DownloadError('Download of %s failed after %d attempts'
+                            %(uri, max_attempts))
+
+    size = os.path.getsize(part)
+    if total is not None and size != total :
+        raise DownloadError('%s: got %d bytes, expected %d'
+                            %(uri, size, total))
+    if hasher :
+        _hash_file(hasher, part)
+        if hasher.hexdigest() != digest :
+            os.remove(part)
+            raise DownloadError('%s: checksum mismatch' %uri)
+
+    os.rename(part, dest_filename)
+    return size
+
+def output_filename(job_id, uri) :
+    """Local file name for a job's output archive"""
+
+    name = os.path.basename(urlparse.urlparse(uri).path)
+    if not name :
+        return '%s.out' %job_id
+    elif job_id in name :
+        return name
+    return '%s_%s' %(job_id, name)
+
+def download_outputs(endpoint, token, job_ids, dest_dir, workers=4,
+                    max_rate=None, checksums=None) :
+    """Fetches the output archives of many jobs in parallel.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        token (string): a valid token to allow user to manipulate jobs
+        job_ids (list of string): jobs whose output to download
+        dest_dir (string, path): directory to write the archives to
+        workers (int, optional): number of concurrent transfers
+        max_rate (float, optional): combined bytes/second of all transfers
+        checksums (dict, optional): expected checksum per job ID
+
+    Returns:
+        (generator): yields (job ID, path, exception) as each job finishes;
+            path is None and exception set when it failed
+    """
+
+    limiter = BandwidthLimiter(max_rate) if max_rate else None
+    checksums = checksums or {}
+
+    def fetch(job_id) :
+        try :
+            uri = cg_job.get_job_output(endpoint, token, job_id)
+            path = os.path.join(dest_dir, output_filename(job_id, uri))
+            download(uri, path, checksums.get(job_id), limiter)
+            return (job_id, path, None)
+        except Exception as e :
+            return (job_id, None, e)
+
+    cg_session.configure_endpoint(endpoint, pool_size=workers)
+    pool = ThreadPool(workers)
+    try :
+        for result in pool.imap_unordered(fetch, job_ids) :
+            yield result
+    finally :
+        pool.terminate()
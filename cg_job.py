@@ -3,10 +3,16 @@
 """
 Set of utilities to:
 	Launch a Job with a configuration file in JSON format
+	Launch a Batch of Jobs concurrently from many configurations
+	Validate Job configurations against the App's parameter schema
 	Monitor a Job and write the response JDON to a destination file
+	Watch many Jobs until they finish, reporting each state change
 	Get the Job Output of a Job and print the output archive HTTP URL
+	List and Query the Jobs recorded in the local job ledger
 
-All calls require a valid token either from CG_TOKEN or command line --token
+All calls require a valid token either from CG_TOKEN or command line --token.
+Without one, a cached token is used (see cg_token_cache), issued with
+CG_USERNAME and CG_PASSWORD when the cache holds no valid token.
 
 Launch Job:
 	# launch a job with name "My_Job" and store the ID to CG_JOB_ID env variables
@@ -14,31 +20,129 @@ Launch Job:
 	# or with command line --appname
 	export CG_JOB_ID=`./cg_job.py --jobname My_Job -cf <config file path>`
 
+Launch a Batch of Jobs:
+	# launch one job per line of a JSONL file (or per JSON file of a
+	# directory) with 8 concurrent submissions, printing each Job ID
+	# as soon as its submission completes
+	./cg_job.py launch-batch --jobname My_Sweep -bf configs.jsonl -w 8
+
+	# launch one job per combination of the parameter values in grid.json,
+	# e.g. {"param0" : ["100", "200"], "param1" : ["50", "500"]}
+	./cg_job.py launch-batch --jobname My_Sweep -cf jobconfig.json -g grid.json
+
+	# launch shard 0 of 4 of a sweep (ranges, lists, random or Latin
+	# hypercube sampling, see cg_sweep), streamed in constant memory
+	./cg_job.py launch-batch --jobname My_Sweep -cf jobconfig.json \
+		--sweep sweep.json --shard 0/4
+
+	# re-run a sweep after a partial failure: configs whose jobs did not
+	# fail are not submitted again, their earlier Job IDs are printed
+	./cg_job.py launch-batch --dedup --jobname My_Sweep -bf configs.jsonl
+
+	# submit 500 configs per call of the gateway's bulk launch endpoint
+	# (one call per config when the first bulk call finds none), printing
+	# the Job IDs in input order once every config is submitted
+	./cg_job.py launch-batch --bulk --bulksize 500 --jobname My_Sweep \
+		-bf configs.jsonl
+
+	# build, serialize and hash the configs of a large sweep in 8
+	# processes, submitting them from 16 threads (see cg_launcher)
+	./cg_job.py launch-batch --jobname My_Sweep -cf jobconfig.json \
+		--sweep sweep.json --processes 8 -w 16
+
+Validate Job Configs:
+	# check job configs against the parameter schema of the app (datatype,
+	# min/max, optional, fixed) without launching anything, printing every
+	# violation; add --validate to launch or launch-batch to check before
+	# submitting (with --processes, invalid configs are skipped and the
+	# others launched)
+	./cg_job.py validate -bf configs.jsonl
+	./cg_job.py launch-batch --validate --jobname My_Sweep -bf configs.jsonl
+
 Monitor a Job:
 	# monitor a job and specify destination file path for the monitor response
 	./cg_job.py monitor -df <dest file path>
 
+	# append the monitor responses of many jobs to one gzip compressed JSONL
+	# file per run (see cg_sink for the other sinks)
+	./cg_job.py monitor --jobidfile ids.txt --sink 'monitor-{run}.jsonl.gz'
+
+Watch Jobs:
+	# poll jobs until each one reaches a terminal state, printing every
+	# state change to stdout as a line of JSON
+	./cg_job.py launch-batch --jobname My_Sweep -bf configs.jsonl > ids.txt
+	./cg_job.py watch --jobidfile ids.txt
+
+List and Query Jobs:
+	# jobs launched, monitored or watched from this host are recorded in a
+	# local ledger (see cg_ledger); list them without calling the gateway
+	./cg_job.py list --where state=RUNNING --where app=My_App
+
+	# jobs launched in the last hour, one JSON object per line
+	./cg_job.py query --newer 3600
+
 Get Job Output:
 	# prints the job output to stdout
 	./cg_job.py output
+
+	# download the output archives of many jobs into outputs/, 4 at a time,
+	# resuming interrupted transfers and capping bandwidth at 50 MB/s
+	./cg_job.py output --download -jf ids.txt -dd outputs -w 4 --maxrate 5e7
 """
 
-from cg_token import CGException, cg_rest, logger_initialize
+from cg_token import (CGException, cg_rest, logger_initialize,
+                        resolve_endpoint)
+from cg_token_cache import cached_token
+import cg_validate
+import cg_ledger
+import cg_dedup
 import json
 import argparse
-import requests
+import itertools
+import time
+import threading
+import Queue
 import os, sys, logging
 
-# This is used sed to disable InsecureRequestWarning.
-requests.packages.urllib3.disable_warnings()
-
 logger = logging.getLogger(__name__)
 
-def parse_args() :
+DEFAULT_WORKERS = int(os.getenv('CG_WORKERS', 16))
+DEFAULT_BULK_SIZE = int(os.getenv('CG_BULK_SIZE', 100))
+
+# The Launch Job call takes the path of a job config file. In-memory
+# configs are written to CONFIG_DIR so that their path can be sent. With
+# CG_INLINE_CONFIG set, the config itself is also sent, in a 'config'
+# field, to gateways that accept it.
+INLINE_CONFIG = os.getenv('CG_INLINE_CONFIG', '').lower() in ('1', 'true',
+                                                            'yes')
+CONFIG_DIR = os.getenv('CG_CONFIG_DIR', '')
+
+# HTTP statuses of a gateway without the bulk launch endpoint. Nothing is
+# launched by a bulk call answered with one of them.
+NO_BULK_STATUSES = (404, 405, 501)
+
+class BulkLaunchError(CGException) :
+	"""Raised by launch_jobs when some submissions failed.
+
+	job_ids holds the Job ID of every config in input order, None for
+	those that failed; errors holds (index, exception) of each failure.
+	"""
+
+	def __init__(self, job_ids, errors) :
+		index, error = errors[0]
+		CGException.__init__(self, {
+			'error_code' : getattr(error, 'error_code', 0),
+			'message' : '%d of %d job submissions failed, first of config '
+						'%s: %s' %(len(errors), len(job_ids), index, error)})
+		self.job_ids = job_ids
+		self.errors = errors
+
+def parse_args(argv=None) :
     """Defines command line positional and optional arguments and checks
         for valid action input if present.
         
-    Args: none
+    Args:
+        argv (list, optional): arguments to parse instead of sys.argv
 
     Returns: A (tuple) containing the following:
         args (namespace) : used to overwrite env variables when necessary
@@ -79,26 +183,120 @@ def parse_args() :
     	help="For Job Launch specify how long (minutes) for job to run")
     parser.add_argument("-df","--destfile", 
         help="For Job Monitoring, destination file path to write response")
+    parser.add_argument("-bf","--batchfile",
+        help="For Batch Launch, JSONL file or directory of job configs")
+    parser.add_argument("-g","--grid",
+        help="For Batch Launch, JSON file mapping parameter names to lists "
+            "of values, expanded over the job config of --configfile")
+    parser.add_argument("--sweep",
+        help="For Batch Launch and Validate, JSON sweep file (see cg_sweep) "
+            "applied to the job config of --configfile, if given")
+    parser.add_argument("--shard",
+        default='0/1',
+        help="For --sweep, part 'i/N' of the sweep to use: indexes i, "
+            "i + N, i + 2N, ...")
+    parser.add_argument("-w","--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="For Batch Launch, Watch, Monitor --sink and Output "
+            "--download, number of concurrent calls")
+    parser.add_argument("-jf","--jobidfile",
+        help="For Watch, Monitor --sink and Output --download, file with "
+            "one Job ID per line, '-' for stdin")
+    parser.add_argument("--sink",
+        help="For Monitor and Watch, append the monitor responses (or "
+            "watch events) as JSON lines to a sink instead: a file, "
+            "'.gz' or '.zst' compressed, '{run}' in its name for one file "
+            "per run, or '-' for stdout (see cg_sink)")
+    parser.add_argument("--mininterval",
+        type=float,
+        default=2.0,
+        help="For Watch, shortest time (seconds) between polls of a job")
+    parser.add_argument("--maxinterval",
+        type=float,
+        default=60.0,
+        help="For Watch, longest time (seconds) between polls of a job")
+    parser.add_argument("--timeout",
+        type=float,
+        help="For Watch, stop watching after this many seconds")
+    parser.add_argument("--validate",
+        action="store_true",
+        help="For Launch and Batch Launch, check the job configs against "
+            "the app's parameter schema before submitting any; with "
+            "--processes, each config as it is prepared, launching only "
+            "the valid ones")
+    parser.add_argument("--download",
+        action="store_true",
+        help="For Output, download the output archives instead of "
+            "printing their URL")
+    parser.add_argument("-dd","--destdir",
+        default='.',
+        help="For Output --download, directory to write archives to")
+    parser.add_argument("--checksum",
+        help="For Output --download of one job, expected archive "
+            "checksum as '<algorithm>:<hex digest>', e.g. 'sha256:...'")
+    parser.add_argument("--maxrate",
+        type=float,
+        help="For Output --download, combined bandwidth cap in bytes/second")
+    parser.add_argument("--dedup",
+        action="store_true",
+        help="For Launch and Batch Launch, reuse the job of an identical "
+            "earlier submission recorded in the ledger, unless it failed")
+    parser.add_argument("--bulk",
+        action="store_true",
+        help="For Batch Launch, submit the configs in batches through the "
+            "gateway's bulk launch endpoint when it has one, and print "
+            "the Job IDs in input order once all are submitted")
+    parser.add_argument("--bulksize",
+        type=int,
+        default=DEFAULT_BULK_SIZE,
+        help="For Batch Launch --bulk, number of jobs per bulk call")
+    parser.add_argument("--processes",
+        type=int,
+        default=0,
+        help="For Batch Launch of a --sweep, prepare the job configs in "
+            "this many processes (see cg_launcher), 0 to prepare them in "
+            "the submitting process")
+    parser.add_argument("--where",
+        action="append",
+        default=[],
+        help="For List and Query, condition 'field=value' on the recorded "
+            "jobs, e.g. state=RUNNING or app=My_App; repeat to combine")
+    parser.add_argument("--newer",
+        type=float,
+        help="For List and Query, only jobs launched in the last NEWER "
+            "seconds")
+    parser.add_argument("--limit",
+        type=int,
+        help="For List and Query, largest number of jobs to show")
     parser.add_argument("action", nargs='?', type=str, default='launch',
-        help="launch/monitor/output")
+        help="launch/launch-batch/validate/monitor/watch/output/list/query")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     logger_initialize(args.debug)
 
-    if not args.endpoint :
+    if not args.endpoint and args.action.lower() not in ['list','query'] :
         logger.error('CG_API (API url for REST calls) '
                 	'not specified\n')
         sys.exit(1)
+    args.endpoint = resolve_endpoint(args.endpoint)
 
-    if args.action.lower() not in ['launch','monitor','output'] :
+    if (args.bulk or args.processes) and args.dedup :
+        logger.error('--bulk and --processes cannot be combined with '
+                    '--dedup')
+        sys.exit(1)
+
+    if args.action.lower() not in ['launch','launch-batch','validate',
+                                    'monitor','watch','output',
+                                    'list','query'] :
         logger.error('Invalid Action')
         sys.exit(1)
 
     return (args,args.action.lower())
 
 def launch_job(endpoint, token, jobname, appname,
-			owner, config_filename, computation) :
+			owner, config_filename, computation, dedup=False) :
 	""" Calls the Gateway Launch Job function and returns the Job ID
 
 	Args:
@@ -111,6 +309,8 @@ def launch_job(endpoint, token, jobname, appname,
 		computation (dict, optional): Dictionary possibly containing:
 			ncpu (int): number of CPUs to run the job owner
 			walltime (long): how long the job should run, in minutes
+		dedup (bool, optional): reuse a prior job of the same submission
+			instead of launching another one (see cg_dedup)
 
 	Returns:
 		(string): Launched Job's ID
@@ -128,6 +328,97 @@ def launch_job(endpoint, token, jobname, appname,
 		logger.error("Config File incorrectly formatted.")
 		sys.exit(1)
 
+	return launch_job_data(endpoint, token, jobname, appname, owner,
+						config, computation, config_filename, dedup)
+
+def launch_job_data(endpoint, token, jobname, appname,
+				owner, config, computation, config_filename=None,
+				dedup=False) :
+	"""Calls the Gateway Launch Job function with an in-memory job config
+	and returns the Job ID
+
+	Args:
+		config (dict): job config with 'parameters' and 'options'
+		config_filename (string, optional): path the config was read from
+
+		See launch_job for the other arguments.
+
+	Returns:
+		(string): Launched Job's ID
+
+	Raise:
+		Passes any exceptions raised in cg_rest.
+	"""
+
+	params_hash = cg_ledger.config_hash(config, appname, computation)
+
+	def submit() :
+		return submit_job(endpoint, token, jobname, appname, owner,
+						json.dumps(config), params_hash, computation,
+						config_filename)
+
+	def refresh(job_id) :
+		return job_state(get_job_status(endpoint, token, job_id))
+
+	if dedup :
+		return cg_dedup.get_deduplicator().launch(endpoint, params_hash,
+												submit, refresh)
+	return submit()
+
+def write_config(config_text, params_hash) :
+	"""Writes a job config to CONFIG_DIR (CG_CONFIG_DIR, by default a
+	'cg_configs' directory of the temporary directory), named after its
+	hash, and returns the file's path"""
+
+	import tempfile
+
+	directory = CONFIG_DIR or os.path.join(tempfile.gettempdir(),
+											'cg_configs')
+	if not os.path.isdir(directory) :
+		try :
+			os.makedirs(directory)
+		except OSError :
+			if not os.path.isdir(directory) :
+				raise
+	path = os.path.join(directory, params_hash + '.json')
+	if not os.path.exists(path) :
+		# Written aside and renamed, so concurrent writers of the same
+		# config never expose a partial file.
+		f = tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp',
+										delete=False)
+		with f :
+			f.write(config_text)
+		os.rename(f.name, path)
+	return path
+
+def submit_job(endpoint, token, jobname, appname, owner, config_text,
+			params_hash, computation, config_filename=None, inline=None) :
+	"""Calls the Gateway Launch Job function with a job config already
+	serialized and hashed (e.g. by cg_launcher) and returns the Job ID
+
+	Without config_filename, the config is written to a file first (see
+	write_config) and its path is sent, as launch_job does.
+
+	Args:
+		config_text (string): job config in JSON format
+		params_hash (string): cg_ledger.config_hash of the job config
+		inline (bool, optional): also send the config itself in a 'config'
+			field, defaults to INLINE_CONFIG (CG_INLINE_CONFIG)
+
+		See launch_job_data for the other arguments.
+
+	Returns:
+		(string): Launched Job's ID
+
+	Raise:
+		Passes any exceptions raised in cg_rest.
+	"""
+
+	if inline is None :
+		inline = INLINE_CONFIG
+	if not config_filename :
+		config_filename = write_config(config_text, params_hash)
+
 	data = {
 		'token' : token,
 		'name' : jobname,
@@ -136,13 +427,361 @@ def launch_job(endpoint, token, jobname, appname,
 		'config_filename' : config_filename,
 		'computation' : computation
 	}
+	if inline :
+		data['config'] = config_text
+
+	response = cg_rest('POST', endpoint.rstrip('/') + '/job', **data)
+	job_id = response['result']['id']
+	cg_ledger.record(job_id, endpoint=endpoint, app=appname, name=jobname,
+					owner=owner, params_hash=params_hash, state='SUBMITTED')
+	return job_id
+
+def read_batch_configs(path) :
+	"""Yields job configs from a JSONL file (one config per line)
+	or from every '.json' file of a directory, in name order"""
+
+	if os.path.isdir(path) :
+		for name in sorted(os.listdir(path)) :
+			if name.endswith('.json') :
+				with open(os.path.join(path, name)) as f :
+					yield json.load(f)
+	else :
+		with open(path) as f :
+			for line in f :
+				if line.strip() :
+					yield json.loads(line)
+
+def expand_grid(base_config, grid) :
+	"""Yields a copy of base_config for every combination of the
+	parameter values in grid, e.g. {"param0" : ["100", "200"],
+	"param1" : ["50", "500"]} gives four job configs."""
+
+	names = sorted(grid)
+	for values in itertools.product(*[grid[name] for name in names]) :
+		config = dict(base_config)
+		config['parameters'] = dict(base_config.get('parameters', {}))
+		config['parameters'].update(zip(names, values))
+		yield config
+
+def launch_batch(endpoint, token, jobname, appname, owner,
+				configs, computation, workers=DEFAULT_WORKERS, indexes=None,
+				dedup=False) :
+	"""Launches one job per config concurrently over the pooled session.
+
+	Configs are consumed lazily, with at most 2 * workers submissions
+	queued at a time. Job names are jobname followed by the config's index.
+
+	Args:
+		configs (iterable of dict): job configs to launch
+		workers (int, optional): number of concurrent submissions
+		indexes (iterable of int, optional): index of each config, used in
+			job names, defaults to 0, 1, 2, ...
+		dedup (bool, optional): see launch_job
+
+		See launch_job for the other arguments.
+
+	Returns:
+		(generator): yields (index, job ID, exception) as each submission
+			completes; job ID is None and exception set when it failed
+	"""
+
+	import cg_session
+	from multiprocessing.pool import ThreadPool
+
+	cg_session.configure_endpoint(endpoint, pool_size=workers)
+	pool = ThreadPool(workers)
+	window = threading.Semaphore(2 * workers)
+	done = Queue.Queue()
+	queued = [0]
+
+	def submit(index, config) :
+		try :
+			return (index, launch_job_data(endpoint, token,
+							'%s_%d' %(jobname, index), appname, owner,
+							config, computation, dedup=dedup), None)
+		except Exception as e :
+			return (index, None, e)
+
+	def feed() :
+		# The index is taken before its config, so a config that cannot be
+		# read (e.g. a bad JSONL line) is reported under its own index.
+		index = None
+		try :
+			remaining = iter(configs)
+			for index in (itertools.count() if indexes is None
+							else indexes) :
+				try :
+					config = next(remaining)
+				except StopIteration :
+					break
+				window.acquire()
+				queued[0] += 1
+				pool.apply_async(submit, (index, config),
+								callback=done.put)
+		except Exception as e :
+			queued[0] += 1
+			done.put((index, None, e))
+		done.put(None)
+
+	feeder = threading.Thread(target=feed)
+	feeder.daemon = True
+	feeder.start()
+
+	completed = 0
+	fed = False
+	try :
+		while not fed or completed < queued[0] :
+			result = done.get()
+			if result is None :
+				fed = True
+				continue
+			completed += 1
+			window.release()
+			yield result
+	finally :
+		pool.terminate()
+
+_bulk_endpoints = {}
+
+def has_bulk_launch(endpoint) :
+	"""Returns False once a bulk launch call (POST /jobs) on endpoint was
+	answered with one of NO_BULK_STATUSES, True until then. The endpoint
+	is never probed: launching jobs is not idempotent, and only real bulk
+	calls, made on request (launch-batch --bulk), find it missing."""
+
+	return _bulk_endpoints.get(endpoint, True)
+
+def launch_bulk(endpoint, token, appname, owner, jobs, computation) :
+	"""Calls the Gateway Bulk Launch Job function (POST /jobs) once for
+	many jobs and returns their Job IDs
+
+	Args:
+		jobs (list of tuple): (job name, job config dict) of each job
+
+		See launch_job for the other arguments.
+
+	Returns:
+		(list of string): Launched Jobs' IDs, in the order of jobs
+
+	Raise:
+		Passes any exceptions raised in cg_rest.
+	"""
+
+	return submit_jobs(endpoint, token, appname, owner,
+					[(name, json.dumps(config),
+					cg_ledger.config_hash(config, appname, computation))
+					for name, config in jobs], computation)
+
+def submit_jobs(endpoint, token, appname, owner, jobs, computation) :
+	"""Calls the Gateway Bulk Launch Job function like launch_bulk, with
+	job configs already serialized and hashed
+
+	Args:
+		jobs (list of tuple): (job name, job config in JSON format,
+			cg_ledger.config_hash of the job config) of each job
+
+		See launch_job for the other arguments.
+
+	Returns:
+		(list of string): Launched Jobs' IDs, in the order of jobs
+
+	Raise:
+		Passes any exceptions raised in cg_rest. When the gateway has no
+		bulk launch endpoint, has_bulk_launch(endpoint) is False
+		afterwards and no job was launched.
+	"""
+
+	# The configs are spliced in as they are, not decoded and encoded again.
+	data = {
+		'token' : token,
+		'app' : appname,
+		'owner' : owner,
+		'jobs' : '[%s]' %','.join('{"name":%s,"config":%s}'
+								%(json.dumps(name), config_text)
+								for name, config_text, params_hash in jobs),
+		'computation' : computation
+	}
+
+	from requests import exceptions as rex
+
+	try :
+		response = cg_rest('POST', endpoint.rstrip('/') + '/jobs', **data)
+	except rex.HTTPError as e :
+		if (e.response is not None and
+				e.response.status_code in NO_BULK_STATUSES) :
+			logger.debug('Bulk launch not available on %s' %endpoint)
+			_bulk_endpoints[endpoint] = False
+		raise
+	job_ids = response['result']['ids']
+	if len(job_ids) != len(jobs) :
+		raise CGException({'error_code' : 0,
+						'message' : 'Bulk launch returned %d Job IDs for '
+									'%d jobs' %(len(job_ids), len(jobs))})
+	for (name, config_text, params_hash), job_id in zip(jobs, job_ids) :
+		cg_ledger.record(job_id, endpoint=endpoint, app=appname, name=name,
+						owner=owner, params_hash=params_hash,
+						state='SUBMITTED')
+	return job_ids
+
+def launch_jobs(endpoint, token, jobname, appname, owner, configs,
+				computation, batch_size=DEFAULT_BULK_SIZE,
+				workers=DEFAULT_WORKERS, indexes=None, bulk=True) :
+	"""Launches one job per in-memory config and returns their Job IDs in
+	input order.
+
+	Configs are grouped in batches of batch_size, each launched with one
+	call of the gateway's bulk endpoint. When the gateway has none (see
+	has_bulk_launch), or without bulk, every config is its own call, and
+	calls are pipelined over workers connections instead: the batches
+	whose bulk call found no endpoint are launched that way too. Either
+	way, at most 2 * workers calls are queued at a time. Job names are
+	jobname followed by the config's index.
+
+	Args:
+		configs (iterable of dict): job configs to launch
+		batch_size (int, optional): jobs per bulk call
+		workers (int, optional): number of concurrent calls
+		indexes (iterable of int, optional): see launch_batch
+		bulk (bool, optional): use the bulk launch endpoint
+
+		See launch_job for the other arguments.
+
+	Returns:
+		(list of string): Launched Jobs' IDs, in the order of configs
+
+	Raise:
+		BulkLaunchError when some submissions failed, after every config
+		was tried.
+	"""
+
+	import cg_session
+	from multiprocessing.pool import ThreadPool
+
+	cg_session.configure_endpoint(endpoint, pool_size=workers)
+	if indexes is None :
+		indexes = itertools.count()
+
+	pool = ThreadPool(workers)
+	window = threading.Semaphore(2 * workers)
+	done = Queue.Queue()
+	queued = [0]
+
+	def bulk_launches() :
+		return bulk and has_bulk_launch(endpoint)
+
+	def submit(batch) :
+		if bulk_launches() :
+			try :
+				job_ids = launch_bulk(endpoint, token, appname, owner,
+							[('%s_%d' %(jobname, index), config)
+							for position, index, config in batch],
+							computation)
+				return [(position, index, job_id, None) for
+						(position, index, config), job_id
+						in zip(batch, job_ids)]
+			except Exception as e :
+				if bulk_launches() :
+					return [(position, index, None, e)
+							for position, index, config in batch]
+				# No bulk launch endpoint: nothing of the batch was
+				# launched, its configs are launched one by one.
+		results = []
+		for position, index, config in batch :
+			try :
+				results.append((position, index, launch_job_data(endpoint,
+							token, '%s_%d' %(jobname, index), appname,
+							owner, config, computation), None))
+			except Exception as e :
+				results.append((position, index, None, e))
+		return results
+
+	def feed() :
+		items = ((position, index, config) for position, (index, config)
+				in enumerate(itertools.izip(indexes, configs)))
+		def dispatch(batch) :
+			window.acquire()
+			queued[0] += 1
+			pool.apply_async(submit, (batch,), callback=done.put)
+
+		batch = []
+		try :
+			for item in items :
+				batch.append(item)
+				if len(batch) >= (batch_size if bulk_launches() else 1) :
+					dispatch(batch)
+					batch = []
+		except Exception as e :
+			queued[0] += 1
+			done.put([(None, None, None, e)])
+		# The configs read before the end, or an error, are launched too.
+		if batch :
+			dispatch(batch)
+		done.put(None)
+
+	feeder = threading.Thread(target=feed)
+	feeder.daemon = True
+	feeder.start()
+
+	results = {}
+	errors = []
+	completed = 0
+	fed = False
+	try :
+		while not fed or completed < queued[0] :
+			batch = done.get()
+			if batch is None :
+				fed = True
+				continue
+			completed += 1
+			window.release()
+			for position, index, job_id, error in batch :
+				if error is not None :
+					errors.append((index, error))
+				if position is not None :
+					results[position] = job_id
+	finally :
+		pool.terminate()
+
+	job_ids = [results[position] for position in xrange(len(results))]
+	if errors :
+		# Feeder errors have no index: they come first.
+		raise BulkLaunchError(job_ids, sorted(errors, key=lambda error :
+									(error[0] is not None, error[0])))
+	return job_ids
+
+def job_state(response) :
+	"""Returns the job state found in a /job monitor response"""
+
+	result = response.get('result', {})
+	return str(result.get('status', result.get('state', ''))).upper()
+
+def get_job_status(endpoint, token, job_id) :
+	"""Calls the Gateway Monitor Job function and returns the response
+
+	Args:
+		endpoint (string, URL): the REST endpoint
+		token (string): a valid token to allow user to manipulate jobs
+		job_id (string): a valid Job ID to monitor
+
+	Returns:
+		(dict): the decoded job monitor response
+
+	Raises:
+		Passes any exceptions raised in cg_rest
+	"""
+
+	params = {
+		'token' : token,
+		'id' : job_id
+	}
 
 	url = endpoint.rstrip('/') + '/job'
 
-	response = cg_rest('POST', url, **data)
+	response = cg_rest('GET', url, **params)
+	cg_ledger.record(job_id, state=job_state(response) or None)
+
+	return response
 
-	return response['result']['id']
-	
 def monitor_job(endpoint, token, job_id, dest_filename) :
 	"""Calls the Gateway Monitor Job function and writes
 	the response to the destination file
@@ -163,14 +802,7 @@ def monitor_job(endpoint, token, job_id, dest_filename) :
 	logger.debug('Monitoring job id "%s" and writing'
 				' response to "' + dest_filename + '"')
 
-	params = {
-		'token' : token,
-		'id' : job_id
-	}
-
-	url = endpoint.rstrip('/') + '/job'
-
-	response = cg_rest('GET', url, **params)
+	response = get_job_status(endpoint, token, job_id)
 
 	# Dump the response JSON (the job monitor response) into destination file.
 	with open(dest_filename, 'w') as outfile :
@@ -181,6 +813,43 @@ def monitor_job(endpoint, token, job_id, dest_filename) :
 	logger.debug('Monitor of Job ID "%s" successfully '
 				'written to "%s"' %(job_id,dest_filename))
 
+def monitor_jobs(endpoint, token, job_ids, sink, workers=DEFAULT_WORKERS) :
+	"""Calls the Gateway Monitor Job function for many jobs concurrently
+	over the pooled session, appending each response to a sink
+
+	Args:
+		endpoint (string, URL): the REST endpoint
+		token (string): a valid token to allow user to manipulate jobs
+		job_ids (list of string): valid Job IDs to monitor
+		sink (cg_sink.Sink): where the responses are written
+		workers (int, optional): number of concurrent calls
+
+	Returns:
+		(list): (job ID, exception) of every job that failed to be monitored
+	"""
+
+	import cg_session
+	import cg_sink
+	from multiprocessing.pool import ThreadPool
+
+	cg_session.configure_endpoint(endpoint, pool_size=workers)
+	pool = ThreadPool(workers)
+
+	def monitor(job_id) :
+		try :
+			response = get_job_status(endpoint, token, job_id)
+		except Exception as e :
+			return (job_id, e)
+		sink.write(cg_sink.make_record('monitor', response, id=job_id))
+		return (job_id, None)
+
+	try :
+		return [(job_id, error) for job_id, error
+				in pool.imap_unordered(monitor, job_ids) if error is not None]
+	finally :
+		pool.close()
+		pool.join()
+
 def get_job_output(endpoint, token, job_id) :
 	"""Calls the Gateway Monitor Job function and writes
 	the response to the destination file
@@ -206,19 +875,280 @@ def get_job_output(endpoint, token, job_id) :
 	url = endpoint.rstrip('/') + '/joboutput'
 
 	response = cg_rest('GET', url, **params)
+	cg_ledger.record(job_id, output_uri=response['result']['uri'])
 
 	return response['result']['uri']
 
-def main() :
-	(args,action) = parse_args()
+def read_sweep(args) :
+	"""Returns (sweep, shard, shards) of --sweep over --configfile, if
+	given, and --shard"""
+
+	import cg_sweep
+
+	base_config = None
+	if args.configfile and os.path.exists(args.configfile) :
+		with open(args.configfile) as f :
+			base_config = json.load(f)
+	try :
+		sweep = cg_sweep.read_sweep(args.sweep, base_config)
+		shard, shards = cg_sweep.parse_shard(args.shard)
+	except cg_sweep.SweepError as e :
+		logger.error(e)
+		sys.exit(1)
+	return (sweep, shard, shards)
+
+def read_configs(args, single=False) :
+	"""Returns (indexes, configs) of the job configs given with --sweep,
+	--batchfile, or --grid over --configfile. With single, --configfile
+	alone gives one config. indexes is None unless a sweep is sharded.
+
+	A sweep is returned as a generator function, so it can be streamed
+	more than once (e.g. to validate, then launch) without being stored."""
+
+	if args.sweep and os.path.exists(args.sweep) :
+		sweep, shard, shards = read_sweep(args)
+		return (sweep.indexes(shard, shards),
+				lambda : sweep.configs(shard, shards))
+	elif args.batchfile and os.path.exists(args.batchfile) :
+		return (None, read_batch_configs(args.batchfile))
+	elif (args.grid and os.path.exists(args.grid) and
+			args.configfile and os.path.exists(args.configfile)) :
+		with open(args.configfile) as f :
+			base_config = json.load(f)
+		with open(args.grid) as f :
+			grid = json.load(f)
+		return (None, expand_grid(base_config, grid))
+	elif single and args.configfile and os.path.exists(args.configfile) :
+		with open(args.configfile) as f :
+			return (None, [json.load(f)])
+	else :
+		logger.error('No valid sweep or batch file, or grid and job '
+					'configuration files given')
+		sys.exit(1)
+
+def validate_configs(args, configs, indexes=None) :
+	"""Checks configs against the parameter schema of args.appname,
+	logging every violation. Returns False if any config is invalid."""
+
+	validator = cg_validate.fetch_validator(args.endpoint, args.appname,
+											args.token)
+	violations = validator.validate_batch(configs, indexes)
+	for violation in violations :
+		logger.error(violation)
+
+	return not violations
+
+def batch_launch(args, computation) :
+	"""Runs the 'launch-batch' action, printing one Job ID per line as
+	each submission completes. Returns False if any submission failed,
+	or if --validate found invalid configs (then nothing is launched)."""
+
+	if args.processes :
+		return process_launch(args, computation)
+
+	indexes, configs = read_configs(args)
+	if callable(configs) :
+		if args.validate and not validate_configs(args, configs(), indexes) :
+			return False
+		configs = configs()
+	elif args.validate :
+		configs = list(configs)
+		if not validate_configs(args, configs) :
+			return False
+
+	if args.bulk :
+		return bulk_launch(args, computation, configs, indexes)
+
+	ok = True
+	for index, job_id, error in launch_batch(args.endpoint, args.token,
+								args.jobname, args.appname, args.username,
+								configs, computation, args.workers, indexes,
+								args.dedup) :
+		if error is not None :
+			logger.error('Job config %d: %s' %(index, error))
+			ok = False
+		else :
+			print job_id
+			sys.stdout.flush()
+
+	if args.dedup :
+		stats = cg_dedup.get_deduplicator().stats()
+		sys.stderr.write('%(submitted)d jobs submitted, %(reused)d prior '
+						'jobs reused, %(collapsed)d duplicates collapsed\n'
+						%stats)
+
+	return ok
+
+def process_launch(args, computation) :
+	"""Runs 'launch-batch --processes' on a sweep, printing one Job ID per
+	line as each submission completes. With --validate, each config is
+	checked by the process that prepares it, and the invalid ones are
+	reported and not launched. Returns False if any submission failed or
+	any config was invalid."""
+
+	import cg_launcher
+	from cg_app import fetch_app_config
+
+	if not (args.sweep and os.path.exists(args.sweep)) :
+		logger.error('--processes needs a valid sweep file')
+		sys.exit(1)
+	sweep, shard, shards = read_sweep(args)
+
+	launcher = cg_launcher.Launcher(args.endpoint, args.token, args.jobname,
+							args.appname, args.username, computation,
+							processes=args.processes, workers=args.workers,
+							bulk=args.bulk)
+	if args.bulk :
+		launcher.chunk_size = args.bulksize
+
+	if args.validate :
+		launcher.parameters = fetch_app_config(args.endpoint, args.appname,
+							args.token)['result'].get('parameters', {})
+
+	ok = True
+	for index, job_id, error in launcher.launch(sweep,
+										sweep.indexes(shard, shards)) :
+		if error is not None :
+			logger.error('Job config %s: %s' %(index, error))
+			ok = False
+		else :
+			print job_id
+			sys.stdout.flush()
+
+	return ok
+
+def bulk_launch(args, computation, configs, indexes) :
+	"""Runs 'launch-batch --bulk', printing the Job IDs in input order.
+	Returns False if any submission failed."""
+
+	try :
+		job_ids = launch_jobs(args.endpoint, args.token, args.jobname,
+							args.appname, args.username, configs,
+							computation, args.bulksize, args.workers,
+							indexes)
+		errors = []
+	except BulkLaunchError as e :
+		job_ids, errors = e.job_ids, e.errors
+
+	for index, error in errors :
+		logger.error('Job config %s: %s' %(index, error))
+	for job_id in job_ids :
+		if job_id is not None :
+			print job_id
+
+	return not errors
+
+def read_job_ids(args) :
+	"""Returns the Job IDs given with --jobid and --jobidfile
+	('-' reads them from stdin, one per line)"""
+
+	job_ids = []
+	if args.jobid :
+		job_ids.append(args.jobid)
+	if args.jobidfile == '-' :
+		job_ids.extend(line.strip() for line in sys.stdin)
+	elif args.jobidfile :
+		with open(args.jobidfile) as f :
+			job_ids.extend(line.strip() for line in f)
+
+	return [job_id for job_id in job_ids if job_id]
+
+def download_outputs(args, job_ids) :
+	"""Runs 'output --download', printing the path of each archive as its
+	download completes. Returns False if any download failed."""
+
+	import cg_download
+
+	checksums = {}
+	if args.checksum and len(job_ids) == 1 :
+		checksums[job_ids[0]] = args.checksum
+
+	if not os.path.isdir(args.destdir) :
+		os.makedirs(args.destdir)
+
+	ok = True
+	for job_id, path, error in cg_download.download_outputs(args.endpoint,
+								args.token, job_ids, args.destdir,
+								args.workers, args.maxrate, checksums) :
+		if error is not None :
+			logger.error('Job ID "%s": %s' %(job_id, error))
+			ok = False
+		else :
+			print path
+			sys.stdout.flush()
+
+	return ok
+
+def query_ledger(args, action) :
+	"""Runs the 'list' (table) and 'query' (JSON lines) actions on the
+	jobs recorded in the ledger. Returns False on an invalid condition."""
+
+	ledger = cg_ledger.get_ledger()
+	if ledger is None :
+		logger.error('The job ledger is disabled (CG_LEDGER is empty)')
+		return False
+
+	where = {}
+	for condition in args.where :
+		name, sep, value = condition.partition('=')
+		if not sep :
+			logger.error("Condition must be 'field=value', not '%s'"
+						%condition)
+			return False
+		where[name.strip()] = value.strip()
+
+	try :
+		jobs = ledger.query(newer=args.newer, limit=args.limit, **where)
+	except ValueError as e :
+		logger.error('%s (fields: %s)' %(e, ', '.join(cg_ledger.FIELDS)))
+		return False
+
+	if action == 'query' :
+		for job in jobs :
+			print json.dumps(job, sort_keys=True)
+		return True
+
+	print '%-32s  %-12s  %-16s  %-19s  %s' %('ID', 'STATE', 'APP',
+											'LAUNCHED', 'NAME')
+	for job in jobs :
+		print '%-32s  %-12s  %-16s  %-19s  %s' %(job['id'], job['state'],
+					job['app'], time.strftime('%Y-%m-%d %H:%M:%S',
+					time.localtime(job['created'])), job['name'])
+	return True
+
+def open_sink(spec) :
+	"""Returns the shared sink of --sink, exiting when it cannot be opened"""
+
+	import cg_sink
+
+	try :
+		return cg_sink.get_sink(spec)
+	except cg_sink.SinkError as e :
+		logger.error(e)
+		sys.exit(1)
+
+def main(argv=None) :
+	(args,action) = parse_args(argv)
+
+	if action in ('list', 'query') :
+		if not query_ledger(args, action) :
+			sys.exit(1)
+		return
+
+	if not args.token :
+		try :
+			args.token = cached_token(args.endpoint, args.username)
+		except CGException as e :
+			logger.error(e)
+			sys.exit(1)
 
 	if not args.token :
 		logger.error('No valid CG_TOKEN given')
 		sys.exit(1)
 
 	try :
-		if (action == 'launch') :
-			if not (args.jobname) :
+		if action in ('launch', 'launch-batch', 'validate') :
+			if action != 'validate' and not (args.jobname) :
 				logger.error('No valid Job Name provided')
 				sys.exit(1)
 			elif not (args.appname) :
@@ -233,13 +1163,71 @@ def main() :
 			if(args.walltime != 0) :
 				computation['walltime'] = args.walltime
 
-			if args.configfile and os.path.exists(args.configfile) :
-				print launch_job(args.endpoint, args.token, args.jobname,
+			if action == 'validate' :
+				indexes, configs = read_configs(args, single=True)
+				if callable(configs) :
+					configs = configs()
+				if not validate_configs(args, configs, indexes) :
+					sys.exit(1)
+
+			elif action == 'launch-batch' :
+				if not batch_launch(args, computation) :
+					sys.exit(1)
+
+			elif args.configfile and os.path.exists(args.configfile) :
+				if args.validate and not validate_configs(args,
+									read_configs(args, single=True)[1]) :
+					sys.exit(1)
+				job_id = launch_job(args.endpoint, args.token, args.jobname,
 						args.appname, args.username, args.configfile,
-						computation)
+						computation, args.dedup)
+				print job_id
+				return job_id
 			else :
 				print ('No valid job configuration file given')
 
+		elif (action == 'watch') :
+			job_ids = read_job_ids(args)
+			if not job_ids :
+				logger.error('No CG_JOB_ID, --jobid or --jobidfile given')
+				sys.exit(1)
+
+			import cg_watch
+
+			emit = cg_watch.write_event
+			if args.sink :
+				emit = open_sink(args.sink).write
+			watcher = cg_watch.JobWatcher(args.endpoint, args.token,
+										min_interval=args.mininterval,
+										max_interval=args.maxinterval,
+										workers=args.workers, emit=emit)
+			for job_id in job_ids :
+				watcher.add(job_id)
+			states = watcher.run(args.timeout)
+			if watcher.active() :
+				logger.error('%d jobs still active after %s seconds'
+							%(watcher.active(), args.timeout))
+				sys.exit(1)
+			unknown = [job_id for job_id, state in states.items()
+						if state == cg_watch.UNKNOWN_STATE]
+			if unknown :
+				logger.error('%d jobs could not be watched: %s'
+							%(len(unknown), ', '.join(sorted(unknown))))
+				sys.exit(1)
+
+		elif (action == 'monitor' and args.sink) :
+			job_ids = read_job_ids(args)
+			if not job_ids :
+				logger.error('No CG_JOB_ID, --jobid or --jobidfile given')
+				sys.exit(1)
+			sink = open_sink(args.sink)
+			failed = monitor_jobs(args.endpoint, args.token, job_ids, sink,
+								args.workers)
+			for job_id, error in failed :
+				logger.error('Job ID "%s": %s' %(job_id, error))
+			if failed :
+				sys.exit(1)
+
 		elif (action == 'monitor') :
 			if not (args.jobid) :
 				logger.error('No CG_JOB_ID found or '
@@ -259,6 +1247,14 @@ def main() :
 							'for job monitor output')
 				sys.exit(1)
 
+		elif args.download :
+			job_ids = read_job_ids(args)
+			if not job_ids :
+				logger.error('No CG_JOB_ID, --jobid or --jobidfile given')
+				sys.exit(1)
+			if not download_outputs(args, job_ids) :
+				sys.exit(1)
+
 		else :
 			if not (args.jobid) :
 				logger.error('No CG_JOB_ID found or '
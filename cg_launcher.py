@@ -0,0 +1,325 @@
+"""
+Multi-process preparation of sweep jobs before submission
+
+Before a sweep is launched, every job config is built from its sweep
+index, checked against the app's parameter schema, serialized to JSON and
+hashed for the job ledger. In one Python process that work is CPU bound
+and holds the GIL, so the submitting threads wait for it. A Launcher
+spreads it over a pool of processes, while the submissions stay on
+threads of the launching process:
+
+    sweep index chunks -> N processes: config, validate, JSON, hash
+                       -> bounded queue -> I/O threads: POST /job (or
+                          POST /jobs per chunk, see cg_job.launch_jobs)
+
+Chunks are only handed to the processes while the queue has room, so at
+most queue_size chunks are prepared ahead of the submissions and memory
+stays flat however large the sweep is. Each process builds configs from
+its own copy of the Sweep, so only sweep indexes and the prepared JSON
+cross the process boundary:
+
+    ./cg_job.py launch-batch --jobname My_Sweep -cf jobconfig.json \\
+        --sweep sweep.json --processes 8 -w 16
+
+Or in Python:
+
+    import cg_launcher
+    launcher = cg_launcher.Launcher(endpoint, token, 'My_Sweep', appname,
+                                    owner, {}, parameters=schema)
+    for index, job_id, error in launcher.launch(sweep) :
+        ...
+
+Settings come from the bash environment:
+
+    CG_PROCESSES    preparing processes (default: the number of CPUs)
+    CG_CHUNK_SIZE   sweep points per chunk (default 100)
+"""
+
+import os
+import json
+import Queue
+import logging
+import itertools
+import threading
+import multiprocessing
+import cg_ledger
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROCESSES = int(os.getenv('CG_PROCESSES', 0) or
+                        multiprocessing.cpu_count())
+DEFAULT_CHUNK_SIZE = int(os.getenv('CG_CHUNK_SIZE', 100))
+DEFAULT_WORKERS = int(os.getenv('CG_WORKERS', 16))
+
+class InvalidConfigError(ValueError) :
+    """Reported for a sweep point whose job config breaks the app's
+    parameter schema; it is not submitted.
+
+    Attributes:
+        violations (list of cg_validate.Violation): what is wrong
+    """
+
+    def __init__(self, violations) :
+        ValueError.__init__(self, '; '.join(
+                    v.message if v.parameter is None else
+                    "parameter '%s' %s" %(v.parameter, v.message)
+                    for v in violations))
+        self.violations = violations
+
+# State of a preparing process, set once by _initialize so that each task
+# only carries sweep indexes.
+_worker = {}
+
+def _initialize(sweep, parameters, appname, computation) :
+    import cg_validate
+
+    _worker['sweep'] = sweep
+    _worker['validator'] = (cg_validate.ConfigValidator(parameters)
+                            if parameters is not None else None)
+    _worker['appname'] = appname
+    _worker['computation'] = computation
+
+def _prepare(indexes) :
+    """Returns (index, config JSON, config hash, violations) of every
+    sweep index of a chunk, violations being a list of
+    cg_validate.Violation; runs in a preparing process"""
+
+    sweep = _worker['sweep']
+    validator = _worker['validator']
+    appname = _worker['appname']
+    computation = _worker['computation']
+    prepared = []
+    for index in indexes :
+        config = sweep.config(index)
+        violations = (validator.check(config, index)
+                        if validator is not None else [])
+        prepared.append((index, json.dumps(config, separators=(',', ':')),
+                        cg_ledger.config_hash(config, appname, computation),
+                        violations))
+    return prepared
+
+def prepare_serially(sweep, indexes, parameters, appname, computation) :
+    """Returns what _prepare gives for indexes, in this process; the
+    one-process baseline of the benchmark"""
+
+    _initialize(sweep, parameters, appname, computation)
+    return _prepare(indexes)
+
+class Launcher(object) :
+    """Launches the jobs of sweeps, preparing configs in a process pool and
+    submitting them from threads.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        token (string): a valid token to allow user to manipulate jobs
+        jobname (string): job names are jobname followed by the index
+        appname (string): name of the app to launch the jobs with
+        owner (string): owner of the application
+        computation (dict): see cg_job.launch_job
+        parameters (dict, optional): the 'parameters' of the app
+                                    configuration; configs breaking them
+                                    are reported and not submitted
+        processes (int, optional): number of preparing processes
+        workers (int, optional): number of submitting threads
+        chunk_size (int, optional): sweep points per task of a process
+                                    (and per call of a bulk launch)
+        queue_size (int, optional): chunks prepared ahead of submission,
+                                    defaults to 2 * (processes + workers)
+        bulk (bool, optional): submit each chunk with one bulk launch
+                                call, or one call per job when the
+                                gateway has no bulk launch endpoint (see
+                                cg_job.has_bulk_launch)
+    """
+
+    def __init__(self, endpoint, token, jobname, appname, owner,
+                computation, parameters=None, processes=DEFAULT_PROCESSES,
+                workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                queue_size=None, bulk=False) :
+        self.endpoint = endpoint
+        self.token = token
+        self.jobname = jobname
+        self.appname = appname
+        self.owner = owner
+        self.computation = computation
+        self.parameters = parameters
+        self.processes = max(processes, 1)
+        self.workers = max(workers, 1)
+        self.chunk_size = max(chunk_size, 1)
+        self.queue_size = queue_size or 2 * (self.processes + self.workers)
+        self.bulk = bulk
+
+    def _chunks(self, indexes) :
+        indexes = iter(indexes)
+        while True :
+            chunk = list(itertools.islice(indexes, self.chunk_size))
+            if not chunk :
+                return
+            yield chunk
+
+    def prepare(self, sweep, indexes=None) :
+        """Yields the prepared chunks of sweep points as they are ready,
+        each a list of (index, config JSON, config hash, violations), see
+        _prepare. Violations are an exception when preparing failed.
+
+        A chunk is handed to a process only while fewer than queue_size
+        chunks are prepared or being prepared and not yet taken from
+        this generator.
+
+        Args:
+            sweep (cg_sweep.Sweep): the sweep
+            indexes (iterable of int, optional): points to prepare,
+                                                defaults to all of them
+        """
+
+        if indexes is None :
+            indexes = sweep.indexes()
+        pool = multiprocessing.Pool(self.processes, _initialize,
+                                    (sweep, self.parameters, self.appname,
+                                    self.computation))
+        # Holds at most queue_size chunks, as that many slots are taken.
+        slots = threading.Semaphore(self.queue_size)
+        ready = Queue.Queue()
+        stopped = threading.Event()
+        queued = [0]
+
+        def feed() :
+            try :
+                for chunk in self._chunks(indexes) :
+                    slots.acquire()
+                    if stopped.is_set() :
+                        break
+                    queued[0] += 1
+                    pool.apply_async(_prepare_safely, (chunk,),
+                                    callback=ready.put)
+            except Exception as e :
+                queued[0] += 1
+                ready.put([(None, None, None, e)])
+            ready.put(None)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        completed = 0
+        fed = False
+        try :
+            while not fed or completed < queued[0] :
+                chunk = ready.get()
+                if chunk is None :
+                    fed = True
+                    continue
+                completed += 1
+                yield chunk
+                slots.release()
+        finally :
+            stopped.set()
+            slots.release()
+            pool.terminate()
+            pool.join()
+
+    def _submit(self, chunk, bulk) :
+        """Submits the valid jobs of a prepared chunk, returning (index,
+        job ID, exception) of each sweep point"""
+
+        import cg_job
+
+        results = []
+        indexes = []
+        jobs = []
+        for index, config_text, params_hash, violations in chunk :
+            if isinstance(violations, Exception) :
+                results.append((index, None, violations))
+            elif violations :
+                results.append((index, None, InvalidConfigError(violations)))
+            else :
+                indexes.append(index)
+                jobs.append(('%s_%d' %(self.jobname, index), config_text,
+                            params_hash))
+
+        if bulk and jobs and cg_job.has_bulk_launch(self.endpoint) :
+            try :
+                job_ids = cg_job.submit_jobs(self.endpoint, self.token,
+                                            self.appname, self.owner, jobs,
+                                            self.computation)
+                return results + [(index, job_id, None) for index, job_id
+                                    in zip(indexes, job_ids)]
+            except Exception as e :
+                if cg_job.has_bulk_launch(self.endpoint) :
+                    return results + [(index, None, e) for index in indexes]
+                # Nothing was launched: one call per job below.
+
+        for index, (name, config_text, params_hash) in zip(indexes, jobs) :
+            try :
+                results.append((index, cg_job.submit_job(self.endpoint,
+                                self.token, name, self.appname, self.owner,
+                                config_text, params_hash, self.computation),
+                                None))
+            except Exception as e :
+                results.append((index, None, e))
+        return results
+
+    def launch(self, sweep, indexes=None) :
+        """Launches one job per sweep point.
+
+        Args:
+            sweep (cg_sweep.Sweep): the sweep
+            indexes (iterable of int, optional): points to launch, e.g.
+                                                sweep.indexes(shard, shards)
+
+        Returns:
+            (generator): yields (index, job ID, exception) as each
+                submission completes, like cg_job.launch_batch; job ID is
+                None and exception set when it failed or the config is
+                invalid (InvalidConfigError)
+        """
+
+        import cg_session
+
+        cg_session.configure_endpoint(self.endpoint, pool_size=self.workers)
+
+        # Bounded, so a slow gateway stops taking chunks from prepare,
+        # which then stops handing chunks to the processes.
+        chunks = Queue.Queue(self.workers)
+        done = Queue.Queue()
+
+        def submit() :
+            while True :
+                chunk = chunks.get()
+                if chunk is None :
+                    done.put(None)
+                    return
+                done.put(self._submit(chunk, self.bulk))
+
+        def feed() :
+            try :
+                for chunk in self.prepare(sweep, indexes) :
+                    chunks.put(chunk)
+            except Exception as e :
+                done.put([(None, None, e)])
+            for i in xrange(self.workers) :
+                chunks.put(None)
+
+        threads = [threading.Thread(target=submit)
+                    for i in xrange(self.workers)]
+        threads.append(threading.Thread(target=feed))
+        for thread in threads :
+            thread.daemon = True
+            thread.start()
+
+        running = self.workers
+        while running :
+            results = done.get()
+            if results is None :
+                running -= 1
+                continue
+            for result in results :
+                yield result
+
+def _prepare_safely(chunk) :
+    """_prepare, giving the exception in place of the violations of every
+    index of the chunk when preparing it failed"""
+
+    try :
+        return _prepare(chunk)
+    except Exception as e :
+        return [(index, None, None, e) for index in chunk]
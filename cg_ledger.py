@@ -0,0 +1,230 @@
+"""
+Local SQLite ledger of launched jobs
+
+launch_job, monitor_job (and every status poll, e.g. of 'watch') and
+get_job_output record each job they see: its ID, app, name, owner, a hash
+of its config, its last known state, when it was launched and last
+updated, and its output archive URI. Jobs can then be found without
+calling the gateway:
+
+    # all running jobs of My_App, as a table
+    ./cg_job.py list --where state=RUNNING --where app=My_App
+
+    # jobs launched in the last hour, one JSON object per line
+    ./cg_job.py query --newer 3600
+
+Writes are buffered and committed in one transaction every batch_size
+records or flush_interval seconds, and when the process exits. Queries
+first commit what is buffered, unless told not to (flush=False) as in
+frequent lookups that would otherwise commit one record at a time.
+
+The ledger file comes from the bash environment:
+
+    CG_LEDGER   path of the SQLite file (default ~/.cg_ledger.db),
+                empty to record nothing
+"""
+
+import os
+import json
+import time
+import atexit
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('id', 'endpoint', 'app', 'name', 'owner', 'params_hash',
+            'state', 'output_uri', 'created', 'updated')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    endpoint TEXT,
+    app TEXT,
+    name TEXT,
+    owner TEXT,
+    params_hash TEXT,
+    state TEXT,
+    output_uri TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, updated);
+CREATE INDEX IF NOT EXISTS jobs_app ON jobs (app, state);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+CREATE INDEX IF NOT EXISTS jobs_params_hash ON jobs (params_hash);
+"""
+
+def _normalize(value) :
+    if isinstance(value, bool) or value is None :
+        return value
+    if isinstance(value, (int, long, float)) :
+        return str(value)
+    return value
+
+def config_hash(config, app=None, computation=None) :
+    """Returns a hex digest identifying a job submission.
+
+    The job config (parameters, options, ...) is normalized with the app
+    and computation: key order does not matter, and numeric parameter
+    values hash like their strings, so 10 and "10" are the same.
+    """
+
+    normalized = dict(config)
+    normalized['parameters'] = dict((name, _normalize(value)) for name, value
+                                    in config.get('parameters', {}).items())
+    normalized['app'] = app
+    normalized['computation'] = computation or {}
+    text = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class Ledger(object) :
+    """Job records in an SQLite file, shared by the threads of a process.
+
+    Args:
+        path (string, path): the SQLite file, created when missing
+        batch_size (int, optional): buffered records that trigger a commit
+        flush_interval (float, optional): longest time (s) a record stays
+                                            buffered while others arrive
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0) :
+        import sqlite3
+
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flushed = time.time()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory) :
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, timeout=30,
+                                check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # WAL lets other processes query while this one writes.
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def record(self, job_id, **fields) :
+        """Buffers new values of a job's fields (see FIELDS); None values
+        leave the stored value unchanged"""
+
+        unknown = set(fields) - set(FIELDS)
+        if unknown :
+            raise ValueError('Unknown ledger fields: %s'
+                            %', '.join(sorted(unknown)))
+        now = time.time()
+        with self.lock :
+            self.pending.append((job_id, now, fields))
+            if (len(self.pending) >= self.batch_size or
+                    now - self.flushed >= self.flush_interval) :
+                self._flush()
+
+    def _flush(self) :
+        pending, self.pending = self.pending, []
+        self.flushed = time.time()
+        if not pending :
+            return
+        with self.db :
+            for job_id, now, fields in pending :
+                self.db.execute('INSERT OR IGNORE INTO jobs (id, created, '
+                                'updated) VALUES (?, ?, ?)',
+                                (job_id, fields.get('created', now), now))
+                names = [name for name, value in sorted(fields.items())
+                        if value is not None]
+                self.db.execute('UPDATE jobs SET %s updated = ? WHERE id = ?'
+                                %''.join('%s = ?, ' %name for name in names),
+                                [fields[name] for name in names] +
+                                [now, job_id])
+        logger.debug('Committed %d ledger records to %s'
+                    %(len(pending), self.path))
+
+    def flush(self) :
+        """Commits the buffered records"""
+
+        with self.lock :
+            self._flush()
+
+    def query(self, newer=None, limit=None, flush=True, **where) :
+        """Returns the jobs matching every condition, newest first.
+
+        Args:
+            newer (float, optional): only jobs launched in the last
+                                    newer seconds
+            limit (int, optional): largest number of jobs returned
+            flush (bool, optional): commit the buffered records first, so
+                                    that they are found too
+            where (optional): field=value conditions, e.g. state='RUNNING'
+
+        Returns:
+            (list of dict): one dict of FIELDS per job
+        """
+
+        unknown = set(where) - set(FIELDS)
+        if unknown :
+            raise ValueError('Unknown ledger fields: %s'
+                            %', '.join(sorted(unknown)))
+        clauses = ['%s = ?' %name for name in sorted(where)]
+        values = [where[name] for name in sorted(where)]
+        if newer is not None :
+            clauses.append('created >= ?')
+            values.append(time.time() - newer)
+        sql = 'SELECT * FROM jobs'
+        if clauses :
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY created DESC'
+        if limit :
+            sql += ' LIMIT %d' %int(limit)
+        with self.lock :
+            if flush :
+                self._flush()
+            return [dict(zip(row.keys(), row))
+                    for row in self.db.execute(sql, values)]
+
+    def close(self) :
+        with self.lock :
+            self._flush()
+            self.db.close()
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+def get_ledger() :
+    """Returns the Ledger of CG_LEDGER, or None when it is disabled"""
+
+    global _ledger
+    if _ledger is None :
+        path = os.getenv('CG_LEDGER', '~/.cg_ledger.db')
+        if not path :
+            return None
+        with _ledger_lock :
+            if _ledger is None :
+                _ledger = Ledger(os.path.expanduser(path))
+                atexit.register(close_ledger)
+    return _ledger
+
+def close_ledger() :
+    """Commits and closes the ledger of this process"""
+
+    global _ledger
+    with _ledger_lock :
+        if _ledger is not None :
+            _ledger.close()
+            _ledger = None
+
+def record(job_id, **fields) :
+    """Records fields of a job in the ledger, if one is enabled. Ledger
+    errors are logged and never fail the gateway call being recorded."""
+
+    import sqlite3
+
+    try :
+        ledger = get_ledger()
+        if ledger is not None :
+            ledger.record(job_id, **fields)
+    except (sqlite3.Error, OSError, IOError) as e :
+        logger.warning('Job %s not recorded in the ledger: %s' %(job_id, e))
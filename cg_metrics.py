@@ -0,0 +1,385 @@
+"""
+Per-call instrumentation of cg_rest, with pluggable listeners
+
+Every REST call made through cg_rest (and cg_request) is recorded as a
+Call: method, URL, endpoint path, number of attempts, HTTP status, bytes
+sent and received, and where the time went:
+
+    queue    waiting for the endpoint's rate limit (see cg_ratelimit)
+    connect  opening new connections, DNS lookup included
+    tls      TLS handshakes of new connections
+    wait     from sending the request to the response headers, i.e.
+             network round trip and server time
+    body     reading the response body
+    decode   decoding the JSON response
+
+Listeners get on_start(call), then on_end(call) or on_error(call) once the
+call finished or failed. Built-in exporters are enabled from the bash
+environment with a comma-separated list:
+
+    # p50/p95/p99 per endpoint path and method printed to stderr at exit,
+    # a trace of every call, and Prometheus metrics written at exit
+    export CG_METRICS="summary,jsonl=/tmp/cg_trace.jsonl,prometheus=/tmp/cg.prom"
+
+or at run time:
+
+    import cg_metrics
+    cg_metrics.add_listener(cg_metrics.SummaryExporter())
+
+Nothing is measured while no listener is registered: cg_rest then only
+checks that the listener list is empty.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import logging
+import threading
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('queue', 'connect', 'tls', 'wait', 'body', 'decode')
+
+listeners = []
+_local = threading.local()
+_atexit_registered = [False]
+
+def endpoint_path(url) :
+    """Returns the endpoint path of a call URL, e.g. '/job'"""
+
+    path = urlparse.urlparse(url).path.rstrip('/')
+    return '/' + path.rsplit('/', 1)[-1]
+
+class Call(object) :
+    """Measurements of one REST call"""
+
+    def __init__(self, method, url) :
+        self.method = method
+        self.url = url
+        self.path = endpoint_path(url)
+        self.start = time.time()
+        self.duration = None
+        self.phases = {}
+        self.attempts = 0
+        self.status = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = None
+
+    def add(self, phase, seconds) :
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def as_dict(self) :
+        return {'method' : self.method, 'url' : self.url, 'path' : self.path,
+                'start' : self.start, 'duration' : self.duration,
+                'phases' : self.phases, 'attempts' : self.attempts,
+                'status' : self.status, 'bytes_sent' : self.bytes_sent,
+                'bytes_received' : self.bytes_received, 'error' : self.error}
+
+class Listener(object) :
+    """Base class of call listeners; every method is optional"""
+
+    def on_start(self, call) :
+        pass
+
+    def on_end(self, call) :
+        pass
+
+    def on_error(self, call) :
+        pass
+
+    def close(self) :
+        pass
+
+def _notify(event, call) :
+    for listener in listeners :
+        try :
+            getattr(listener, event)(call)
+        except Exception as e :
+            logger.warning('Metrics listener %r failed on %s: %s'
+                            %(listener, event, e))
+
+def add_listener(listener) :
+    """Registers a listener, closed when the process exits"""
+
+    listeners.append(listener)
+    if not _atexit_registered[0] :
+        _atexit_registered[0] = True
+        atexit.register(close)
+
+def remove_listener(listener) :
+    listeners.remove(listener)
+
+def close() :
+    """Closes every listener, writing the exporters' output"""
+
+    while listeners :
+        listener = listeners.pop()
+        try :
+            listener.close()
+        except Exception as e :
+            logger.warning('Closing metrics listener %r failed: %s'
+                            %(listener, e))
+
+def current() :
+    """Returns the Call sent by this thread, or None"""
+
+    return getattr(_local, 'call', None)
+
+def start(method, url) :
+    """Starts recording a call sent by this thread and returns it"""
+
+    call = Call(method, url)
+    _local.call = call
+    _notify('on_start', call)
+    return call
+
+def detach(call) :
+    """Stops attributing this thread's connection timings to call"""
+
+    if call is not None and getattr(_local, 'call', None) is call :
+        _local.call = None
+
+def record_response(call, response, seconds, handshake) :
+    """Adds one attempt's response to call.
+
+    Args:
+        call (Call): the call the attempt belongs to
+        response (requests.Response): the response of the attempt
+        seconds (float): time spent sending and reading the response
+        handshake (float): connect and TLS time of the attempt
+    """
+
+    elapsed = response.elapsed.total_seconds()
+    call.add('wait', max(elapsed - handshake, 0.0))
+    call.add('body', max(seconds - elapsed, 0.0))
+    call.status = response.status_code
+    body = response.request.body
+    call.bytes_sent += len(body) if body else 0
+    call.bytes_received += len(response.content or '')
+
+def end(call) :
+    """Finishes call and notifies the listeners, once"""
+
+    if call is None or call.duration is not None :
+        return
+    detach(call)
+    call.duration = time.time() - call.start
+    _notify('on_end', call)
+
+def error(call, exception) :
+    """Finishes call as failed with exception, once"""
+
+    if call is None or call.duration is not None :
+        return
+    detach(call)
+    call.duration = time.time() - call.start
+    call.error = '%s: %s' %(type(exception).__name__, exception)
+    _notify('on_error', call)
+
+def percentile(samples, p) :
+    """Nearest-rank percentile p (0-100) of samples"""
+
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+class SummaryExporter(Listener) :
+    """Prints call counts and latency percentiles per endpoint path and
+    method when closed.
+
+    Args:
+        stream (file, optional): where the table is written
+        max_samples (int, optional): durations kept per path and method,
+                                    sampled uniformly beyond that
+    """
+
+    def __init__(self, stream=None, max_samples=10000) :
+        self.stream = stream
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def on_end(self, call) :
+        key = (call.path, call.method)
+        with self.lock :
+            entry = self.calls.setdefault(key, {'count' : 0, 'errors' : 0,
+                                                'samples' : []})
+            entry['count'] += 1
+            if call.error is not None :
+                entry['errors'] += 1
+            samples = entry['samples']
+            if len(samples) < self.max_samples :
+                samples.append(call.duration)
+            else :
+                index = random.randrange(entry['count'])
+                if index < self.max_samples :
+                    samples[index] = call.duration
+
+    on_error = on_end
+
+    def render(self) :
+        lines = ['%-14s %-7s %8s %7s %9s %9s %9s %9s'
+                %('PATH', 'METHOD', 'CALLS', 'ERRORS', 'P50 ms', 'P95 ms',
+                'P99 ms', 'MAX ms')]
+        with self.lock :
+            for (path, method), entry in sorted(self.calls.items()) :
+                samples = entry['samples']
+                lines.append('%-14s %-7s %8d %7d %9.2f %9.2f %9.2f %9.2f'
+                            %(path, method, entry['count'], entry['errors'],
+                            percentile(samples, 50) * 1000,
+                            percentile(samples, 95) * 1000,
+                            percentile(samples, 99) * 1000,
+                            max(samples) * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def close(self) :
+        if self.calls :
+            (self.stream or sys.stderr).write(self.render())
+
+class TraceExporter(Listener) :
+    """Appends every finished call to a file as a line of JSON"""
+
+    def __init__(self, path) :
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def on_end(self, call) :
+        line = json.dumps(call.as_dict(), sort_keys=True,
+                        separators=(',', ':'))
+        with self.lock :
+            self.file.write(line + '\n')
+
+    on_error = on_end
+
+    def close(self) :
+        with self.lock :
+            self.file.close()
+
+class PrometheusExporter(Listener) :
+    """Aggregates calls into Prometheus metrics, in the text exposition
+    format. With a path, the metrics are written there when closed, e.g.
+    for the node_exporter textfile collector.
+
+    Args:
+        path (string, path, optional): file written when closed
+        buckets (tuple, optional): upper bounds (s) of the duration buckets
+    """
+
+    def __init__(self, path=None, buckets=(0.005, 0.01, 0.025, 0.05, 0.1,
+                                        0.25, 0.5, 1, 2.5, 5, 10)) :
+        self.path = path
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.errors = {}
+        self.durations = {}
+        self.phases = {}
+        self.bytes = {}
+
+    def on_end(self, call) :
+        key = (call.method, call.path)
+        with self.lock :
+            status = str(call.status) if call.status is not None else ''
+            self.calls[key + (status,)] = \
+                self.calls.get(key + (status,), 0) + 1
+            if call.error is not None :
+                kind = call.error.split(':', 1)[0]
+                self.errors[key + (kind,)] = \
+                    self.errors.get(key + (kind,), 0) + 1
+            counts = self.durations.setdefault(key,
+                                [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets) :
+                if call.duration <= bound :
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += call.duration
+            for phase, seconds in call.phases.items() :
+                self.phases[key + (phase,)] = \
+                    self.phases.get(key + (phase,), 0.0) + seconds
+            for direction, size in (('sent', call.bytes_sent),
+                                    ('received', call.bytes_received)) :
+                self.bytes[key + (direction,)] = \
+                    self.bytes.get(key + (direction,), 0) + size
+
+    on_error = on_end
+
+    def render(self) :
+        """Returns the metrics in the Prometheus text format"""
+
+        def labels(names, values) :
+            return ','.join('%s="%s"' %(name, value)
+                            for name, value in zip(names, values))
+
+        lines = []
+        def family(name, kind, text, samples, names) :
+            lines.append('# HELP %s %s' %(name, text))
+            lines.append('# TYPE %s %s' %(name, kind))
+            for key, value in sorted(samples.items()) :
+                lines.append('%s{%s} %s' %(name, labels(names, key), value))
+
+        with self.lock :
+            family('cg_rest_calls_total', 'counter', 'REST calls finished',
+                    self.calls, ('method', 'path', 'status'))
+            family('cg_rest_errors_total', 'counter', 'REST calls failed',
+                    self.errors, ('method', 'path', 'error'))
+            lines.append('# HELP cg_rest_call_duration_seconds Duration of '
+                        'REST calls')
+            lines.append('# TYPE cg_rest_call_duration_seconds histogram')
+            for key, counts in sorted(self.durations.items()) :
+                base = labels(('method', 'path'), key)
+                for bound, count in zip(self.buckets, counts) :
+                    lines.append('cg_rest_call_duration_seconds_bucket'
+                                '{%s,le="%s"} %d' %(base, bound, count))
+                lines.append('cg_rest_call_duration_seconds_bucket'
+                            '{%s,le="+Inf"} %d' %(base, counts[-2]))
+                lines.append('cg_rest_call_duration_seconds_sum{%s} %r'
+                            %(base, counts[-1]))
+                lines.append('cg_rest_call_duration_seconds_count{%s} %d'
+                            %(base, counts[-2]))
+            family('cg_rest_phase_seconds_total', 'counter', 'Time spent in '
+                    'each phase of REST calls', self.phases,
+                    ('method', 'path', 'phase'))
+            family('cg_rest_bytes_total', 'counter', 'Bytes of REST call '
+                    'bodies', self.bytes, ('method', 'path', 'direction'))
+        return '\n'.join(lines) + '\n'
+
+    def close(self) :
+        if not self.path :
+            return
+        temp = '%s.%d.tmp' %(self.path, os.getpid())
+        with open(temp, 'w') as f :
+            f.write(self.render())
+        os.rename(temp, self.path)
+
+EXPORTERS = {
+    'summary' : lambda arg : SummaryExporter(),
+    'jsonl' : TraceExporter,
+    'prometheus' : PrometheusExporter,
+}
+
+def configure_from_env(spec=None) :
+    """Registers the exporters of a list like 'summary,jsonl=<path>'.
+    Mistakes are reported on stderr, as this runs before logging is set up.
+    """
+
+    spec = spec if spec is not None else os.getenv('CG_METRICS', '')
+    for item in spec.split(',') :
+        name, _, arg = item.strip().partition('=')
+        if not name :
+            continue
+        if name not in EXPORTERS :
+            sys.stderr.write("CG_METRICS: unknown exporter '%s', expected "
+                            "one of %s\n" %(name, ', '.join(sorted(EXPORTERS))))
+            continue
+        if name == 'jsonl' and not arg :
+            sys.stderr.write("CG_METRICS: the jsonl exporter needs a path, "
+                            "'jsonl=<path>'\n")
+            continue
+        add_listener(EXPORTERS[name](arg or None))
+
+configure_from_env()
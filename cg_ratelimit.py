@@ -0,0 +1,174 @@
+"""
+Client-side token-bucket rate limiting of REST calls per endpoint path
+
+Each limited path ('/token', '/app', '/appconfig', '/job', '/joboutput')
+has a bucket that refills at 'rate' calls per second, up to 'burst' calls.
+cg_rest takes one token from the bucket of the path it calls before every
+attempt, waiting when the bucket is empty. This keeps the call rate at
+the allowed ceiling instead of swinging between bursts and rejected calls.
+
+Buckets are per process unless a shared directory is given. Then the
+bucket state lives in one small file per path, updated under an flock, so
+every CLI process on the host draws from the same budget. On Linux,
+/dev/shm keeps those files in memory.
+
+Limits come from the bash environment:
+
+    # 5 job calls/s (bursts of 10) and 1 token call/s for every process
+    export CG_RATE_LIMIT="/job=5:10,/token=1"
+    export CG_RATE_LIMIT_DIR=/dev/shm/cg_ratelimit
+
+or can be set at run time:
+
+    import cg_ratelimit
+    cg_ratelimit.configure('/job', rate=5, burst=10)
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket(object) :
+    """Bucket shared by the threads of one process.
+
+    Args:
+        rate (float): tokens added per second
+        burst (float, optional): bucket size, defaults to max(rate, 1)
+    """
+
+    def __init__(self, rate, burst=None) :
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def _take(self, tokens, stamp) :
+        """Refills the bucket to now, then returns (tokens, stamp, wait)
+        after taking one token, or the seconds to wait for one"""
+
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+        if tokens >= 1 :
+            return (tokens - 1, now, 0)
+        return (tokens, now, (1 - tokens) / self.rate)
+
+    def acquire(self) :
+        """Blocks until a token is available and takes it.
+
+        Returns:
+            (float): seconds spent waiting
+        """
+
+        waited = 0
+        while True :
+            with self.lock :
+                self.tokens, self.stamp, wait = self._take(self.tokens,
+                                                        self.stamp)
+            if not wait :
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+class FileTokenBucket(TokenBucket) :
+    """Bucket whose state is kept in a file shared by processes"""
+
+    def __init__(self, path, rate, burst=None) :
+        TokenBucket.__init__(self, rate, burst)
+        self.path = path
+
+    def acquire(self) :
+        waited = 0
+        while True :
+            with open(self.path, 'a+') as f :
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try :
+                    state = json.loads(f.read())
+                except ValueError :
+                    state = {'tokens' : self.burst, 'stamp' : time.time()}
+                tokens, stamp, wait = self._take(state['tokens'],
+                                                state['stamp'])
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({'tokens' : tokens, 'stamp' : stamp}))
+            if not wait :
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+_buckets = {}
+
+def configure(path, rate, burst=None, shared_dir=None) :
+    """Limits calls to endpoint path (e.g. '/job') to rate per second.
+
+    Args:
+        path (string): endpoint path, matched against the last path
+                        segment of call URLs
+        rate (float): calls per second, 0 or None removes the limit
+        burst (float, optional): calls allowed back to back
+        shared_dir (string, path, optional): directory for a bucket file
+                                            shared with other processes
+    """
+
+    path = '/' + path.strip('/')
+    if not rate :
+        _buckets.pop(path, None)
+        return
+    if shared_dir :
+        if not os.path.isdir(shared_dir) :
+            os.makedirs(shared_dir)
+        filename = os.path.join(shared_dir,
+                                path.strip('/').replace('/', '_') + '.bucket')
+        _buckets[path] = FileTokenBucket(filename, rate, burst)
+    else :
+        _buckets[path] = TokenBucket(rate, burst)
+    logger.debug("Rate limit for '%s': %s calls/s, burst %s%s"
+                %(path, rate, _buckets[path].burst,
+                ' (shared in %s)' %shared_dir if shared_dir else ''))
+
+def configure_from_env(spec=None, shared_dir=None) :
+    """Reads limits like '/job=5:10,/token=1' (path=rate[:burst]).
+    Malformed items are logged and skipped."""
+
+    spec = spec if spec is not None else os.getenv('CG_RATE_LIMIT', '')
+    shared_dir = shared_dir or os.getenv('CG_RATE_LIMIT_DIR') or None
+    for item in spec.split(',') :
+        if not item.strip() :
+            continue
+        path, _, limit = item.partition('=')
+        rate, _, burst = limit.partition(':')
+        try :
+            rate = float(rate)
+            burst = float(burst) if burst else None
+        except ValueError :
+            rate = None
+        if not path.strip() or rate is None or rate <= 0 or (
+                burst is not None and burst <= 0) :
+            logger.error("CG_RATE_LIMIT: ignoring '%s', expected "
+                        "path=rate[:burst] with positive numbers"
+                        %item.strip())
+            continue
+        configure(path.strip(), rate, burst, shared_dir)
+
+def acquire(url) :
+    """Waits for a token of the bucket limiting url, if any"""
+
+    if not _buckets :
+        return
+    path = urlparse.urlparse(url).path.rstrip('/')
+    path = '/' + path.rsplit('/', 1)[-1]
+    bucket = _buckets.get(path)
+    if bucket is not None :
+        waited = bucket.acquire()
+        if waited :
+            logger.debug("Rate limit of '%s' delayed call by %.3f seconds"
+                        %(path, waited))
+
+configure_from_env()
@@ -0,0 +1,249 @@
+"""
+Retry policy and per-endpoint circuit breaker used by cg_rest
+
+Failed calls are retried with exponential backoff and full jitter. A
+'Retry-After' header on a 429/503 response is honoured instead of the
+computed delay. Idempotent calls (GET, PUT, DELETE) are retried on
+connection errors, timeouts and retryable statuses. POST calls are only
+retried when the gateway cannot have acted on them: the connection was
+never established, or the gateway answered 429/503.
+
+Each endpoint (scheme, host and path) has a circuit breaker. After
+failure_threshold consecutive failures it opens, and calls fail at once
+with CircuitOpenError for reset_timeout seconds. A single trial call is
+then let through, and its result closes or re-opens the circuit.
+
+Defaults come from the bash environment:
+
+    CG_RETRY_ATTEMPTS    attempts per call, 1 disables retries (default 3)
+    CG_BREAKER_FAILURES  consecutive failures that open a circuit (default 5)
+    CG_BREAKER_RESET     seconds a circuit stays open (default 30)
+
+The policy can also be replaced at run time:
+
+    import cg_retry
+    cg_retry.set_policy(cg_retry.RetryPolicy(max_attempts=5, base_delay=1))
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+import urlparse
+from email.utils import parsedate_tz, mktime_tz
+from requests import exceptions as rex
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'])
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+# The gateway refused these without acting on them, so POSTs may be resent.
+REJECTED_STATUSES = frozenset([429, 503])
+
+FAILURE_THRESHOLD = int(os.getenv('CG_BREAKER_FAILURES', 5))
+RESET_TIMEOUT = float(os.getenv('CG_BREAKER_RESET', 30))
+
+class CircuitOpenError(rex.ConnectionError) :
+    """Raised instead of calling an endpoint whose circuit is open"""
+
+class RetryPolicy(object) :
+    """Decides whether and when a failed call is tried again.
+
+    Args:
+        max_attempts (int, optional): total attempts, 1 disables retries
+        base_delay (float, optional): delay cap (s) after the first failure
+        max_delay (float, optional): largest backoff delay (s)
+        max_retry_after (float, optional): largest Retry-After honoured (s)
+        retry_statuses (set, optional): HTTP statuses worth retrying
+    """
+
+    def __init__(self, max_attempts=None, base_delay=0.5, max_delay=30.0,
+                max_retry_after=120.0, retry_statuses=RETRY_STATUSES) :
+        if max_attempts is None :
+            max_attempts = int(os.getenv('CG_RETRY_ATTEMPTS', 3))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = retry_statuses
+
+    def retry_error(self, method, attempt, error) :
+        """True if a call that raised error should be tried again"""
+
+        if attempt >= self.max_attempts :
+            return False
+        if method in IDEMPOTENT_METHODS :
+            return isinstance(error, (rex.ConnectionError, rex.Timeout))
+        return not_sent(error)
+
+    def retry_response(self, method, attempt, response) :
+        """True if a call answered with response should be tried again"""
+
+        if attempt >= self.max_attempts :
+            return False
+        if method in IDEMPOTENT_METHODS :
+            return response.status_code in self.retry_statuses
+        return response.status_code in REJECTED_STATUSES
+
+    def delay(self, attempt, response=None) :
+        """Seconds to wait before attempt + 1"""
+
+        if response is not None :
+            retry_after = parse_retry_after(
+                                response.headers.get('Retry-After'))
+            if retry_after is not None :
+                return min(retry_after, self.max_retry_after)
+        cap = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, cap)
+
+class CircuitBreaker(object) :
+    """Tracks consecutive failures of one endpoint"""
+
+    def __init__(self, failure_threshold=None, reset_timeout=None) :
+        if failure_threshold is None :
+            failure_threshold = FAILURE_THRESHOLD
+        if reset_timeout is None :
+            reset_timeout = RESET_TIMEOUT
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    def before(self, key) :
+        """Raises CircuitOpenError unless a call may go through now"""
+
+        with self.lock :
+            if self.opened is None :
+                return
+            if self.trial or time.time() - self.opened < self.reset_timeout :
+                raise CircuitOpenError("Circuit for '%s' is open after %d "
+                                        "failures" %(key, self.failures))
+            self.trial = True
+
+    def success(self) :
+        with self.lock :
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self, key) :
+        with self.lock :
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold :
+                if self.opened is None or self.trial :
+                    logger.warning("Opening circuit for '%s' for %s seconds"
+                                    %(key, self.reset_timeout))
+                self.opened = time.time()
+                self.trial = False
+
+_policy = RetryPolicy()
+_breakers = {}
+_lock = threading.Lock()
+
+def set_policy(policy) :
+    """Replaces the RetryPolicy used by every cg_rest call"""
+
+    global _policy
+    _policy = policy
+
+def get_policy() :
+    return _policy
+
+def endpoint_key(url) :
+    parts = urlparse.urlparse(url)
+    return '%s://%s%s' %(parts.scheme, parts.netloc, parts.path)
+
+def breaker_for(url) :
+    """Returns the CircuitBreaker of the endpoint url belongs to"""
+
+    key = endpoint_key(url)
+    with _lock :
+        if key not in _breakers :
+            _breakers[key] = CircuitBreaker()
+        return _breakers[key]
+
+def reset_breakers() :
+    with _lock :
+        _breakers.clear()
+
+def not_sent(error) :
+    """True if error shows the request never reached the gateway"""
+
+    if isinstance(error, rex.ConnectTimeout) :
+        return True
+    if isinstance(error, rex.ConnectionError) :
+        cause = error.args[0] if error.args else None
+        return isinstance(getattr(cause, 'reason', None), NewConnectionError)
+    return False
+
+def parse_retry_after(value) :
+    """Seconds from a Retry-After header (delta-seconds or HTTP-date)"""
+
+    if not value :
+        return None
+    value = value.strip()
+    if value.isdigit() :
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None :
+        return None
+    return max(mktime_tz(date) - time.time(), 0)
+
+def is_failure(response) :
+    """True if a response shows the endpoint is struggling"""
+
+    return response.status_code >= 500 or response.status_code == 429
+
+def call(method, url, send) :
+    """Calls send() until it succeeds or the retry policy gives up.
+
+    Args:
+        method (str): the HTTP method, used to tell idempotent calls apart
+        url (str, URL): the endpoint called, selects the circuit breaker
+        send (function): performs one attempt and returns the response
+
+    Returns:
+        (requests.Response): the last response received
+
+    Raises:
+        CircuitOpenError when the endpoint's circuit is open, or the
+        exception of the last attempt.
+    """
+
+    policy = _policy
+    breaker = breaker_for(url)
+    key = endpoint_key(url)
+    attempt = 0
+    while True :
+        attempt += 1
+        breaker.before(key)
+        try :
+            r = send()
+        except (rex.ConnectionError, rex.Timeout) as e :
+            breaker.failure(key)
+            if not policy.retry_error(method, attempt, e) :
+                raise
+            delay = policy.delay(attempt)
+            logger.debug("%s '%s' failed (%s), retrying in %.2f seconds",
+                        method, url, e, delay)
+        except Exception :
+            # Any outcome must be reported, or a trial call would leave the
+            # circuit open for good.
+            breaker.failure(key)
+            raise
+        else :
+            if is_failure(r) :
+                breaker.failure(key)
+            else :
+                breaker.success()
+            if not policy.retry_response(method, attempt, r) :
+                return r
+            delay = policy.delay(attempt, r)
+            logger.debug("%s '%s' returned %d, retrying in %.2f seconds",
+                        method, url, r.status_code, delay)
+            r.close()
+        time.sleep(delay)
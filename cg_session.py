@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Shared, pooled HTTP session used by cg_rest for every REST call
+
+All of the cg_* utilities go through a single requests.Session so that
+connections to the gateway are kept alive and reused between calls instead
+of paying for a new TCP+TLS handshake each time.
+
+Pool settings can be tuned per endpoint (URL prefix):
+
+    import cg_session
+
+    # 20 pooled connections and 2 connect retries for the sandbox gateway
+    cg_session.configure_endpoint('https://sandbox.cigi.illinois.edu/',
+                                  pool_size=20, max_retries=2)
+
+    # close the connection after every call to this endpoint
+    cg_session.configure_endpoint('https://other.gateway/', keep_alive=False)
+
+Defaults for endpoints that were not configured come from the bash
+environment:
+
+    CG_POOL_SIZE    number of pooled connections per host (default 10)
+    CG_MAX_RETRIES  connection retries done by the adapter (default 0)
+    CG_TIMEOUT      request timeout in seconds (default 50)
+"""
+
+import os
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import (HTTPConnection,
+                                                HTTPSConnection)
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+                                                    HTTPSConnectionPool)
+import cg_metrics
+
+# This is used sed to disable InsecureRequestWarning.
+requests.packages.urllib3.disable_warnings()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = int(os.getenv('CG_POOL_SIZE', 10))
+DEFAULT_MAX_RETRIES = int(os.getenv('CG_MAX_RETRIES', 0))
+DEFAULT_TIMEOUT = float(os.getenv('CG_TIMEOUT', 50))
+
+_lock = threading.Lock()
+_session = None
+_endpoints = {}
+# Virtual endpoints of replica pools (see cg_balance): (adapter, replicas)
+_pools = {}
+
+class TimedConnect(object) :
+    """Connection mixin reporting the DNS + TCP connect time of new
+    connections to the call being recorded by cg_metrics"""
+
+    def _new_conn(self) :
+        call = cg_metrics.current()
+        if call is None :
+            return super(TimedConnect, self)._new_conn()
+        start = time.time()
+        try :
+            return super(TimedConnect, self)._new_conn()
+        finally :
+            call.add('connect', time.time() - start)
+
+class TimedHTTPConnection(TimedConnect, HTTPConnection) :
+    pass
+
+class TimedHTTPSConnection(TimedConnect, HTTPSConnection) :
+    """Also reports the TLS handshake time"""
+
+    def connect(self) :
+        call = cg_metrics.current()
+        if call is None :
+            return HTTPSConnection.connect(self)
+        start = time.time()
+        connect = call.phases.get('connect', 0)
+        try :
+            return HTTPSConnection.connect(self)
+        finally :
+            call.add('tls', time.time() - start -
+                    (call.phases.get('connect', 0) - connect))
+
+class TimedHTTPConnectionPool(HTTPConnectionPool) :
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool) :
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedAdapter(HTTPAdapter) :
+    """HTTPAdapter whose new connections are timed for cg_metrics"""
+
+    def init_poolmanager(self, *args, **kwargs) :
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http' : TimedHTTPConnectionPool,
+            'https' : TimedHTTPSConnectionPool,
+        }
+
+class EndpointSettings(object) :
+    """Connection pool settings for one endpoint (URL prefix)"""
+
+    def __init__(self, pool_size=None, max_retries=None, keep_alive=True) :
+        if pool_size is None :
+            pool_size = DEFAULT_POOL_SIZE
+        if max_retries is None :
+            max_retries = DEFAULT_MAX_RETRIES
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.keep_alive = keep_alive
+
+    def adapter(self) :
+        return TimedAdapter(pool_connections=self.pool_size,
+                            pool_maxsize=self.pool_size,
+                            max_retries=self.max_retries)
+
+def _mount(session, prefix, settings) :
+    session.mount(prefix, settings.adapter())
+    logger.debug("Pool for '%s': size=%d, retries=%d, keep-alive=%s"
+                %(prefix, settings.pool_size, settings.max_retries,
+                settings.keep_alive))
+
+def _new_session() :
+    session = requests.Session()
+    session.verify = False
+    default = EndpointSettings()
+    for prefix in ('http://', 'https://') :
+        session.mount(prefix, default.adapter())
+    for prefix, settings in _endpoints.items() :
+        _mount(session, prefix, settings)
+    for prefix, (adapter, replicas) in _pools.items() :
+        session.mount(prefix, adapter)
+    return session
+
+def configure_endpoint(prefix, pool_size=None,
+                        max_retries=None, keep_alive=True) :
+    """Sets the connection pool used for every URL starting with prefix.
+
+    Args:
+        prefix (string, URL): endpoint, e.g. the value of CG_API
+        pool_size (int, optional): number of connections kept in the pool
+        max_retries (int, optional): connection retries done by the adapter
+        keep_alive (bool, optional): False closes connections after each call
+
+    Returns: void
+    """
+
+    settings = EndpointSettings(pool_size, max_retries, keep_alive)
+    with _lock :
+        # The pool of a virtual endpoint is the pools of its replicas.
+        prefixes = _pools[prefix][1] if prefix in _pools else [prefix]
+        for prefix in prefixes :
+            _endpoints[prefix] = settings
+            if _session is not None :
+                _mount(_session, prefix, settings)
+
+def mount_pool(prefix, adapter, replicas) :
+    """Sends every URL starting with prefix through adapter, which
+    balances them over the replicas (see cg_balance)"""
+
+    with _lock :
+        _pools[prefix] = (adapter, replicas)
+        if _session is not None :
+            _session.mount(prefix, adapter)
+
+def endpoint_settings(url) :
+    """Returns the EndpointSettings that apply to the given URL"""
+
+    match = ''
+    for prefix in _endpoints :
+        if url.startswith(prefix) and len(prefix) > len(match) :
+            match = prefix
+    if match :
+        return _endpoints[match]
+    return EndpointSettings()
+
+def get_session() :
+    """Returns the shared requests.Session, creating it on first use"""
+
+    global _session
+    if _session is None :
+        with _lock :
+            if _session is None :
+                _session = _new_session()
+    return _session
+
+def close_session() :
+    """Closes the shared session and all of its pooled connections"""
+
+    global _session
+    with _lock :
+        if _session is not None :
+            _session.close()
+        _session = None
+
+def request(method, url, headers={}, **kwargs) :
+    """Sends one request over the shared session.
+
+    Applies the default timeout and the endpoint's keep-alive setting;
+    any keyword argument accepted by requests.Session.request can be given.
+
+    Returns:
+        (requests.Response): the raw response
+    """
+
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    if not endpoint_settings(url).keep_alive :
+        headers = dict(headers)
+        headers['Connection'] = 'close'
+    return get_session().request(method, url, headers=headers, **kwargs)
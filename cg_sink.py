@@ -0,0 +1,294 @@
+"""
+Buffered, append-only sinks for gateway responses
+
+monitor, getinfo and getconfig write one pretty-printed JSON file per call
+by default. With a sink, each response is appended as one line of compact
+JSON instead, so snapshots of thousands of jobs go into a single file:
+
+    {"id":"<job id>","kind":"monitor","response":{...},"time":1700000000.0}
+
+A sink is chosen by a spec:
+
+    -, stdout               lines written to stdout
+    monitor.jsonl           lines appended to a file
+    monitor.jsonl.gz        gzip compressed (appended as gzip members)
+    monitor.jsonl.zst       zstd compressed, needs the zstandard package
+    monitor-{run}.jsonl.gz  a new file per run: '{run}' is replaced with the
+                            start time and process ID
+
+For example:
+
+    ./cg_job.py monitor --jobidfile job_ids.txt --sink 'snap-{run}.jsonl.gz'
+
+Lines are buffered in memory and written out when buffer_size bytes are
+waiting or every flush_interval seconds. Files are fsynced every
+fsync_interval seconds and when the process exits. Settings come from the
+bash environment:
+
+    CG_SINK_BUFFER          bytes buffered before a write (default 65536)
+    CG_SINK_FLUSH_INTERVAL  seconds between writes of the buffer (default 1)
+    CG_SINK_FSYNC_INTERVAL  seconds between fsyncs (default 5), 0 fsyncs
+                            only when the sink is closed
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = int(os.getenv('CG_SINK_BUFFER', 64 * 1024))
+DEFAULT_FLUSH_INTERVAL = float(os.getenv('CG_SINK_FLUSH_INTERVAL', 1.0))
+DEFAULT_FSYNC_INTERVAL = float(os.getenv('CG_SINK_FSYNC_INTERVAL', 5.0))
+
+# Started once per process, so every '{run}' sink of a run (e.g. all the
+# commands of a 'cg.py batch' script) shares one file.
+RUN_ID = '%s-%d' %(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+
+class SinkError(ValueError) :
+    """Raised when a sink spec cannot be opened"""
+
+def make_record(kind, response, **fields) :
+    """Returns the line written for one response, e.g.
+    make_record('monitor', response, id=job_id)"""
+
+    record = {'kind' : kind, 'time' : time.time(), 'response' : response}
+    record.update(fields)
+    return record
+
+class Sink(object) :
+    """Writes records as lines of compact JSON, buffered in memory and
+    written out by size and on a schedule.
+
+    Args:
+        stream (file): where lines are written
+        buffer_size (int, optional): bytes buffered before a write
+        flush_interval (float, optional): seconds between writes of the
+                                            buffer, 0 writes only by size
+        fsync_interval (float, optional): seconds between fsyncs, 0 only
+                                            fsyncs when closed
+    """
+
+    def __init__(self, stream, buffer_size=DEFAULT_BUFFER_SIZE,
+                flush_interval=DEFAULT_FLUSH_INTERVAL,
+                fsync_interval=DEFAULT_FSYNC_INTERVAL) :
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.records = 0
+        self.synced = time.time()
+        self.closed = threading.Event()
+        self.flusher = None
+        if flush_interval :
+            self.flusher = threading.Thread(target=self._flush_periodically)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def write(self, record) :
+        """Buffers one record (a JSON serializable dict)"""
+
+        line = json.dumps(record, separators=(',', ':'))
+        with self.lock :
+            if self.closed.is_set() :
+                raise ValueError('Sink is closed')
+            self.buffer.append(line)
+            self.buffer.append('\n')
+            self.buffered += len(line) + 1
+            self.records += 1
+            if self.buffered >= self.buffer_size :
+                self._write()
+
+    def _write(self) :
+        if self.buffer :
+            self.stream.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def _push(self) :
+        """Hands written data to the OS"""
+
+        self.stream.flush()
+
+    def _sync(self) :
+        """Pushes written data to the disk, for sinks backed by a file"""
+
+        self.stream.flush()
+
+    def _flush_periodically(self) :
+        while not self.closed.wait(self.flush_interval) :
+            try :
+                self.flush()
+            except (IOError, OSError, ValueError) as e :
+                logger.warning('Writing %r failed: %s' %(self, e))
+
+    def flush(self, sync=None) :
+        """Writes the buffer out, and fsyncs when sync is True (or, when
+        None, when fsync_interval passed since the last fsync)"""
+
+        with self.lock :
+            if self.closed.is_set() :
+                return
+            self._write()
+            now = time.time()
+            if sync is None :
+                sync = (self.fsync_interval and
+                        now - self.synced >= self.fsync_interval)
+            if sync :
+                self._sync()
+                self.synced = now
+            else :
+                self._push()
+
+    def _close(self) :
+        pass
+
+    def close(self) :
+        """Writes and fsyncs what is buffered, then closes the stream"""
+
+        with self.lock :
+            if self.closed.is_set() :
+                return
+            self._write()
+            self._sync()
+            self._close()
+            self.closed.set()
+
+class FileSink(Sink) :
+    """Appends lines to a file, optionally gzip or zstd compressed.
+
+    Args:
+        path (string, path): the file, created with its directory when
+                            missing
+        compression (string, optional): None, 'gzip' or 'zstd'
+
+        See Sink for the other arguments.
+    """
+
+    def __init__(self, path, compression=None, **options) :
+        self.path = path
+        self.compression = compression
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory) :
+            os.makedirs(directory)
+        self.file = open(path, 'ab')
+        if compression == 'gzip' :
+            import gzip
+            # Each run appends a gzip member; readers see one stream.
+            stream = gzip.GzipFile(fileobj=self.file, mode='wb')
+        elif compression == 'zstd' :
+            import zstandard
+            stream = zstandard.ZstdCompressor().stream_writer(self.file)
+        else :
+            stream = self.file
+        Sink.__init__(self, stream, **options)
+
+    def __repr__(self) :
+        return '<FileSink %s>' %self.path
+
+    def _push(self) :
+        # Compressed data stays in the compressor until the next fsync,
+        # so that blocks are not cut short every flush_interval.
+        self.file.flush()
+
+    def _sync(self) :
+        if self.stream is not self.file :
+            # Ends the compressed block so that what was written so far
+            # can be decompressed.
+            self.stream.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _close(self) :
+        if self.compression == 'zstd' :
+            import zstandard
+            self.stream.flush(zstandard.FLUSH_FRAME)
+        elif self.stream is not self.file :
+            self.stream.close()
+        self.file.close()
+
+class StdoutSink(Sink) :
+    """Writes lines to stdout, e.g. to pipe them to another process"""
+
+    def __init__(self, **options) :
+        Sink.__init__(self, sys.stdout, **options)
+
+    def __repr__(self) :
+        return '<StdoutSink>'
+
+def open_sink(spec, **options) :
+    """Returns a new Sink of a spec, see the module documentation.
+
+    Raises:
+        SinkError when the sink cannot be opened
+    """
+
+    if spec in ('-', 'stdout') :
+        return StdoutSink(**options)
+    path = os.path.expanduser(spec.replace('{run}', RUN_ID))
+    compression = None
+    if path.endswith('.gz') :
+        compression = 'gzip'
+    elif path.endswith(('.zst', '.zstd')) :
+        compression = 'zstd'
+        try :
+            import zstandard
+        except ImportError :
+            raise SinkError('The zstandard package is needed to write %s, '
+                            'or use gzip (.gz)' %path)
+    try :
+        return FileSink(path, compression, **options)
+    except (IOError, OSError) as e :
+        raise SinkError('Cannot open sink %s: %s' %(path, e))
+
+def read_records(path) :
+    """Yields the records of a file written by a FileSink, as dicts"""
+
+    if path.endswith('.gz') :
+        import gzip
+        f = gzip.open(path, 'rb')
+    elif path.endswith(('.zst', '.zstd')) :
+        import io
+        import zstandard
+        f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+                                open(path, 'rb'), read_across_frames=True))
+    else :
+        f = open(path, 'rb')
+    with f :
+        for line in f :
+            if line.strip() :
+                yield json.loads(line)
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+def get_sink(spec) :
+    """Returns the Sink of spec shared by this process, closed when the
+    process exits"""
+
+    with _sinks_lock :
+        sink = _sinks.get(spec)
+        if sink is None :
+            if not _sinks :
+                atexit.register(close_sinks)
+            sink = _sinks[spec] = open_sink(spec)
+    return sink
+
+def close_sinks() :
+    """Closes every shared sink"""
+
+    with _sinks_lock :
+        sinks = _sinks.values()
+        _sinks.clear()
+    for sink in sinks :
+        try :
+            sink.close()
+        except (IOError, OSError) as e :
+            logger.warning('Closing %r failed: %s' %(sink, e))
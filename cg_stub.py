@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+"""
+Local stub of the GISolve Open Service API gateway
+
+Answers the same REST calls as the real gateway with the same
+'status'/'result' envelope that cg_rest parses, keeping all state in memory.
+Used to benchmark the cg_* utilities without touching the live sandbox.
+Latency, injected failures and the job state machine are configurable.
+
+Run as a standalone server:
+    ./cg_stub.py --port 8000
+
+    # 20ms +/- 5ms per call, 1% of calls fail with 503, jobs run 5 seconds
+    # and one in ten fails
+    ./cg_stub.py --latency 0.02 --latency-jitter 0.005 --error-rate 0.01 \
+        --job-states QUEUED:1,RUNNING:5,FINISHED --job-failure-rate 0.1
+    export CG_API=http://127.0.0.1:8000/
+
+Or in-process:
+    from cg_stub import StubGateway
+    stub = StubGateway().start()
+    ... cg_rest('GET', stub.url + 'version') ...
+    stub.stop()
+"""
+
+import json
+import uuid
+import random
+import hashlib
+import time
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+API_VERSION = 'stub-0.1'
+
+class StubState(object) :
+    """In-memory tokens, apps and jobs known to the stub gateway
+
+    Jobs go through job_states, a list of (state, seconds) pairs whose last
+    state is terminal, e.g. [('QUEUED', 1), ('RUNNING', 5), ('FINISHED', 0)].
+    A share job_failure_rate of the jobs ends in FAILED instead. Without
+    job_states, jobs are QUEUED for the first third of job_duration seconds,
+    RUNNING until job_duration and FINISHED afterwards. Each job's output
+    archive is output_size bytes served from /output/<job id>.tar.gz.
+
+    Every API call takes latency seconds, give or take latency_jitter. A
+    share error_rate of the calls fails with HTTP error_status (and a
+    Retry-After header when retry_after is set) to inject faults.
+
+    With bulk, POST /jobs launches a list of jobs in one call, like a
+    gateway offering bulk submission; otherwise it answers 404 as the
+    real gateway does.
+    """
+
+    def __init__(self, job_duration=0, output_size=1024 * 1024,
+                error_rate=0.0, error_status=503, retry_after=None,
+                latency=0.0, latency_jitter=0.0, job_states=None,
+                job_failure_rate=0.0, bulk=False) :
+        if job_states is None :
+            job_states = [('QUEUED', job_duration / 3.0),
+                        ('RUNNING', job_duration * 2 / 3.0),
+                        ('FINISHED', 0)]
+        self.job_states = job_states
+        self.job_failure_rate = job_failure_rate
+        self.bulk = bulk
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.output_size = output_size
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.base_url = ''
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.apps = {}
+        self.configs = {}
+        self.jobs = {}
+
+    def error(self, code, message) :
+        return {'status' : 'error',
+                'result' : {'error_code' : code, 'message' : message}}
+
+    def success(self, result=None, **extra) :
+        response = {'status' : 'success', 'result' : result or {}}
+        response.update(extra)
+        return response
+
+    def check_token(self, args) :
+        return args.get('token', '') in self.tokens
+
+    def handle(self, method, path, args) :
+        """Returns the response envelope for one call"""
+
+        handler = getattr(self, '%s_%s' %(method.lower(),
+                            path.strip('/').replace('/', '_')), None)
+        if handler is None or (handler == self.post_jobs and not self.bulk) :
+            return 404, None
+        if self.latency or self.latency_jitter :
+            time.sleep(max(self.latency + random.uniform(
+                        -self.latency_jitter, self.latency_jitter), 0))
+        if self.error_rate and random.random() < self.error_rate :
+            return self.error_status, None
+        with self.lock :
+            return 200, handler(args)
+
+    def get_version(self, args) :
+        return self.success(version=API_VERSION)
+
+    def post_token(self, args) :
+        token = uuid.uuid4().hex
+        lifetime = int(args.get('lifetime', 43200))
+        self.tokens[token] = time.time() + lifetime
+        return self.success({'token' : token})
+
+    def put_token(self, args) :
+        if not self.check_token(args) :
+            return self.error(1, 'Invalid token')
+        lifetime = int(self.tokens[args['token']] - time.time())
+        return self.success({'lifetime' : lifetime})
+
+    def delete_token(self, args) :
+        self.tokens.pop(args.get('token', ''), None)
+        return self.success()
+
+    def post_app(self, args) :
+        if not self.check_token(args) :
+            return self.error(1, 'Invalid token')
+        self.apps[args['app']] = dict(args)
+        return self.success({'app' : args['app']})
+
+    def get_app(self, args) :
+        if not self.check_token(args) :
+            return self.error(1, 'Invalid token')
+        if args.get('app', '') not in self.apps :
+            return self.error(2, 'App not found')
+        return self.success(self.apps[args['app']])
+
+    def post_appconfig(self, args) :
+        if args.get('app', '') not in self.apps :
+            return self.error(2, 'App not found')
+        self.configs[args['app']] = json.loads(args.get('config', '{}'))
+        return self.success()
+
+    def get_appconfig(self, args) :
+        if not self.check_token(args) :
+            return self.error(1, 'Invalid token')
+        if args.get('app', '') not in self.configs :
+            return self.error(2, 'App not configured')
+        return self.success(self.configs[args['app']])
+
+    def post_job(self, args) :
+        if not self.check_token(args) :
+            return self.error(1, 'Invalid token')
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = {'id' : job_id, 'name' : args.get('name', ''),
+                            'app' : args.get('app', ''),
+                            'submitted' : time.time(),
+                            'failed' : random.random() < self.job_failure_rate}
+        return self.success({'id' : job_id})
+
+    def post_jobs(self, args) :
+        if not self.check_token(args) :
+            return self.error(1, 'Invalid token')
+        ids = []
+        for job in json.loads(args.get('jobs', '[]')) :
+            job_args = dict(args, name=job.get('name', ''))
+            ids.append(self.post_job(job_args)['result']['id'])
+        return self.success({'ids' : ids})
+
+    def job_status(self, job) :
+        elapsed = time.time() - job['submitted']
+        for state, seconds in self.job_states[:-1] :
+            if elapsed < seconds :
+                return state
+            elapsed -= seconds
+        return 'FAILED' if job['failed'] else self.job_states[-1][0]
+
+    def get_job(self, args) :
+        if args.get('id', '') not in self.jobs :
+            return self.error(3, 'Job not found')
+        job = dict(self.jobs[args['id']])
+        job['status'] = self.job_status(job)
+        del job['failed']
+        return self.success(job)
+
+    def get_joboutput(self, args) :
+        if args.get('id', '') not in self.jobs :
+            return self.error(3, 'Job not found')
+        return self.success({'uri' : '%soutput/%s.tar.gz'
+                            %(self.base_url, args['id'])})
+
+    def output_bytes(self, job_id, start, end) :
+        """Yields bytes start..end (exclusive) of a job's output archive"""
+
+        pattern = hashlib.sha256(job_id).digest() * 2048
+        while start < end :
+            offset = start % len(pattern)
+            chunk = pattern[offset:offset + end - start]
+            start += len(chunk)
+            yield chunk
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler) :
+    """Decodes form/query arguments and writes the JSON envelope"""
+
+    protocol_version = 'HTTP/1.1'
+    # Write each response in one segment so keep-alive clients are not
+    # stalled by Nagle's algorithm and delayed ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) :
+        pass
+
+    def _arguments(self) :
+        query = urlparse.urlparse(self.path).query
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length :
+            query = self.rfile.read(length)
+        return dict((k, v[-1]) for k, v in
+                    urlparse.parse_qs(query, keep_blank_values=True).items())
+
+    def _send_output(self, path) :
+        state = self.server.state
+        job_id = path[len('/output/'):].split('.')[0]
+        if job_id not in state.jobs :
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        size = state.output_size
+        ranged = (self.headers.getheader('Range') or '').strip()
+        if ranged.startswith('bytes=') :
+            start = int(ranged[len('bytes='):].split('-')[0])
+            if start >= size :
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' %size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                            'bytes %d-%d/%d' %(start, size - 1, size))
+        else :
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        for chunk in state.output_bytes(job_id, start, size) :
+            self.wfile.write(chunk)
+
+    def _dispatch(self) :
+        path = urlparse.urlparse(self.path).path
+        if self.command == 'GET' and path.startswith('/output/') :
+            return self._send_output(path)
+        arguments = self._arguments()
+        if self.server.slots is not None :
+            with self.server.slots :
+                code, response = self.server.state.handle(self.command,
+                                                        path, arguments)
+        else :
+            code, response = self.server.state.handle(self.command, path,
+                                                    arguments)
+        body = json.dumps(response) if response is not None else ''
+        etag = None
+        if self.command == 'GET' and code == 200 :
+            etag = '"%s"' %hashlib.md5(body).hexdigest()
+            if self.headers.getheader('If-None-Match') == etag :
+                code, body = 304, ''
+        self.send_response(code)
+        if etag :
+            self.send_header('ETag', etag)
+        if code in (429, 503) and self.server.state.retry_after is not None :
+            self.send_header('Retry-After', str(self.server.state.retry_after))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer) :
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StubGateway(object) :
+    """Runs the stub gateway on a background thread.
+
+    With capacity, at most that many API calls are served at once, like a
+    gateway with a fixed number of workers. Stubs given the state of
+    another one act as replicas of the same gateway. See StubState for
+    the other options.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, job_duration=0,
+                output_size=1024 * 1024, error_rate=0.0, error_status=503,
+                retry_after=None, latency=0.0, latency_jitter=0.0,
+                job_states=None, job_failure_rate=0.0, capacity=0,
+                state=None, bulk=False) :
+        self.server = StubServer((host, port), StubHandler)
+        self.server.slots = (threading.Semaphore(capacity) if capacity
+                            else None)
+        if state is None :
+            state = StubState(job_duration, output_size, error_rate,
+                            error_status, retry_after, latency,
+                            latency_jitter, job_states, job_failure_rate,
+                            bulk)
+            state.base_url = self.url
+        self.server.state = state
+        self.thread = None
+
+    @property
+    def url(self) :
+        return 'http://%s:%d/' %self.server.server_address
+
+    @property
+    def state(self) :
+        return self.server.state
+
+    def start(self) :
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self) :
+        self.server.shutdown()
+        self.server.server_close()
+
+def parse_job_states(spec) :
+    """Parses 'QUEUED:1,RUNNING:5,FINISHED' into [(state, seconds), ...]"""
+
+    states = []
+    for item in spec.split(',') :
+        state, _, seconds = item.strip().partition(':')
+        states.append((state, float(seconds or 0)))
+    return states
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1',
+        help="Interface to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8000,
+        help="Port to listen on")
+    parser.add_argument("--job-duration", type=float, default=0,
+        help="Seconds a job takes to go from QUEUED to FINISHED")
+    parser.add_argument("--output-size", type=int, default=1024 * 1024,
+        help="Size in bytes of every job output archive")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+        help="Share (0-1) of API calls failing with --error-status")
+    parser.add_argument("--error-status", type=int, default=503,
+        help="HTTP status of injected failures")
+    parser.add_argument("--retry-after", type=int,
+        help="Retry-After seconds sent with injected 429/503 failures")
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="Seconds every API call takes")
+    parser.add_argument("--latency-jitter", type=float, default=0.0,
+        help="Seconds added to or taken from --latency at random")
+    parser.add_argument("--job-states",
+        help="Job state machine as 'STATE:seconds,...,FINAL_STATE', "
+            "e.g. 'QUEUED:1,RUNNING:5,FINISHED'. Overrides --job-duration")
+    parser.add_argument("--job-failure-rate", type=float, default=0.0,
+        help="Share (0-1) of jobs ending in FAILED")
+    parser.add_argument("--capacity", type=int, default=0,
+        help="Largest number of API calls served at once, 0 for no limit")
+    parser.add_argument("--bulk", action="store_true",
+        help="Accept bulk job submissions on POST /jobs")
+    args = parser.parse_args()
+
+    job_states = parse_job_states(args.job_states) if args.job_states else None
+    stub = StubGateway(args.host, args.port, args.job_duration,
+                        args.output_size, args.error_rate,
+                        args.error_status, args.retry_after, args.latency,
+                        args.latency_jitter, job_states,
+                        args.job_failure_rate, args.capacity,
+                        bulk=args.bulk)
+    print stub.url
+    try :
+        stub.server.serve_forever()
+    except KeyboardInterrupt :
+        stub.server.server_close()
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,290 @@
+"""
+Parameter sweeps streamed as job configs
+
+A sweep file gives the values of each swept parameter, and how the
+parameter space is covered:
+
+    {
+        "sampling" : "grid",
+        "parameters" : {
+            "param0" : {"range" : [50, 1000, 50]},
+            "param1" : ["50", "500", "1000"],
+            "param2" : {"min" : 1, "max" : 100, "type" : "integer"}
+        }
+    }
+
+    list                    the values to use, in order
+    {"values" : [...]}      same as a list
+    {"range" : [start, stop, step]}
+                            start, start + step, ... up to stop (included)
+    {"min" : a, "max" : b, "step" : s}
+                            same as a range; without a step, grid sweeps
+                            use a step of 1 and sampled sweeps draw from
+                            the whole interval
+    "type"                  "integer" (default when the bounds are
+                            integers) or "float"
+
+"sampling" is "grid" (the Cartesian product, the default), "random"
+(independent uniform draws) or "lhs" (a Latin hypercube: every parameter's
+interval is cut in "samples" strata, each used exactly once). Sampled
+sweeps need "samples" and take an optional "seed".
+
+Configs are computed from their index alone, so nothing is materialized:
+a sweep of a million points streams in constant memory, and shard i of N
+(indexes i, i + N, i + 2N, ...) gives every launcher process or host its
+own disjoint part of the same sweep:
+
+    ./cg_job.py launch-batch --jobname My_Sweep -cf jobconfig.json \\
+        --sweep sweep.json --shard 0/4
+"""
+
+import json
+import random
+import decimal
+import logging
+from fractions import gcd
+
+logger = logging.getLogger(__name__)
+
+SAMPLINGS = ('grid', 'random', 'lhs')
+
+class SweepError(ValueError) :
+    """Raised for an invalid sweep specification"""
+
+def _decimals(value) :
+    """Number of decimal places of value as written, e.g. 2 for 0.05"""
+    return max(-decimal.Decimal(repr(float(value))).as_tuple().exponent, 0)
+
+def _format(value, integer, decimals=None) :
+    if integer :
+        return str(int(round(value)))
+    if decimals is not None :
+        # start + i * step carries binary rounding errors, e.g.
+        # 0.1 + 2 * 0.1 == 0.30000000000000004; the values of a range have
+        # no more decimal places than its start and step.
+        value = round(value, decimals)
+    return repr(float(value))
+
+class ValuesAxis(object) :
+    """Parameter taking the values of a list"""
+
+    def __init__(self, values) :
+        if not values :
+            raise SweepError('Empty list of values')
+        self.values = [v if isinstance(v, basestring) else str(v)
+                        for v in values]
+
+    def __len__(self) :
+        return len(self.values)
+
+    def at(self, position) :
+        return self.values[position]
+
+    def sample(self, u) :
+        """Value at fraction u (0 <= u < 1) of the axis"""
+        return self.values[min(int(u * len(self.values)),
+                                len(self.values) - 1)]
+
+class RangeAxis(object) :
+    """Parameter taking evenly spaced values, computed when needed"""
+
+    def __init__(self, start, stop, step=None, integer=None) :
+        if integer is None :
+            integer = all(isinstance(v, (int, long)) for v in
+                            (start, stop, step if step else 1))
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.integer = integer
+        self.decimals = max(_decimals(start), _decimals(step or 1))
+        if stop < start :
+            raise SweepError('Range stop %s is below start %s'
+                            %(stop, start))
+        if step is not None and step <= 0 :
+            raise SweepError('Range step must be positive, not %s' %step)
+
+    def __len__(self) :
+        step = self.step or 1
+        # The small tolerance keeps a stop hit by float steps included.
+        return int((self.stop - self.start) / float(step) + 1e-9) + 1
+
+    def at(self, position) :
+        return _format(self.start + position * (self.step or 1),
+                        self.integer, self.decimals)
+
+    def sample(self, u) :
+        if self.step :
+            return self.at(min(int(u * len(self)), len(self) - 1))
+        if self.integer :
+            return str(min(int(self.start + u * (self.stop - self.start + 1)),
+                            self.stop))
+        return _format(self.start + u * (self.stop - self.start), False)
+
+def _range_axis(name, start, stop, step, integer) :
+    for bound in (start, stop, step) :
+        if (bound is not None and (isinstance(bound, bool) or
+                not isinstance(bound, (int, long, float)))) :
+            raise SweepError("Parameter '%s': range bounds must be numbers"
+                            %name)
+    return RangeAxis(start, stop, step, integer)
+
+def parse_axis(name, spec) :
+    """Returns the axis of one parameter of a sweep file"""
+
+    if isinstance(spec, list) :
+        return ValuesAxis(spec)
+    if not isinstance(spec, dict) :
+        raise SweepError("Parameter '%s': expected a list or an object"
+                        %name)
+
+    integer = None
+    if 'type' in spec :
+        if spec['type'] not in ('integer', 'float') :
+            raise SweepError("Parameter '%s': unknown type '%s'"
+                            %(name, spec['type']))
+        integer = spec['type'] == 'integer'
+    if 'values' in spec :
+        return ValuesAxis(spec['values'])
+    if 'range' in spec :
+        bounds = list(spec['range']) + [None]
+        if len(bounds) < 3 :
+            raise SweepError("Parameter '%s': range needs start and stop"
+                            %name)
+        return _range_axis(name, bounds[0], bounds[1], bounds[2], integer)
+    if 'min' in spec and 'max' in spec :
+        return _range_axis(name, spec['min'], spec['max'], spec.get('step'),
+                            integer)
+    raise SweepError("Parameter '%s': needs values, range or min/max" %name)
+
+class Sweep(object) :
+    """Lazy sequence of the job configs of a sweep.
+
+    Args:
+        axes (dict): parameter name to ValuesAxis/RangeAxis
+        base (dict, optional): job config every point is applied to
+        sampling (string, optional): 'grid', 'random' or 'lhs'
+        samples (int, optional): number of points of a sampled sweep
+        seed (int, optional): seed of a sampled sweep
+    """
+
+    def __init__(self, axes, base=None, sampling='grid', samples=None,
+                seed=0) :
+        if sampling not in SAMPLINGS :
+            raise SweepError("Unknown sampling '%s', expected one of %s"
+                            %(sampling, ', '.join(SAMPLINGS)))
+        if sampling != 'grid' and not samples :
+            raise SweepError("'%s' sampling needs a number of samples"
+                            %sampling)
+        self.names = sorted(axes)
+        self.axes = [axes[name] for name in self.names]
+        self.base = base or {}
+        self.sampling = sampling
+        self.seed = seed
+
+        if sampling == 'grid' :
+            self.size = 1
+            for axis in self.axes :
+                self.size *= len(axis)
+        else :
+            self.size = int(samples)
+
+        if sampling == 'lhs' :
+            # Stratum of point i on each axis is (a * i + b) mod size, a
+            # permutation of the strata that needs no memory to store.
+            rng = random.Random(seed)
+            self.permutations = []
+            for axis in self.axes :
+                a = rng.randrange(1, max(self.size, 2))
+                while gcd(a, self.size) != 1 :
+                    a = rng.randrange(1, self.size)
+                self.permutations.append((a, rng.randrange(self.size)))
+
+    def __len__(self) :
+        return self.size
+
+    def point(self, index) :
+        """Returns the swept parameter values of point index"""
+
+        if not 0 <= index < self.size :
+            raise IndexError('Sweep index %d out of range' %index)
+        if self.sampling == 'grid' :
+            values = []
+            for axis in reversed(self.axes) :
+                index, position = divmod(index, len(axis))
+                values.append(axis.at(position))
+            values.reverse()
+        else :
+            rng = random.Random(self.seed * 1000003 + index)
+            if self.sampling == 'random' :
+                values = [axis.sample(rng.random()) for axis in self.axes]
+            else :
+                size = float(self.size)
+                values = [axis.sample(((a * index + b) % self.size +
+                                        rng.random()) / size)
+                            for axis, (a, b) in zip(self.axes,
+                                                    self.permutations)]
+        return dict(zip(self.names, values))
+
+    def config(self, index) :
+        """Returns the job config of point index"""
+
+        config = dict(self.base)
+        config['parameters'] = dict(self.base.get('parameters', {}))
+        config['parameters'].update(self.point(index))
+        return config
+
+    def indexes(self, shard=0, shards=1) :
+        """Indexes of the points of shard (0 <= shard < shards)"""
+
+        if not 0 <= shard < shards :
+            raise SweepError('Shard %d out of range for %d shards'
+                            %(shard, shards))
+        return xrange(shard, self.size, shards)
+
+    def configs(self, shard=0, shards=1) :
+        """Yields the job configs of shard, in index order"""
+
+        for index in self.indexes(shard, shards) :
+            yield self.config(index)
+
+def load_sweep(spec, base=None) :
+    """Returns the Sweep of a sweep specification.
+
+    Args:
+        spec (dict): contents of a sweep file
+        base (dict, optional): job config the sweep is applied to,
+                                overrides the file's "base"
+
+    Raises:
+        SweepError if the specification is invalid.
+    """
+
+    parameters = spec.get('parameters')
+    if not parameters or not isinstance(parameters, dict) :
+        raise SweepError('Sweep has no parameters')
+    axes = dict((name, parse_axis(name, value))
+                for name, value in parameters.items())
+    sweep = Sweep(axes, base if base is not None else spec.get('base'),
+                spec.get('sampling', 'grid'), spec.get('samples'),
+                spec.get('seed', 0))
+    logger.debug('Sweep of %d points over %s (%s)'
+                %(len(sweep), ', '.join(sweep.names), sweep.sampling))
+    return sweep
+
+def read_sweep(filename, base=None) :
+    """Returns the Sweep of a sweep file in JSON format"""
+
+    with open(filename) as f :
+        return load_sweep(json.load(f), base)
+
+def parse_shard(text) :
+    """Returns (shard, shards) from 'i/N', e.g. '0/4'"""
+
+    try :
+        shard, shards = [int(part) for part in text.split('/')]
+    except ValueError :
+        raise SweepError("Shard must be given as 'i/N', not '%s'" %text)
+    if not 0 <= shard < shards :
+        raise SweepError('Shard %d out of range for %d shards'
+                        %(shard, shards))
+    return (shard, shards)
@@ -45,18 +45,18 @@ Print debug info to stderr:
     Append the flag "--debug" or "-d" :
         ./cg_token.py --debug
 """
-import sys, os, getpass
+import sys, os
 import json
 import logging
-import requests
 import argparse
-from requests import exceptions as rex
-
-# This is used sed to disable InsecureRequestWarning.
-requests.packages.urllib3.disable_warnings()
+import time
+import cg_metrics
 
 logger = logging.getLogger(__name__)
 
+# Longest request/response body (in characters) written to the debug log.
+MAX_LOGGED_BODY = int(os.getenv('CG_LOG_BODY_MAX', 4096))
+
 class CGException(Exception) :
 
     def __init__(self, result) :
@@ -69,31 +69,45 @@ def logger_initialize(debug) :
     """Initializes the format and level for the logger"""
 
     _format = ("%(levelname)s - %(asctime)s\n%(message)s\n")
-    if debug :
-        logging.basicConfig(format=_format,
-                            level=logging.DEBUG)
-    else :
-        logging.basicConfig(format=_format,
-                            level=logging.WARNING)
+    level = logging.DEBUG if debug else logging.WARNING
+    logging.basicConfig(format=_format, level=level)
+    # basicConfig only applies once per process; later calls (e.g. from
+    # the cg shell) still switch the level.
+    logging.getLogger().setLevel(level)
+
+def _format_body(body) :
+    """Pretty-prints a request/response body, truncated to MAX_LOGGED_BODY"""
+
+    text = json.dumps(body, indent=4, separators=(',',': '), default=str)
+    if len(text) > MAX_LOGGED_BODY :
+        text = ('%s\n... (%d more characters)'
+                %(text[:MAX_LOGGED_BODY], len(text) - MAX_LOGGED_BODY))
+    return text
 
 def log_response(method, url, response, request) :
-    """Logs request and response when in debug mode"""
-    
+    """Logs request and response when in debug mode
+
+    Nothing is formatted unless the logger is enabled for DEBUG, and the
+    password is masked on a copy so the caller's request is left intact.
+    """
+
+    if not logger.isEnabledFor(logging.DEBUG) :
+        return
+
     if request.get('password', '') :
-        request['password'] = '*******'
-    logger.debug("URL: " + url)
-    logger.debug("Request: " + method)
-    logger.debug("Request Data (in JSON format)"
-        ": " + json.dumps(request,indent=4,separators=(',',': ')))
-    logger.debug("Response (in JSON format)"
-        ": " + json.dumps(response,indent=4,separators=(',',': ')))
-
-def parse_args() :
+        request = dict(request, password='*******')
+    logger.debug("URL: %s", url)
+    logger.debug("Request: %s", method)
+    logger.debug("Request Data (in JSON format): %s", _format_body(request))
+    logger.debug("Response (in JSON format): %s", _format_body(response))
+
+def parse_args(argv=None) :
     """Defines command line positional and optional arguments and checks
         for valid action input if present. Additionally prompts with getpass
         if user specifies "--password -" to override CG_PASSWORD
     
-    Args: none
+    Args:
+        argv (list, optional): arguments to parse instead of sys.argv
 
     Returns: A (tuple) containing the following:
         args (namespace) : used to overwrite env variables when necessary
@@ -134,17 +148,19 @@ def parse_args() :
     parser.add_argument("action", nargs='?', type=str, default='issue',
         help='issue/verify/revoke')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     logger_initialize(args.debug)
 
     if args.password and args.password == '-' : 
+        import getpass
         args.password = getpass.getpass("Enter desired CG Password: ")
 
     if not args.endpoint :    
         logger.error('CG_API (API url for REST calls) '
                 'not specified\n')
         sys.exit(1)
+    args.endpoint = resolve_endpoint(args.endpoint)
 
     if args.action.lower() not in ['issue','verify','revoke'] :
         logger.error('Invalid Action')
@@ -152,13 +168,27 @@ def parse_args() :
 
     return (args,args.action.lower())
 
+def resolve_endpoint(endpoint) :
+    """Returns endpoint, or the virtual endpoint balancing calls over the
+    replicas of a comma separated list of endpoints (see cg_balance)"""
+
+    if ',' not in endpoint :
+        return endpoint
+    import cg_balance
+    return cg_balance.resolve(endpoint)
+
 def cg_rest(method, endpoint, headers={}, **kwargs) :
     """Calls the CG REST endpoint passing keyword arguments given.
 
     'cg_rest' provides a basic wrapper around the HTTP request to
     the rest endpoint, and attempts to provide informative error
     messages when errors occur. Exceptions are passed to the calling
-    function for final resolution.
+    function for final resolution. Requests are sent over the shared,
+    pooled session from cg_session so connections are kept alive, and
+    are retried (or failed fast while the endpoint is down) as decided by
+    cg_retry. Every attempt first waits for the endpoint's rate limit
+    (see cg_ratelimit). Calls are reported to the listeners of cg_metrics,
+    if any.
     
         cg_rest('POST', <url>, headers=<HTTP headers dict>, username=<username>, 
 password=<password>, ...)
@@ -182,37 +212,113 @@ password=<password>, ...)
     
     Raises:
         Raises CGException when the gateway server return an error status.
+        Raises cg_retry.CircuitOpenError while the endpoint's circuit is open.
         Other exceptions may be raised based errors with the HTTP request
         and response. See documentation of Python's request module for
         a complete list.
     """ 
+    r = cg_request(method, endpoint, headers, **kwargs)
+    return decode_response(method, endpoint, r, kwargs)
+
+def cg_request(method, endpoint, headers={}, **kwargs) :
+    """Sends one REST call like cg_rest, but returns the raw
+    requests.Response without decoding it.
+
+    Used by callers that need the HTTP status or headers, e.g. for
+    conditional requests. Pass the response to decode_response to get what
+    cg_rest would have returned.
+
+    Raises:
+        Same as cg_rest, except CGException.
+    """
+
+    # Imported on the first call, so that '--help' and argument errors
+    # exit without loading requests.
+    import cg_session
+    import cg_retry
+    import cg_ratelimit
+    from requests import exceptions as rex
+
+    method = method.upper()
+    if method == 'POST' or method == 'PUT' :
+        body = {'data' : kwargs}
+    else : # Must be 'GET' or 'DELETE'
+        body = {'params' : kwargs}
+
+    call = cg_metrics.start(method, endpoint) if cg_metrics.listeners else None
+
+    def send() :
+        if call is None :
+            cg_ratelimit.acquire(endpoint)
+            return cg_session.request(method, endpoint, headers=headers,
+                                    **body)
+
+        queued = time.time()
+        cg_ratelimit.acquire(endpoint)
+        sent = time.time()
+        call.add('queue', sent - queued)
+        call.attempts += 1
+        handshake = call.phases.get('connect', 0) + call.phases.get('tls', 0)
+        r = cg_session.request(method, endpoint, headers=headers, **body)
+        handshake = (call.phases.get('connect', 0) +
+                    call.phases.get('tls', 0) - handshake)
+        cg_metrics.record_response(call, r, time.time() - sent, handshake)
+        return r
+
     try :
-        if method.upper() == 'POST' or method.upper() == 'PUT' :
-            r = requests.request(method.upper(), endpoint, timeout=50, 
-                                verify=False, headers=headers, data=kwargs)
-        else : # Must be 'GET' or 'DELETE'
-            r = requests.request(method.upper(), endpoint, timeout=50,
-                                verify=False, headers=headers, params=kwargs)
+        r = cg_retry.call(method, endpoint, send)
         r.raise_for_status()
     
     except (rex.ConnectionError, rex.HTTPError, rex.MissingSchema) as e :
         logger.debug("Problem with API endpoint '%s', "
-                "is it entered correctly?" %endpoint)
+                "is it entered correctly?", endpoint)
+        cg_metrics.error(call, e)
         raise
 
     except (rex.Timeout) as e :
         logger.debug('Request timed out, the service may be '
                     'temporarily unavailable')
+        cg_metrics.error(call, e)
+        raise
+
+    except Exception as e :
+        cg_metrics.error(call, e)
         raise
 
-    response = r.json()
-    log_response(method, endpoint, response, kwargs)
+    if call is not None :
+        cg_metrics.detach(call)
+        r.cg_call = call
+    return r
+
+def decode_response(method, endpoint, r, request) :
+    """Decodes the JSON envelope of a response from cg_request.
+
+    Returns:
+        (dict): the decoded response
+
+    Raises:
+        Raises CGException when the gateway server return an error status.
+    """
+
+    call = getattr(r, 'cg_call', None)
+    decoding = time.time() if call is not None else 0
+    try :
+        response = r.json()
+    except ValueError as e :
+        cg_metrics.error(call, e)
+        raise
+    if call is not None :
+        call.add('decode', time.time() - decoding)
+    log_response(method, endpoint, response, request)
 
     # If status is not provided, default to error.
     if response.get('status','') and response.get('status','') == 'error' :
-        logger.debug("Call fails with '%s'" %response['result']['message'])
-        raise CGException(response['result'])
+        logger.debug("Call fails with '%s'", response['result']['message'])
+        e = CGException(response['result'])
+        cg_metrics.error(call, e)
+        raise e
 
+    cg_metrics.end(call)
     return response
 
 def issue_token(endpoint, username, password, lifetime, binding) :
@@ -306,8 +412,12 @@ def revoke_token(endpoint, username, password, token) :
 
     response = cg_rest('DELETE', url, **params)
 
-def main() :
-    (args, action) = parse_args()
+    # Cached verifications (see cg_verify) must not outlive the token.
+    import cg_verify
+    cg_verify.invalidate_token(token)
+
+def main(argv=None) :
+    (args, action) = parse_args(argv)
     
     try :
         if action == "issue" :
@@ -317,8 +427,10 @@ def main() :
                                 "\nBinding must be 0 or 1")
                 sys.exit(1)
 
-            print issue_token(args.endpoint, args.username, args.password,
+            token = issue_token(args.endpoint, args.username, args.password,
                                 args.lifetime, args.binding)
+            print token
+            return token
 
         else :
             if not args.token :
@@ -326,8 +438,10 @@ def main() :
                 sys.exit(1)
 
             if action == "verify" :
-                print verify_token(args.endpoint, args.username, 
+                lifetime = verify_token(args.endpoint, args.username,
                                     args.token, args.clientid, args.clientip)
+                print lifetime
+                return lifetime
 
             else :
                 revoke_token(args.endpoint, args.username, 
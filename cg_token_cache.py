@@ -0,0 +1,237 @@
+"""
+Token manager that caches a CG token and refreshes it before it expires
+
+Instead of issuing a token up front and passing it around in CG_TOKEN,
+callers ask a TokenManager for the current token. The token and its
+expiry time are kept in memory and, optionally, in an on-disk cache shared
+by every process of the same user (guarded by a file lock). A token is only
+issued when no cached token has more than refresh_margin seconds left, and
+a background timer can replace it before that happens:
+
+    from cg_token_cache import TokenManager
+
+    tokens = TokenManager(endpoint, username, password,
+                        cache_file='~/.cg_token_cache')
+    token = tokens.get_token()
+    ...
+    print tokens.stats()
+
+The cg_app and cg_job utilities fall back to the cache when no CG_TOKEN is
+given, using CG_USERNAME/CG_PASSWORD and the cache file in CG_TOKEN_CACHE
+(default ~/.cg_token_cache).
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from cg_token import issue_token, verify_token
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.getenv('CG_TOKEN_CACHE', '~/.cg_token_cache')
+DEFAULT_LIFETIME = 43200
+DEFAULT_REFRESH_MARGIN = 300
+
+# Seconds before a failed background refresh is tried again, doubled on
+# each failure in a row up to RETRY_MAX
+RETRY_MIN = 5
+RETRY_MAX = 300
+
+class TokenFileCache(object) :
+    """Tokens stored as JSON in a file, read and written under an
+    exclusive lock on '<path>.lock'"""
+
+    def __init__(self, path) :
+        self.path = os.path.expanduser(path)
+
+    def _locked(self) :
+        lock = open(self.path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _read(self) :
+        try :
+            with open(self.path) as f :
+                return json.load(f)
+        except (IOError, ValueError) :
+            return {}
+
+    def load(self, key) :
+        """Returns the (token, expires) stored for key, or (None, 0)"""
+
+        lock = self._locked()
+        try :
+            entry = self._read().get(key)
+        finally :
+            lock.close()
+        if not entry :
+            return (None, 0)
+        return (entry['token'], entry['expires'])
+
+    def store(self, key, token, expires) :
+        lock = self._locked()
+        try :
+            entries = self._read()
+            now = time.time()
+            for name in [k for k, v in entries.items()
+                        if v['expires'] <= now] :
+                del entries[name]
+            entries[key] = {'token' : token, 'expires' : expires}
+            fd = os.open(self.path + '.tmp',
+                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f :
+                json.dump(entries, f)
+            os.rename(self.path + '.tmp', self.path)
+        finally :
+            lock.close()
+
+class TokenManager(object) :
+    """Issues, caches and refreshes the token of one user on one endpoint.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        username (string): the user's login
+        password (string): the user's password
+        lifetime (int, optional): lifetime of issued tokens in seconds
+        binding (int, optional): 1 to bind tokens to the user IP, 0 else
+        cache_file (string, path, optional): on-disk cache shared by processes
+        refresh_margin (int, optional): tokens with fewer seconds left than
+                                        this are replaced
+        background (bool, optional): refresh the token on a timer thread
+                                    before it reaches refresh_margin
+    """
+
+    def __init__(self, endpoint, username, password,
+                lifetime=DEFAULT_LIFETIME, binding=1, cache_file=None,
+                refresh_margin=DEFAULT_REFRESH_MARGIN, background=False) :
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.lifetime = lifetime
+        self.binding = binding
+        self.refresh_margin = min(refresh_margin, lifetime / 2)
+        self.background = background
+        self.file_cache = TokenFileCache(cache_file) if cache_file else None
+        self.key = '%s|%s' %(endpoint.rstrip('/'), username)
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires = 0
+        self.timer = None
+        self.closed = False
+        self.refresh_errors = 0
+        self.counters = {'requests' : 0, 'hits' : 0, 'file_hits' : 0,
+                        'issued' : 0, 'refreshes' : 0,
+                        'refresh_failures' : 0}
+
+    def _fresh(self, expires) :
+        return expires - time.time() > self.refresh_margin
+
+    def _issue(self) :
+        token = issue_token(self.endpoint, self.username, self.password,
+                            self.lifetime, self.binding)
+        self.counters['issued'] += 1
+        expires = time.time() + self.lifetime
+        try :
+            # The server may grant less than requested; trust its answer.
+            expires = time.time() + verify_token(self.endpoint,
+                                    self.username, token, '', '')
+        except Exception as e :
+            logger.debug('Could not verify new token lifetime: %s' %e)
+        if self.file_cache :
+            self.file_cache.store(self.key, token, expires)
+        return (token, expires)
+
+    def _set(self, token, expires) :
+        self.token = token
+        self.expires = expires
+        logger.debug('Token for %s valid for %d more seconds'
+                    %(self.key, expires - time.time()))
+        if self.background :
+            self._schedule()
+
+    def _schedule(self, delay=None) :
+        if self.timer :
+            self.timer.cancel()
+        if self.closed :
+            return
+        if delay is None :
+            delay = max(self.expires - time.time() - self.refresh_margin, 0)
+        self.timer = threading.Timer(delay, self.refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def get_token(self) :
+        """Returns a token with more than refresh_margin seconds left,
+        issuing a new one only when no cached token qualifies.
+
+        Raises:
+            Passes any exceptions raised in cg_rest.
+        """
+
+        with self.lock :
+            self.counters['requests'] += 1
+            if self.token and self._fresh(self.expires) :
+                self.counters['hits'] += 1
+                return self.token
+
+            if self.file_cache :
+                token, expires = self.file_cache.load(self.key)
+                if token and self._fresh(expires) :
+                    self.counters['file_hits'] += 1
+                    self._set(token, expires)
+                    return token
+
+            self._set(*self._issue())
+            return self.token
+
+    def refresh(self) :
+        """Replaces the current token with a newly issued one. When that
+        fails, a background refresh is tried again after a backoff."""
+
+        with self.lock :
+            try :
+                self._set(*self._issue())
+                self.counters['refreshes'] += 1
+                self.refresh_errors = 0
+            except Exception as e :
+                self.counters['refresh_failures'] += 1
+                self.refresh_errors += 1
+                delay = min(RETRY_MIN * 2 ** (self.refresh_errors - 1),
+                            RETRY_MAX)
+                logger.warning('Background token refresh failed, retrying '
+                                'in %d seconds: %s' %(delay, e))
+                if self.background :
+                    self._schedule(delay)
+
+    def close(self) :
+        """Stops the background refresh timer"""
+
+        with self.lock :
+            self.closed = True
+            if self.timer :
+                self.timer.cancel()
+
+    def stats(self) :
+        """Returns the cache counters, with 'hit_rate' (share of requests
+        served from memory or file) and 'issues_avoided'"""
+
+        stats = dict(self.counters)
+        served = stats['hits'] + stats['file_hits']
+        stats['issues_avoided'] = served
+        stats['hit_rate'] = (float(served) / stats['requests']
+                            if stats['requests'] else 0.0)
+        return stats
+
+def cached_token(endpoint, username, password=None) :
+    """Returns a token from the on-disk cache in CG_TOKEN_CACHE, issuing one
+    with CG_PASSWORD if needed. Returns '' when no password is available."""
+
+    password = password or os.getenv('CG_PASSWORD', '')
+    if not (username and password) :
+        return ''
+    manager = TokenManager(endpoint, username, password,
+                            cache_file=DEFAULT_CACHE_FILE)
+    return manager.get_token()
@@ -0,0 +1,224 @@
+"""
+Client-side validation of job configs against an app's parameter schema
+
+The 'parameters' of an app configuration (see appconfig.json) describe
+each job parameter: its datatype, min/max, whether it is optional and
+whether its value is fixed. compile_schema turns them into one check
+function per parameter once, so validating a job config afterwards costs
+a few comparisons per parameter and no gateway call:
+
+    import cg_validate
+    validator = cg_validate.fetch_validator(endpoint, 'My_App', token)
+    for violation in validator.validate_batch(configs) :
+        print violation
+
+Configs that break the schema are caught before they are submitted,
+instead of failing after a round trip and a wait in the gateway queue.
+"""
+
+import urlparse
+import itertools
+import logging
+from cg_app import fetch_app_config
+
+logger = logging.getLogger(__name__)
+
+class Violation(object) :
+    """One way a job config breaks the schema.
+
+    Attributes:
+        index (int): position of the config in the batch
+        parameter (string): name of the offending parameter, or None
+        message (string): what is wrong
+    """
+
+    __slots__ = ('index', 'parameter', 'message')
+
+    def __init__(self, index, parameter, message) :
+        self.index = index
+        self.parameter = parameter
+        self.message = message
+
+    def __str__(self) :
+        if self.parameter is None :
+            return 'Job config %d: %s' %(self.index, self.message)
+        return ("Job config %d: parameter '%s' %s"
+                %(self.index, self.parameter, self.message))
+
+    __repr__ = __str__
+
+def _number(text) :
+    try :
+        return float(text)
+    except (TypeError, ValueError) :
+        return None
+
+def _parse_integer(value) :
+    if isinstance(value, bool) :
+        raise ValueError(value)
+    if isinstance(value, float) and value != int(value) :
+        raise ValueError(value)
+    return int(value)
+
+def _parse_float(value) :
+    if isinstance(value, bool) :
+        raise ValueError(value)
+    return float(value)
+
+def _parse_url(value) :
+    parts = urlparse.urlparse(value)
+    if not parts.scheme or not (parts.netloc or parts.scheme == 'file') :
+        raise ValueError(value)
+    return value
+
+def _parse_string(value) :
+    if not isinstance(value, basestring) :
+        raise ValueError(value)
+    return value
+
+# Parser of each datatype, raising ValueError (or TypeError) on bad values.
+PARSERS = {
+    'integer' : (_parse_integer, 'an integer'),
+    'int' : (_parse_integer, 'an integer'),
+    'float' : (_parse_float, 'a number'),
+    'double' : (_parse_float, 'a number'),
+    'number' : (_parse_float, 'a number'),
+    'url' : (_parse_url, 'a URL'),
+    'string' : (_parse_string, 'a string'),
+}
+
+def compile_parameter(name, schema) :
+    """Returns a function of a parameter value giving an error message, or
+    None when the value is valid.
+
+    Args:
+        name (string): the parameter name
+        schema (dict): the parameter's entry in the app configuration
+    """
+
+    fixed = schema.get('fixed')
+    if fixed not in (None, '') :
+        def check(value) :
+            if value != fixed and str(value) != fixed :
+                return "must be '%s', not '%s'" %(fixed, value)
+        return check
+
+    parser, expected = PARSERS.get(str(schema.get('datatype', '')).lower(),
+                                    (None, None))
+    low = _number(schema.get('min'))
+    high = _number(schema.get('max'))
+    if parser is None :
+        return lambda value : None
+
+    if low is None and high is None :
+        def check(value) :
+            try :
+                parser(value)
+            except (TypeError, ValueError) :
+                return "must be %s, not '%s'" %(expected, value)
+        return check
+
+    low = float('-inf') if low is None else low
+    high = float('inf') if high is None else high
+    def check(value) :
+        try :
+            number = parser(value)
+        except (TypeError, ValueError) :
+            return "must be %s, not '%s'" %(expected, value)
+        if not low <= number <= high :
+            return ("must be between %s and %s, not '%s'"
+                    %(schema.get('min', '-inf'), schema.get('max', 'inf'),
+                    value))
+    return check
+
+class ConfigValidator(object) :
+    """Checks job configs against a compiled parameter schema.
+
+    Args:
+        parameters (dict): the 'parameters' of an app configuration,
+                            keyed by parameter name (a list of parameter
+                            entries with a 'name' is accepted too)
+    """
+
+    def __init__(self, parameters) :
+        if isinstance(parameters, list) :
+            parameters = dict((p['name'], p) for p in parameters)
+        self.checks = {}
+        self.required = []
+        for name, schema in sorted(parameters.items()) :
+            self.checks[name] = compile_parameter(name, schema)
+            optional = schema.get('optional', False)
+            if isinstance(optional, basestring) :
+                optional = optional.lower() in ('true', '1', 'yes')
+            # A fixed or defaulted parameter may be left out of a config.
+            if (not optional and schema.get('fixed') in (None, '') and
+                    schema.get('default') in (None, '')) :
+                self.required.append(name)
+
+    def check(self, config, index=0) :
+        """Returns the list of Violations of one job config"""
+
+        violations = []
+        if not isinstance(config, dict) :
+            return [Violation(index, None, 'is not a JSON object')]
+        values = config.get('parameters', {})
+        if not isinstance(values, dict) :
+            return [Violation(index, None, "'parameters' is not a JSON object")]
+
+        checks = self.checks
+        for name, value in values.iteritems() :
+            check = checks.get(name)
+            if check is None :
+                violations.append(Violation(index, name, 'is not a parameter '
+                                            'of the app'))
+                continue
+            message = check(value)
+            if message is not None :
+                violations.append(Violation(index, name, message))
+        for name in self.required :
+            if name not in values :
+                violations.append(Violation(index, name, 'is required'))
+        return violations
+
+    def validate_batch(self, configs, indexes=None) :
+        """Checks every config, returning all Violations at once (an empty
+        list when every config is valid). Violations are numbered with
+        indexes when given, else with the position of the config."""
+
+        if indexes is None :
+            items = enumerate(configs)
+        else :
+            items = itertools.izip(indexes, configs)
+        violations = []
+        for index, config in items :
+            violations.extend(self.check(config, index))
+        return violations
+
+def compile_schema(app_config) :
+    """Returns a ConfigValidator of an app configuration (the contents of
+    appconfig.json, or the 'result' of a Get App Configuration call)"""
+
+    return ConfigValidator(app_config.get('parameters', {}))
+
+_compiled = {}
+
+def fetch_validator(endpoint, appname, token) :
+    """Returns the ConfigValidator of a registered app.
+
+    The configuration comes from the app cache (see cg_cache), and is only
+    compiled again when the gateway returned a different configuration.
+
+    Raises:
+        Passes any exceptions raised in cg_rest.
+    """
+
+    response = fetch_app_config(endpoint, appname, token)
+    key = (endpoint.rstrip('/'), appname)
+    cached = _compiled.get(key)
+    if cached is not None and cached[0] is response :
+        return cached[1]
+    validator = compile_schema(response['result'])
+    _compiled[key] = (response, validator)
+    logger.debug("Compiled parameter schema of '%s' (%d parameters)"
+                %(appname, len(validator.checks)))
+    return validator
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+"""
+Cached and coalesced token verification for services that check the token
+of every incoming request
+
+cg_token.verify_token makes one PUT /token call per check. A TokenVerifier
+answers the same question from memory:
+
+    - concurrent verifications of the same token, consumer and client IP
+      are coalesced: one thread calls the gateway, the others wait for
+      its answer
+    - a valid token is trusted until its returned lifetime runs out, but
+      for at most max_ttl seconds, after which the gateway is asked again
+    - a rejected token is remembered for negative_ttl seconds
+    - revoke_token drops the token's verifications at once
+
+As a library, with the same arguments as cg_token.verify_token:
+
+    import cg_verify
+    lifetime = cg_verify.verify_token(endpoint, username, token,
+                                    client_id, client_ip)
+
+Or as a local HTTP sidecar answering PUT and DELETE /token like the
+gateway, so services only point their endpoint at it:
+
+    ./cg_verify.py --port 8125 --endpoint $CG_API
+    ./cg_token.py verify --endpoint http://127.0.0.1:8125/ ...
+
+GET /stats on the sidecar returns the counters of its verifier.
+
+Settings come from the bash environment:
+
+    CG_VERIFY_MAX_TTL       longest time (s) a valid token is trusted
+                            without asking the gateway (default 60)
+    CG_VERIFY_NEGATIVE_TTL  time (s) a rejected token is remembered
+                            (default 5)
+    CG_VERIFY_ENTRIES       largest number of cached verifications
+                            (default 100000)
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from collections import OrderedDict
+import cg_token
+from cg_token import CGException, logger_initialize, resolve_endpoint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_TTL = float(os.getenv('CG_VERIFY_MAX_TTL', 60))
+DEFAULT_NEGATIVE_TTL = float(os.getenv('CG_VERIFY_NEGATIVE_TTL', 5))
+DEFAULT_ENTRIES = int(os.getenv('CG_VERIFY_ENTRIES', 100000))
+
+class Verification(object) :
+    """Answer of the gateway for one token, consumer and client IP.
+
+    Attributes:
+        expires (float): time the answer stops being used
+        valid_until (float): time the token expires, for valid tokens
+        error (CGException): the rejection, for invalid tokens
+    """
+
+    __slots__ = ('expires', 'valid_until', 'error')
+
+    def __init__(self, expires, valid_until=None, error=None) :
+        self.expires = expires
+        self.valid_until = valid_until
+        self.error = error
+
+class Pending(object) :
+    """Verification in progress, awaited by concurrent duplicates"""
+
+    def __init__(self) :
+        self.done = threading.Event()
+        self.verification = None
+        self.error = None
+        self.revoked = False
+
+class TokenVerifier(object) :
+    """Verifies tokens against one gateway, caching and coalescing calls.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        max_ttl (float, optional): longest time (s) a valid token is
+                                    trusted without asking the gateway
+        negative_ttl (float, optional): time (s) a rejection is remembered
+        max_entries (int, optional): largest number of cached answers,
+                                    the least recently used go first
+    """
+
+    def __init__(self, endpoint, max_ttl=DEFAULT_MAX_TTL,
+                negative_ttl=DEFAULT_NEGATIVE_TTL,
+                max_entries=DEFAULT_ENTRIES) :
+        self.endpoint = endpoint
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.counters = {'hits' : 0, 'negative_hits' : 0, 'misses' : 0,
+                        'coalesced' : 0, 'invalidations' : 0,
+                        'evictions' : 0}
+
+    def _answer(self, verification, now) :
+        if verification.error is not None :
+            raise verification.error
+        return max(int(verification.valid_until - now), 0)
+
+    def _store(self, key, verification) :
+        self.entries.pop(key, None)
+        self.entries[key] = verification
+        while len(self.entries) > self.max_entries :
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def _call(self, username, token, client_id, client_ip) :
+        start = time.time()
+        try :
+            lifetime = cg_token.verify_token(self.endpoint, username, token,
+                                            client_id, client_ip)
+        except CGException as e :
+            return Verification(time.time() + self.negative_ttl, error=e)
+        # Count the lifetime from when the call was sent, to stay on the
+        # safe side of the gateway's clock.
+        valid_until = start + float(lifetime)
+        return Verification(min(valid_until, start + self.max_ttl),
+                            valid_until)
+
+    def verify(self, username, token, client_id, client_ip) :
+        """Returns the remaining lifetime of token (in seconds), like
+        cg_token.verify_token.
+
+        Raises:
+            CGException when the gateway rejected the token, possibly in
+            an earlier call. Passes any other exceptions raised in cg_rest,
+            which are not cached.
+        """
+
+        key = (token, username, client_id, client_ip)
+        with self.lock :
+            now = time.time()
+            verification = self.entries.get(key)
+            if verification is not None :
+                if now < verification.expires :
+                    self.entries[key] = self.entries.pop(key)
+                    if verification.error is not None :
+                        self.counters['negative_hits'] += 1
+                    else :
+                        self.counters['hits'] += 1
+                    return self._answer(verification, now)
+                del self.entries[key]
+            pending = self.pending.get(key)
+            owner = pending is None
+            if owner :
+                pending = self.pending[key] = Pending()
+                self.counters['misses'] += 1
+            else :
+                self.counters['coalesced'] += 1
+
+        if not owner :
+            pending.done.wait()
+            if pending.error is not None :
+                raise pending.error
+            return self._answer(pending.verification, time.time())
+
+        try :
+            pending.verification = self._call(username, token, client_id,
+                                                client_ip)
+        except Exception as e :
+            pending.error = e
+            raise
+        finally :
+            with self.lock :
+                del self.pending[key]
+                # A revocation during the call already dropped the token.
+                if pending.error is None and not pending.revoked :
+                    self._store(key, pending.verification)
+            pending.done.set()
+        return self._answer(pending.verification, time.time())
+
+    def invalidate(self, token) :
+        """Drops every cached answer about token"""
+
+        with self.lock :
+            for key in [k for k in self.entries if k[0] == token] :
+                del self.entries[key]
+                self.counters['invalidations'] += 1
+            for key, pending in self.pending.items() :
+                if key[0] == token :
+                    pending.revoked = True
+
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+
+    def stats(self) :
+        """Returns the counters, the number of entries and the share of
+        verifications answered without a gateway call"""
+
+        with self.lock :
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        checks = (stats['hits'] + stats['negative_hits'] +
+                    stats['coalesced'] + stats['misses'])
+        stats['hit_rate'] = ((checks - stats['misses']) / float(checks)
+                            if checks else 0.0)
+        return stats
+
+_verifiers = {}
+_verifiers_lock = threading.Lock()
+
+def get_verifier(endpoint) :
+    """Returns the TokenVerifier of endpoint shared by this process"""
+
+    key = endpoint.rstrip('/')
+    with _verifiers_lock :
+        verifier = _verifiers.get(key)
+        if verifier is None :
+            verifier = _verifiers[key] = TokenVerifier(endpoint)
+    return verifier
+
+def verify_token(endpoint, username, token, client_id, client_ip) :
+    """Cached cg_token.verify_token, see TokenVerifier.verify"""
+
+    return get_verifier(endpoint).verify(username, token, client_id,
+                                        client_ip)
+
+def invalidate_token(token) :
+    """Drops the cached answers about token of every verifier"""
+
+    with _verifiers_lock :
+        verifiers = _verifiers.values()
+    for verifier in verifiers :
+        verifier.invalidate(token)
+
+class SidecarHandler(BaseHTTPServer.BaseHTTPRequestHandler) :
+    """Answers PUT /token from the verifier, forwards DELETE /token to the
+    gateway, and writes the gateway's JSON envelope"""
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) :
+        logger.debug('%s - %s' %(self.address_string(), format %args))
+
+    def _arguments(self) :
+        query = urlparse.urlparse(self.path).query
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length :
+            query = self.rfile.read(length)
+        return dict((k, v[-1]) for k, v in
+                    urlparse.parse_qs(query, keep_blank_values=True).items())
+
+    def _send(self, code, response) :
+        body = json.dumps(response)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self) :
+        verifier = self.server.verifier
+        path = urlparse.urlparse(self.path).path.rstrip('/')
+        args = self._arguments()
+        try :
+            if path.endswith('/token') and self.command == 'PUT' :
+                lifetime = verifier.verify(args.get('username', ''),
+                                        args.get('token', ''),
+                                        args.get('consumer', ''),
+                                        args.get('remote_addr', ''))
+                result = {'lifetime' : lifetime}
+            elif path.endswith('/token') and self.command == 'DELETE' :
+                cg_token.revoke_token(verifier.endpoint,
+                                    args.get('username', ''),
+                                    args.get('password', ''),
+                                    args.get('token', ''))
+                verifier.invalidate(args.get('token', ''))
+                result = {}
+            elif path.endswith('/stats') and self.command == 'GET' :
+                result = verifier.stats()
+            else :
+                return self._send(404, {'status' : 'error', 'result' :
+                                        {'error_code' : 404,
+                                        'message' : 'Not found'}})
+        except CGException as e :
+            return self._send(200, {'status' : 'error', 'result' :
+                                    {'error_code' : e.error_code,
+                                    'message' : e.message}})
+        except Exception as e :
+            logger.warning('Gateway call failed: %s' %e)
+            return self._send(502, {'status' : 'error', 'result' :
+                                    {'error_code' : 502,
+                                    'message' : 'Gateway call failed: %s'
+                                                %e}})
+        self._send(200, {'status' : 'success', 'result' : result})
+
+    do_GET = do_PUT = do_DELETE = _dispatch
+
+class SidecarServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer) :
+    daemon_threads = True
+    allow_reuse_address = True
+
+class VerifySidecar(object) :
+    """Runs the verification sidecar of a gateway on a background thread"""
+
+    def __init__(self, endpoint, host='127.0.0.1', port=0, verifier=None) :
+        self.server = SidecarServer((host, port), SidecarHandler)
+        self.server.verifier = verifier or get_verifier(endpoint)
+        self.thread = None
+
+    @property
+    def url(self) :
+        return 'http://%s:%d/' %self.server.server_address
+
+    @property
+    def verifier(self) :
+        return self.server.verifier
+
+    def start(self) :
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self) :
+        self.server.shutdown()
+        self.server.server_close()
+
+def parse_args(argv=None) :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--debug",
+        action="store_true",
+        help='Allow debug info to be written to stderr')
+    parser.add_argument("-e", "--endpoint",
+        default=os.getenv('CG_API',''),
+        help="Set API url of the gateway")
+    parser.add_argument("--host",
+        default='127.0.0.1',
+        help="Interface to listen on")
+    parser.add_argument("-p", "--port",
+        type=int,
+        default=8125,
+        help="Port to listen on")
+    parser.add_argument("--max-ttl",
+        type=float,
+        default=DEFAULT_MAX_TTL,
+        help="Longest time (s) a valid token is trusted without asking "
+            "the gateway")
+    parser.add_argument("--negative-ttl",
+        type=float,
+        default=DEFAULT_NEGATIVE_TTL,
+        help="Time (s) a rejected token is remembered")
+    parser.add_argument("-w", "--workers",
+        type=int,
+        default=16,
+        help="Connections kept open to the gateway")
+
+    args = parser.parse_args(argv)
+
+    logger_initialize(args.debug)
+
+    if not args.endpoint :
+        logger.error('CG_API (API url for REST calls) '
+                    'not specified\n')
+        sys.exit(1)
+    args.endpoint = resolve_endpoint(args.endpoint)
+
+    return args
+
+def main(argv=None) :
+    args = parse_args(argv)
+
+    import cg_session
+    cg_session.configure_endpoint(args.endpoint, pool_size=args.workers)
+
+    verifier = TokenVerifier(args.endpoint, args.max_ttl, args.negative_ttl)
+    sidecar = VerifySidecar(args.endpoint, args.host, args.port, verifier)
+    print sidecar.url
+    sys.stdout.flush()
+    try :
+        sidecar.server.serve_forever()
+    except KeyboardInterrupt :
+        sidecar.server.server_close()
+
+if __name__ == '__main__' :
+    main()
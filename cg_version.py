@@ -7,22 +7,20 @@ Print Version:
 	./cg_version.py
 """
 
-from cg_token import CGException, cg_rest, logger_initialize
+from cg_token import (CGException, cg_rest, logger_initialize,
+                        resolve_endpoint)
 import json
-import requests
 import argparse
 import os, sys, logging
 
-# This is used sed to disable InsecureRequestWarning.
-requests.packages.urllib3.disable_warnings()
-
 logger = logging.getLogger(__name__)
 
-def parse_args() :
+def parse_args(argv=None) :
     """Defines command line positional and optional arguments and checks
         for valid action input if present.
         
-    Args: none
+    Args:
+        argv (list, optional): arguments to parse instead of sys.argv
 
     Returns: A (tuple) containing the following:
         args (namespace) : used to overwrite env variables when necessary
@@ -36,7 +34,7 @@ def parse_args() :
     	default=os.getenv('CG_API',''),
     	help="Set API url")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     logger_initialize(args.debug)
 
@@ -44,17 +42,19 @@ def parse_args() :
     	logger.error('CG_API (API url for REST calls) '
     				'not specified\n')
     	sys.exit(1)
+    args.endpoint = resolve_endpoint(args.endpoint)
 
     return args;
 
-def main() :
-	args = parse_args()
+def main(argv=None) :
+	args = parse_args(argv)
 
 	url = args.endpoint.rstrip('/') + '/version'
 
 	try :
-		response = cg_rest('GET',url,timeout=50,verify=False)
+		response = cg_rest('GET',url)
 		print response['version']
+		return response['version']
 
 	except CGException as e :
 		logger.error(e)
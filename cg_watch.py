@@ -0,0 +1,197 @@
+"""
+Watches many jobs until each one reaches a terminal state
+
+Jobs are polled with a per-job adaptive interval: it starts at
+min_interval, grows by backoff each time a poll shows no change (up to
+max_interval) and drops back to min_interval whenever the state changes.
+Every interval is jittered so that jobs launched together do not keep
+polling together. All jobs that are due within merge_window of each other
+are polled in one concurrent round over the pooled session, and finished
+jobs leave the schedule, so polling cost follows the number of active
+jobs only.
+
+State changes are reported as events, written by default to stdout as
+newline-delimited JSON:
+
+    {"event":"state","id":"<job id>","previous":null,"state":"QUEUED",...}
+    {"event":"state","id":"<job id>","previous":"QUEUED","state":"RUNNING",...}
+
+A job the gateway answers an error for (e.g. an unknown Job ID), or whose
+polls fail max_errors times in a row, is not polled again: it ends with an
+'unknown' event and the UNKNOWN state.
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import logging
+import cg_job
+from cg_job import job_state
+from cg_token import CGException
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATES = frozenset(['FINISHED', 'DONE', 'COMPLETED', 'FAILED',
+                            'ERROR', 'CANCELLED', 'CANCELED', 'KILLED'])
+
+# Last state of a job given up on
+UNKNOWN_STATE = 'UNKNOWN'
+
+DEFAULT_WORKERS = int(os.getenv('CG_WORKERS', 16))
+
+def write_event(event, stream=sys.stdout) :
+    """Writes one event as a line of compact JSON"""
+
+    stream.write(json.dumps(event, separators=(',', ':'), sort_keys=True))
+    stream.write('\n')
+    stream.flush()
+
+class WatchedJob(object) :
+    """Polling state of one job"""
+
+    def __init__(self, job_id, interval) :
+        self.job_id = job_id
+        self.state = None
+        self.interval = interval
+        self.polls = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+
+class JobWatcher(object) :
+    """Polls a set of jobs until all of them are in a terminal state.
+
+    Args:
+        endpoint (string, URL): the REST endpoint
+        token (string): a valid token to allow user to monitor jobs
+        min_interval (float, optional): first and shortest poll interval (s)
+        max_interval (float, optional): longest poll interval (s)
+        backoff (float, optional): interval growth factor when nothing changed
+        jitter (float, optional): interval is scaled by 1 +/- jitter
+        merge_window (float, optional): jobs due within this many seconds
+                                        of each other are polled in one round
+        workers (int, optional): number of polls run at once
+        emit (function, optional): called with each event dict
+        terminal_states (set, optional): states that end the watch of a job
+        max_errors (int, optional): failed polls in a row after which a job
+                                    is given up on
+    """
+
+    def __init__(self, endpoint, token, min_interval=2.0, max_interval=60.0,
+                backoff=1.5, jitter=0.1, merge_window=0.5,
+                workers=DEFAULT_WORKERS, emit=write_event,
+                terminal_states=TERMINAL_STATES, max_errors=10) :
+        self.endpoint = endpoint
+        self.token = token
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.merge_window = merge_window
+        self.workers = workers
+        self.emit = emit
+        self.terminal_states = terminal_states
+        self.max_errors = max_errors
+        self.jobs = {}
+        self.schedule = []
+
+    def add(self, job_id) :
+        """Starts watching job_id, polling it on the next round"""
+
+        if job_id not in self.jobs :
+            self.jobs[job_id] = WatchedJob(job_id, self.min_interval)
+            heapq.heappush(self.schedule, (0, job_id))
+
+    def active(self) :
+        return len(self.schedule)
+
+    def _next_poll(self, job, now) :
+        scale = random.uniform(1 - self.jitter, 1 + self.jitter)
+        heapq.heappush(self.schedule, (now + job.interval * scale,
+                                        job.job_id))
+
+    def _poll(self, job_id) :
+        try :
+            response = cg_job.get_job_status(self.endpoint, self.token,
+                                            job_id)
+            return (job_id, response, None)
+        except Exception as e :
+            return (job_id, None, e)
+
+    def _update(self, job, response, error, now) :
+        job.polls += 1
+        if error is not None :
+            job.errors += 1
+            job.consecutive_errors += 1
+            # The gateway's own errors (e.g. job not found) are permanent.
+            if (isinstance(error, CGException) or
+                    job.consecutive_errors >= self.max_errors) :
+                self.emit({'event' : 'unknown', 'id' : job.job_id,
+                            'time' : now, 'previous' : job.state,
+                            'state' : UNKNOWN_STATE, 'error' : str(error),
+                            'polls' : job.polls})
+                job.state = UNKNOWN_STATE
+                return
+            job.interval = min(job.interval * self.backoff, self.max_interval)
+            self.emit({'event' : 'error', 'id' : job.job_id,
+                        'time' : now, 'error' : str(error)})
+            self._next_poll(job, now)
+            return
+
+        job.consecutive_errors = 0
+
+        state = job_state(response)
+        if state != job.state :
+            self.emit({'event' : 'state', 'id' : job.job_id, 'time' : now,
+                        'previous' : job.state, 'state' : state,
+                        'polls' : job.polls})
+            job.state = state
+            job.interval = self.min_interval
+        else :
+            job.interval = min(job.interval * self.backoff, self.max_interval)
+
+        if state not in self.terminal_states :
+            self._next_poll(job, now)
+
+    def run(self, timeout=None) :
+        """Polls until every job is terminal or timeout seconds pass.
+
+        Returns:
+            (dict): last known state of every watched job
+        """
+
+        import cg_session
+        from multiprocessing.pool import ThreadPool
+
+        cg_session.configure_endpoint(self.endpoint, pool_size=self.workers)
+        pool = ThreadPool(self.workers)
+        deadline = time.time() + timeout if timeout else None
+        try :
+            while self.schedule :
+                now = time.time()
+                if deadline and now >= deadline :
+                    break
+                wait = self.schedule[0][0] - now
+                if wait > 0 :
+                    if deadline :
+                        wait = min(wait, deadline - now)
+                    time.sleep(wait)
+                    continue
+
+                due = []
+                horizon = now + self.merge_window
+                while self.schedule and self.schedule[0][0] <= horizon :
+                    due.append(heapq.heappop(self.schedule)[1])
+                logger.debug('Polling %d of %d active jobs'
+                            %(len(due), len(due) + len(self.schedule)))
+                for job_id, response, error in pool.imap_unordered(
+                                                        self._poll, due) :
+                    self._update(self.jobs[job_id], response, error,
+                                time.time())
+        finally :
+            pool.terminate()
+
+        return dict((job_id, job.state)
+                    for job_id, job in self.jobs.items())
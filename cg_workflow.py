@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+
+"""
+Runs a workflow of gateway calls declared as a DAG in JSON (or YAML)
+
+Each step calls one API function with named arguments. '${step}' in an
+argument is replaced with the result of another step, which makes it a
+dependency, and '${env.NAME}' with an environment variable. Explicit
+dependencies can be added with "after". Steps whose dependencies are done
+run concurrently, so independent branches (e.g. configuring several apps,
+launching many jobs) overlap instead of running one after the other:
+
+    {
+        "steps" : {
+            "token" : {"call" : "issue_token"},
+            "app" : {"call" : "register_app", "args" : {
+                "token" : "${token}", "appname" : "TEST2",
+                "info_filename" : "appinfo.json"}},
+            "configure" : {"call" : "config_app", "args" : {
+                "token" : "${token}", "appname" : "${app}",
+                "config_filename" : "appconfig.json"}},
+            "job" : {"call" : "launch_job", "args" : {
+                "token" : "${token}", "appname" : "${app}",
+                "jobname" : "TEST_JOB1", "config_filename" : "jobconfig.json"},
+                "after" : ["configure"]},
+            "wait" : {"call" : "wait_job", "args" : {
+                "token" : "${token}", "job_id" : "${job}"}},
+            "output" : {"call" : "get_job_output", "args" : {
+                "token" : "${token}", "job_id" : "${job}"},
+                "after" : ["wait"]}
+        }
+    }
+
+endpoint, username, password, owner and the optional arguments of the API
+functions default to CG_API, CG_USERNAME, CG_PASSWORD and the functions'
+own defaults. A missing token defaults to CG_TOKEN, or a cached token (see
+cg_token_cache).
+
+Progress is checkpointed to '<workflow>.state' after every step. Running
+the workflow again resumes it: finished steps are not called again unless
+their definition, or one of the steps they depend on, changed. A token
+issued by a finished step is verified first, and issued again when it
+expired or has less than CG_TOKEN_MARGIN seconds left (default 300);
+the steps using it are not called again for that.
+
+    ./cg_workflow.py test_workflow.json
+    ./cg_workflow.py test_workflow.json --fresh --workers 4
+
+Every step completion is written to stdout as a line of JSON.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import Queue
+import hashlib
+import logging
+import argparse
+from cg_token import (logger_initialize, issue_token,
+                        verify_token, revoke_token, resolve_endpoint)
+from cg_token_cache import cached_token
+import cg_app
+import cg_job
+import cg_watch
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = int(os.getenv('CG_WORKERS', 16))
+TOKEN_MARGIN = int(os.getenv('CG_TOKEN_MARGIN', 300))
+
+REFERENCE = re.compile(r'\$\{([^}]+)\}')
+
+class WorkflowError(ValueError) :
+    """Raised for an invalid workflow, or a step that cannot finish"""
+
+def wait_job(endpoint, token, job_id, timeout=None, min_interval=2.0,
+            max_interval=60.0, backoff=1.5) :
+    """Polls a job until it reaches a terminal state and returns the state.
+    The poll interval grows from min_interval to max_interval.
+
+    Raises:
+        WorkflowError if the job is still active after timeout seconds.
+    """
+
+    deadline = time.time() + timeout if timeout else None
+    interval = min_interval
+    while True :
+        state = cg_watch.job_state(cg_job.get_job_status(endpoint, token,
+                                                        job_id))
+        if state in cg_watch.TERMINAL_STATES :
+            return state
+        if deadline and time.time() + interval > deadline :
+            raise WorkflowError('Job %s still %s after %s seconds'
+                                %(job_id, state, timeout))
+        time.sleep(interval)
+        interval = min(interval * backoff, max_interval)
+
+CALLS = {
+    'issue_token' : issue_token,
+    'verify_token' : verify_token,
+    'revoke_token' : revoke_token,
+    'register_app' : cg_app.register_app,
+    'config_app' : cg_app.config_app,
+    'get_app_info' : cg_app.get_app_info,
+    'get_app_config' : cg_app.get_app_config,
+    'launch_job' : cg_job.launch_job,
+    'monitor_job' : cg_job.monitor_job,
+    'wait_job' : wait_job,
+    'get_job_output' : cg_job.get_job_output,
+}
+
+# Results left out of the progress written to stdout.
+SECRET_CALLS = frozenset(['issue_token'])
+
+def references(value) :
+    """Yields the names referenced with '${...}' anywhere in value"""
+
+    if isinstance(value, basestring) :
+        for name in REFERENCE.findall(value) :
+            yield name.strip()
+    elif isinstance(value, dict) :
+        for item in value.values() :
+            for name in references(item) :
+                yield name
+    elif isinstance(value, list) :
+        for item in value :
+            for name in references(item) :
+                yield name
+
+def substitute(value, lookup) :
+    """Replaces the '${...}' references in value with lookup(name). A
+    string that is a single reference takes the referenced value as is."""
+
+    if isinstance(value, basestring) :
+        match = REFERENCE.match(value)
+        if match and match.end() == len(value) :
+            return lookup(match.group(1).strip())
+        return REFERENCE.sub(lambda m : str(lookup(m.group(1).strip())),
+                            value)
+    elif isinstance(value, dict) :
+        return dict((key, substitute(item, lookup))
+                    for key, item in value.items())
+    elif isinstance(value, list) :
+        return [substitute(item, lookup) for item in value]
+    return value
+
+class Step(object) :
+    """One call of a workflow and the steps it depends on"""
+
+    def __init__(self, name, spec) :
+        import inspect
+
+        if not isinstance(spec, dict) or spec.get('call') not in CALLS :
+            raise WorkflowError("Step '%s': 'call' must be one of %s"
+                                %(name, ', '.join(sorted(CALLS))))
+        self.name = name
+        self.call = spec['call']
+        self.args = spec.get('args', {})
+        self.func = CALLS[self.call]
+        self.signature = inspect.getargspec(self.func)
+        unknown = set(self.args) - set(self.signature.args)
+        if unknown :
+            raise WorkflowError("Step '%s': %s takes no argument %s"
+                                %(name, self.call, ', '.join(sorted(unknown))))
+        self.after = set(spec.get('after', []))
+        for reference in references(self.args) :
+            if not reference.startswith('env.') :
+                self.after.add(reference.split('.')[0])
+        self.digest = hashlib.sha1(json.dumps(spec,
+                                    sort_keys=True)).hexdigest()
+
+class Workflow(object) :
+    """A validated DAG of steps.
+
+    Args:
+        spec (dict): the workflow, with a "steps" mapping of names to steps
+
+    Raises:
+        WorkflowError on unknown calls, arguments or steps, and on cycles.
+    """
+
+    def __init__(self, spec) :
+        steps = spec.get('steps') if isinstance(spec, dict) else None
+        if not steps or not isinstance(steps, dict) :
+            raise WorkflowError('Workflow has no steps')
+        self.steps = dict((name, Step(name, step))
+                        for name, step in steps.items())
+        for step in self.steps.values() :
+            missing = step.after - set(self.steps)
+            if missing :
+                raise WorkflowError("Step '%s' depends on unknown steps %s"
+                                    %(step.name, ', '.join(sorted(missing))))
+        self.order = self._sort()
+
+    def _sort(self) :
+        """Returns the step names in an order where every step comes after
+        its dependencies"""
+
+        order = []
+        done = set()
+        remaining = dict((name, set(step.after))
+                        for name, step in self.steps.items())
+        while remaining :
+            ready = sorted(name for name, after in remaining.items()
+                            if after <= done)
+            if not ready :
+                raise WorkflowError('Workflow has a cycle between steps %s'
+                                    %', '.join(sorted(remaining)))
+            for name in ready :
+                order.append(name)
+                done.add(name)
+                del remaining[name]
+        return order
+
+def load_workflow(filename) :
+    """Returns the Workflow of a JSON file, or of a YAML file ('.yaml' or
+    '.yml') when PyYAML is installed"""
+
+    with open(filename) as f :
+        if filename.endswith(('.yaml', '.yml')) :
+            try :
+                import yaml
+            except ImportError :
+                raise WorkflowError('PyYAML is needed to read %s, '
+                                    'or give the workflow in JSON' %filename)
+            return Workflow(yaml.safe_load(f))
+        return Workflow(json.load(f))
+
+class Checkpoint(object) :
+    """Results of the finished steps, and the status of the steps that did
+    not finish, saved to a JSON file after each step"""
+
+    def __init__(self, path) :
+        self.path = path
+        self.steps = {}
+        if path and os.path.exists(path) :
+            with open(path) as f :
+                self.steps = json.load(f).get('steps', {})
+
+    def result(self, step) :
+        """Returns (True, result) if step finished with its current
+        definition, (False, None) otherwise"""
+
+        saved = self.steps.get(step.name)
+        if (saved is not None and saved.get('digest') == step.digest and
+                saved.get('status', 'done') == 'done') :
+            return (True, saved.get('result'))
+        return (False, None)
+
+    def save(self, step, result) :
+        self.steps[step.name] = {'digest' : step.digest, 'result' : result,
+                                'status' : 'done', 'time' : time.time()}
+        self._write()
+
+    def mark(self, step, status, error=None) :
+        """Records that step did not finish: status is 'failed' or
+        'skipped'"""
+
+        self.steps[step.name] = {'digest' : step.digest, 'status' : status,
+                                'time' : time.time()}
+        if error is not None :
+            self.steps[step.name]['error'] = str(error)
+        self._write()
+
+    def _write(self) :
+        if not self.path :
+            return
+        # Results include tokens: keep the file private to the user.
+        temp = '%s.%d.tmp' %(self.path, os.getpid())
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f :
+            json.dump({'steps' : self.steps}, f, indent=4, sort_keys=True,
+                    separators=(',', ': '))
+        os.rename(temp, self.path)
+
+class Runner(object) :
+    """Runs a Workflow, as many independent steps at once as workers.
+
+    Args:
+        workflow (Workflow): the steps to run
+        endpoint (string, URL): default REST endpoint
+        username (string, optional): default username and job owner
+        password (string, optional): default password
+        token (string, optional): default token
+        checkpoint (Checkpoint, optional): results of an earlier run
+        workers (int, optional): number of steps run at once
+        emit (function, optional): called with each progress event dict
+    """
+
+    def __init__(self, workflow, endpoint, username='', password='',
+                token='', checkpoint=None, workers=DEFAULT_WORKERS,
+                emit=cg_watch.write_event) :
+        self.workflow = workflow
+        self.endpoint = endpoint
+        self.token = token
+        self.checkpoint = checkpoint or Checkpoint(None)
+        self.workers = workers
+        self.emit = emit
+        self.defaults = {'endpoint' : endpoint, 'username' : username,
+                        'password' : password, 'owner' : username,
+                        'client_id' : os.getenv('CG_CLIENT_ID', ''),
+                        'client_ip' : os.getenv('CG_CLIENT_IP', ''),
+                        'lifetime' : 43200, 'binding' : 1, 'apptype' : 0,
+                        'computation' : {}}
+        self.results = {}
+
+    def default_token(self) :
+        if not self.token :
+            self.token = cached_token(self.endpoint,
+                                    self.defaults['username'],
+                                    self.defaults['password'] or None)
+        return self.token
+
+    def lookup(self, name) :
+        if name.startswith('env.') :
+            return os.getenv(name[4:], '')
+        step, _, key = name.partition('.')
+        result = self.results[step]
+        return result[key] if key else result
+
+    def arguments(self, step) :
+        """Returns the keyword arguments of step's call"""
+
+        args = substitute(step.args, self.lookup)
+        spec = step.signature
+        optional = spec.args[len(spec.args) - len(spec.defaults or ()):]
+        for name in spec.args :
+            if name in args or name in optional :
+                continue
+            if name == 'token' :
+                args[name] = self.default_token()
+            elif name in self.defaults :
+                args[name] = self.defaults[name]
+            else :
+                raise WorkflowError("Step '%s': missing argument '%s' of %s"
+                                    %(step.name, name, step.call))
+        return args
+
+    def _run_step(self, step, args) :
+        start = time.time()
+        try :
+            return (step, step.func(**args), None, time.time() - start)
+        except SystemExit as e :
+            return (step, None, WorkflowError('%s exited with status %s'
+                                            %(step.call, e.code)),
+                    time.time() - start)
+        except Exception as e :
+            return (step, None, e, time.time() - start)
+
+    def _event(self, step, status, result=None, seconds=None, error=None) :
+        event = {'event' : 'step', 'step' : step.name, 'call' : step.call,
+                'status' : status}
+        if result is not None and step.call not in SECRET_CALLS :
+            event['result'] = result
+        if seconds is not None :
+            event['seconds'] = round(seconds, 3)
+        if error is not None :
+            event['error'] = str(error)
+        self.emit(event)
+
+    def _unfinished(self, status, step, value, seconds=None, error=None) :
+        status[step.name] = value
+        self.checkpoint.mark(step, value, error)
+        self._event(step, value, seconds=seconds, error=error)
+
+    def _token_expired(self, step, token) :
+        """Whether a token issued by step in an earlier run expired, or
+        has less than TOKEN_MARGIN seconds left"""
+
+        try :
+            args = self.arguments(step)
+            lifetime = verify_token(args['endpoint'], args['username'], token,
+                                    self.defaults['client_id'],
+                                    self.defaults['client_ip'])
+        except Exception as e :
+            logger.debug("Token of step '%s' not verified: %s"
+                        %(step.name, e))
+            return True
+        return lifetime <= TOKEN_MARGIN
+
+    def run(self) :
+        """Runs every step whose dependencies succeeded.
+
+        Returns:
+            (dict): step name to status: 'done', 'resumed', 'failed' or
+                'skipped' (a dependency failed, or the step was blocked)
+        """
+
+        steps = self.workflow.steps
+        status = {}
+        rerun = set()
+        for name in self.workflow.order :
+            step = steps[name]
+            finished, result = self.checkpoint.result(step)
+            if finished and not (step.after & rerun) :
+                if (step.call == 'issue_token' and
+                        self._token_expired(step, result)) :
+                    # Issued again, without calling the steps that used the
+                    # old token again.
+                    continue
+                self.results[name] = result
+                status[name] = 'resumed'
+                self._event(step, 'resumed', result)
+            else :
+                rerun.add(name)
+
+        import cg_session
+        from multiprocessing.pool import ThreadPool
+
+        cg_session.configure_endpoint(self.endpoint, pool_size=self.workers)
+        pool = ThreadPool(self.workers)
+        done = Queue.Queue()
+        running = set()
+        try :
+            while True :
+                for name in self.workflow.order :
+                    if name in status or name in running :
+                        continue
+                    step = steps[name]
+                    if any(status.get(dep) in ('failed', 'skipped')
+                            for dep in step.after) :
+                        self._unfinished(status, step, 'skipped')
+                        continue
+                    if not all(status.get(dep) in ('done', 'resumed')
+                                for dep in step.after) :
+                        continue
+                    try :
+                        args = self.arguments(step)
+                    except Exception as e :
+                        self._unfinished(status, step, 'failed', error=e)
+                        continue
+                    running.add(name)
+                    pool.apply_async(self._run_step, (step, args),
+                                    callback=done.put)
+
+                if not running :
+                    break
+                step, result, error, seconds = done.get()
+                running.discard(step.name)
+                if error is not None :
+                    self._unfinished(status, step, 'failed', seconds, error)
+                    continue
+                self.results[step.name] = result
+                self.checkpoint.save(step, result)
+                status[step.name] = 'done'
+                self._event(step, 'done', result, seconds)
+        finally :
+            pool.terminate()
+
+        # Nothing is left to run: any step still without a status is
+        # blocked, and reported with the steps that did not finish.
+        for name in self.workflow.order :
+            if name not in status :
+                self._unfinished(status, steps[name], 'skipped')
+        return status
+
+def parse_args(argv=None) :
+    """Defines command line positional and optional arguments
+
+    Args:
+        argv (list, optional): arguments to parse instead of sys.argv
+
+    Returns:
+        args (namespace) : the workflow file and run settings
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--debug",
+        action="store_true",
+        help='Allow debug info to be written to stderr')
+    parser.add_argument("-e", "--endpoint",
+        default=os.getenv('CG_API',''),
+        help="Set API url")
+    parser.add_argument("-u", "--username",
+        default=os.getenv('CG_USERNAME',''),
+        help="Set Username")
+    parser.add_argument("-p", "--password",
+        default=os.getenv('CG_PASSWORD',''),
+        help="Set Password")
+    parser.add_argument("-t", "--token",
+        default=os.getenv('CG_TOKEN',''),
+        help="Set Token used by steps that are not given one")
+    parser.add_argument("-w", "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of steps run at once")
+    parser.add_argument("-c", "--checkpoint",
+        help="Checkpoint file, defaults to the workflow file + '.state'")
+    parser.add_argument("--fresh",
+        action="store_true",
+        help="Ignore the checkpoint and run every step")
+    parser.add_argument("workflow",
+        help="Workflow file in JSON (or YAML, with PyYAML installed)")
+
+    args = parser.parse_args(argv)
+
+    logger_initialize(args.debug)
+
+    if not args.endpoint :
+        logger.error('CG_API (API url for REST calls) '
+                    'not specified\n')
+        sys.exit(1)
+    args.endpoint = resolve_endpoint(args.endpoint)
+
+    return args
+
+def main(argv=None) :
+    args = parse_args(argv)
+
+    try :
+        workflow = load_workflow(args.workflow)
+    except (WorkflowError, ValueError, IOError) as e :
+        logger.error('%s: %s' %(args.workflow, e))
+        sys.exit(1)
+
+    path = args.checkpoint or args.workflow + '.state'
+    if args.fresh and os.path.exists(path) :
+        os.remove(path)
+
+    runner = Runner(workflow, args.endpoint, args.username, args.password,
+                    args.token, Checkpoint(path), args.workers)
+    status = runner.run()
+    failed = sorted(name for name, value in status.items()
+                    if value in ('failed', 'skipped'))
+    if failed :
+        logger.error('Steps not finished: %s' %', '.join(failed))
+        sys.exit(1)
+
+if __name__ == '__main__' :
+    main()
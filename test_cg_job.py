@@ -0,0 +1,85 @@
+"""
+Tests of the cg_job bulk launch against the local stub gateway, with and
+without its bulk launch endpoint
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import os
+import unittest
+
+# No ledger file is written by the tests.
+os.environ['CG_LEDGER'] = ''
+
+import cg_job
+from cg_token import issue_token
+from cg_stub import StubGateway
+
+class BulkLaunchTest(unittest.TestCase) :
+
+    def start(self, **options) :
+        self.stub = StubGateway(**options).start()
+        self.addCleanup(self.stub.stop)
+        self.addCleanup(cg_job._bulk_endpoints.clear)
+        self.token = issue_token(self.stub.url, 'test', 'test', 3600, 0)
+        self.configs = [{'parameters' : {'param0' : str(i)}}
+                        for i in xrange(25)]
+
+    def launch(self, **options) :
+        return cg_job.launch_jobs(self.stub.url, self.token, 'test', 'test',
+                                'test', self.configs, {}, batch_size=10,
+                                workers=2, **options)
+
+    def test_bulk_launch(self) :
+        self.start(bulk=True)
+        job_ids = self.launch()
+
+        self.assertEqual(len(job_ids), 25)
+        self.assertEqual(len(set(job_ids)), 25)
+        self.assertEqual(len(self.stub.state.jobs), 25)
+        self.assertTrue(cg_job.has_bulk_launch(self.stub.url))
+
+    def test_falls_back_without_bulk_endpoint(self) :
+        self.start()
+        self.assertTrue(cg_job.has_bulk_launch(self.stub.url))
+
+        job_ids = self.launch()
+
+        self.assertFalse(cg_job.has_bulk_launch(self.stub.url))
+        self.assertEqual(len(set(job_ids)), 25)
+        self.assertEqual(len(self.stub.state.jobs), 25)
+        self.assertEqual([self.stub.state.jobs[job_id]['name']
+                        for job_id in job_ids],
+                        ['test_%d' %i for i in xrange(25)])
+
+    def test_no_call_without_bulk(self) :
+        self.start(bulk=True)
+        job_ids = self.launch(bulk=False)
+
+        self.assertEqual(len(job_ids), 25)
+        self.assertTrue(cg_job.has_bulk_launch(self.stub.url))
+
+    def test_errors_without_index_sort_first(self) :
+        self.start(bulk=True)
+
+        valid = self.configs[:3]
+
+        def configs() :
+            for config in valid :
+                yield config
+            raise ValueError('bad config line')
+
+        self.configs = configs()
+        self.stub.state.error_status = 400
+        self.stub.state.error_rate = 1.0
+        try :
+            self.launch()
+        except cg_job.BulkLaunchError as e :
+            self.assertEqual([index for index, error in e.errors],
+                            [None, 0, 1, 2])
+            self.assertEqual(e.job_ids, [None, None, None])
+        else :
+            self.fail('BulkLaunchError not raised')
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,154 @@
+"""
+Tests of the cg_retry policy and circuit breaker against the local stub
+gateway, with injected failures
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import time
+import unittest
+from requests import exceptions as rex
+import cg_retry
+import cg_session
+from cg_stub import StubGateway
+
+class StubTestCase(unittest.TestCase) :
+    """Runs each test against a fresh stub gateway, counting attempts"""
+
+    def setUp(self) :
+        self.stub = StubGateway().start()
+        self.addCleanup(self.stub.stop)
+        self.policy = cg_retry.get_policy()
+        self.addCleanup(cg_retry.set_policy, self.policy)
+        cg_retry.set_policy(cg_retry.RetryPolicy(max_attempts=3,
+                                                base_delay=0.01))
+        cg_retry.reset_breakers()
+        self.addCleanup(cg_retry.reset_breakers)
+        self.sent = 0
+
+    def fail(self, status, retry_after=None) :
+        self.stub.state.error_rate = 1.0
+        self.stub.state.error_status = status
+        self.stub.state.retry_after = retry_after
+
+    def call(self, method, path='version') :
+        url = self.stub.url + path
+
+        def send() :
+            self.sent += 1
+            return cg_session.request(method, url)
+
+        return cg_retry.call(method, url, send)
+
+class RetryTest(StubTestCase) :
+
+    def test_success_is_not_retried(self) :
+        r = self.call('GET')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.sent, 1)
+
+    def test_retry_budget(self) :
+        self.fail(503)
+        r = self.call('GET')
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(self.sent, 3)
+
+    def test_statuses_not_worth_retrying(self) :
+        self.fail(400)
+        self.assertEqual(self.call('GET').status_code, 400)
+        self.assertEqual(self.sent, 1)
+
+    def test_retry_after_is_honoured(self) :
+        self.fail(503, retry_after=1)
+        cg_retry.set_policy(cg_retry.RetryPolicy(max_attempts=2,
+                                                base_delay=0.01))
+        start = time.time()
+        self.call('GET')
+        self.assertGreaterEqual(time.time() - start, 1.0)
+        self.assertEqual(self.sent, 2)
+
+    def test_retry_after_is_capped(self) :
+        r = self.call('GET')
+        r.headers['Retry-After'] = '3600'
+        policy = cg_retry.RetryPolicy(max_retry_after=2)
+        self.assertEqual(policy.delay(1, r), 2)
+
+    def test_post_is_not_retried_once_processed(self) :
+        for status in (500, 502, 504) :
+            self.sent = 0
+            self.fail(status)
+            self.assertEqual(self.call('POST', 'job').status_code, status)
+            self.assertEqual(self.sent, 1)
+
+    def test_post_is_retried_when_rejected(self) :
+        self.fail(503)
+        self.call('POST', 'job')
+        self.assertEqual(self.sent, 3)
+
+    def test_post_is_retried_when_never_sent(self) :
+        self.stub.stop()
+        url = self.stub.url + 'job'
+
+        def send() :
+            self.sent += 1
+            return cg_session.request('POST', url)
+
+        self.assertRaises(rex.ConnectionError, cg_retry.call, 'POST', url,
+                            send)
+        self.assertEqual(self.sent, 3)
+
+class CircuitBreakerTest(StubTestCase) :
+
+    def setUp(self) :
+        StubTestCase.setUp(self)
+        cg_retry.set_policy(cg_retry.RetryPolicy(max_attempts=1))
+        self.threshold = cg_retry.FAILURE_THRESHOLD
+        self.timeout = cg_retry.RESET_TIMEOUT
+        cg_retry.FAILURE_THRESHOLD = 2
+        cg_retry.RESET_TIMEOUT = 0.2
+        self.addCleanup(setattr, cg_retry, 'FAILURE_THRESHOLD',
+                        self.threshold)
+        self.addCleanup(setattr, cg_retry, 'RESET_TIMEOUT', self.timeout)
+
+    def open_circuit(self) :
+        self.fail(503)
+        self.call('GET')
+        self.call('GET')
+        self.assertRaises(cg_retry.CircuitOpenError, self.call, 'GET')
+        self.assertEqual(self.sent, 2)
+
+    def test_open_half_open_close(self) :
+        self.open_circuit()
+
+        # Half open: one trial call once reset_timeout passed; it succeeds
+        # and closes the circuit.
+        time.sleep(0.25)
+        self.stub.state.error_rate = 0.0
+        self.assertEqual(self.call('GET').status_code, 200)
+        self.assertEqual(self.call('GET').status_code, 200)
+        self.assertEqual(self.sent, 4)
+
+    def test_failed_trial_reopens(self) :
+        self.open_circuit()
+        time.sleep(0.25)
+        self.assertEqual(self.call('GET').status_code, 503)
+        self.assertRaises(cg_retry.CircuitOpenError, self.call, 'GET')
+        self.assertEqual(self.sent, 3)
+
+    def test_trial_raising_other_errors_does_not_stick(self) :
+        self.open_circuit()
+        time.sleep(0.25)
+        url = self.stub.url + 'version'
+
+        def broken() :
+            raise rex.ChunkedEncodingError('connection broken')
+
+        self.assertRaises(rex.ChunkedEncodingError, cg_retry.call, 'GET',
+                            url, broken)
+        self.assertRaises(cg_retry.CircuitOpenError, self.call, 'GET')
+        time.sleep(0.25)
+        self.stub.state.error_rate = 0.0
+        self.assertEqual(self.call('GET').status_code, 200)
+
+if __name__ == '__main__' :
+    unittest.main()
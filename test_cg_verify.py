@@ -0,0 +1,157 @@
+"""
+Tests of the cg_verify TokenVerifier caching and coalescing, with
+cg_token.verify_token replaced by a counting fake
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import time
+import threading
+import unittest
+import cg_token
+import cg_verify
+from cg_token import CGException
+
+class TokenVerifierTest(unittest.TestCase) :
+
+    def setUp(self) :
+        self.addCleanup(setattr, cg_token, 'verify_token',
+                        cg_token.verify_token)
+        cg_token.verify_token = self.fake
+        self.calls = 0
+        self.answer = lambda token : 3600
+        self.verifier = cg_verify.TokenVerifier('http://gateway/',
+                                                max_ttl=60, negative_ttl=0.2)
+
+    def fake(self, endpoint, username, token, client_id, client_ip) :
+        self.calls += 1
+        return self.answer(token)
+
+    def assertLifetime(self, lifetime) :
+        # Counted down from when the call was sent, in whole seconds.
+        self.assertTrue(3590 < lifetime <= 3600, lifetime)
+
+    def verify(self, token='token') :
+        return self.verifier.verify('user', token, 'consumer', '127.0.0.1')
+
+    def test_valid_answer_is_cached(self) :
+        self.assertLifetime(self.verify())
+        self.assertLifetime(self.verify())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.verifier.stats()['hits'], 1)
+
+    def test_concurrent_verifications_are_coalesced(self) :
+        release = threading.Event()
+
+        def answer(token) :
+            release.wait(5)
+            return 3600
+
+        self.answer = answer
+        results = []
+        threads = [threading.Thread(target=lambda :
+                                    results.append(self.verify()))
+                    for i in xrange(8)]
+        for thread in threads :
+            thread.start()
+        deadline = time.time() + 5
+        while (self.verifier.stats()['coalesced'] < 7 and
+                time.time() < deadline) :
+            time.sleep(0.01)
+        release.set()
+        for thread in threads :
+            thread.join(5)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(results), 8)
+        for lifetime in results :
+            self.assertLifetime(lifetime)
+        stats = self.verifier.stats()
+        self.assertEqual((stats['misses'], stats['coalesced']), (1, 7))
+
+    def test_waiters_get_the_rejection(self) :
+        release = threading.Event()
+
+        def answer(token) :
+            release.wait(5)
+            raise CGException({'error_code' : 1, 'message' : 'Invalid token'})
+
+        self.answer = answer
+        errors = []
+
+        def verify() :
+            try :
+                self.verify()
+            except CGException as e :
+                errors.append(e)
+
+        threads = [threading.Thread(target=verify) for i in xrange(4)]
+        for thread in threads :
+            thread.start()
+        deadline = time.time() + 5
+        while (self.verifier.stats()['coalesced'] < 3 and
+                time.time() < deadline) :
+            time.sleep(0.01)
+        release.set()
+        for thread in threads :
+            thread.join(5)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(errors), 4)
+
+    def test_rejection_is_cached_for_negative_ttl(self) :
+        def answer(token) :
+            raise CGException({'error_code' : 1, 'message' : 'Invalid token'})
+
+        self.answer = answer
+        self.assertRaises(CGException, self.verify)
+        self.assertRaises(CGException, self.verify)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.verifier.stats()['negative_hits'], 1)
+
+        time.sleep(0.25)
+        self.assertRaises(CGException, self.verify)
+        self.assertEqual(self.calls, 2)
+
+    def test_transport_errors_are_not_cached(self) :
+        def answer(token) :
+            raise IOError('connection reset')
+
+        self.answer = answer
+        self.assertRaises(IOError, self.verify)
+        self.assertRaises(IOError, self.verify)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.verifier.stats()['entries'], 0)
+
+    def test_lifetime_is_trusted_for_at_most_max_ttl(self) :
+        self.verifier.max_ttl = 0.1
+        self.verify()
+        time.sleep(0.15)
+        self.verify()
+        self.assertEqual(self.calls, 2)
+
+    def test_invalidate_during_the_call_prevents_the_store(self) :
+        def answer(token) :
+            # Revoked while the gateway answers.
+            self.verifier.invalidate(token)
+            return 3600
+
+        self.answer = answer
+        self.assertLifetime(self.verify())
+        self.assertEqual(self.verifier.stats()['entries'], 0)
+
+        self.answer = lambda token : 3600
+        self.verify()
+        self.assertEqual(self.calls, 2)
+
+    def test_invalidate_drops_cached_answers(self) :
+        self.verify('token')
+        self.verify('other')
+        self.verifier.invalidate('token')
+
+        self.verify('token')
+        self.verify('other')
+        self.assertEqual(self.calls, 3)
+
+if __name__ == '__main__' :
+    unittest.main()
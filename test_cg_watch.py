@@ -0,0 +1,116 @@
+"""
+Tests of cg_watch against the local stub gateway, with simulated job state
+transitions
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import os
+import time
+import unittest
+
+# No ledger file is written by the tests.
+os.environ['CG_LEDGER'] = ''
+
+import cg_job
+import cg_watch
+from cg_token import issue_token
+from cg_stub import StubGateway
+
+class JobWatcherTest(unittest.TestCase) :
+
+    def start(self, **options) :
+        self.stub = StubGateway(**options).start()
+        self.addCleanup(self.stub.stop)
+        self.token = issue_token(self.stub.url, 'test', 'test', 3600, 0)
+        self.events = []
+
+    def launch(self) :
+        return cg_job.launch_job_data(self.stub.url, self.token, 'test',
+                                    'test', 'test', {'parameters' : {}}, {})
+
+    def watcher(self, **options) :
+        options.setdefault('min_interval', 0.02)
+        options.setdefault('max_interval', 0.1)
+        options.setdefault('merge_window', 0.01)
+        return cg_watch.JobWatcher(self.stub.url, self.token,
+                                    emit=self.events.append, **options)
+
+    def states(self, job_id) :
+        return [(e['previous'], e['state']) for e in self.events
+                if e['id'] == job_id and e['event'] == 'state']
+
+    def test_state_transitions(self) :
+        self.start(job_states=[('QUEUED', 0.2), ('RUNNING', 0.2),
+                                ('FINISHED', 0)])
+        job_ids = [self.launch() for i in xrange(3)]
+        watcher = self.watcher()
+        for job_id in job_ids :
+            watcher.add(job_id)
+
+        states = watcher.run(timeout=10)
+
+        self.assertEqual(watcher.active(), 0)
+        for job_id in job_ids :
+            self.assertEqual(states[job_id], 'FINISHED')
+            self.assertEqual(self.states(job_id),
+                            [(None, 'QUEUED'), ('QUEUED', 'RUNNING'),
+                            ('RUNNING', 'FINISHED')])
+
+    def test_failed_jobs_are_terminal(self) :
+        self.start(job_states=[('RUNNING', 0.1), ('FINISHED', 0)],
+                    job_failure_rate=1.0)
+        job_id = self.launch()
+        watcher = self.watcher()
+        watcher.add(job_id)
+
+        states = watcher.run(timeout=10)
+
+        self.assertEqual(states[job_id], 'FAILED')
+        self.assertEqual(self.states(job_id),
+                        [(None, 'RUNNING'), ('RUNNING', 'FAILED')])
+
+    def test_unknown_job_is_given_up_at_once(self) :
+        self.start()
+        watcher = self.watcher()
+        watcher.add('no-such-job')
+
+        start = time.time()
+        states = watcher.run(timeout=10)
+
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(states['no-such-job'], cg_watch.UNKNOWN_STATE)
+        self.assertEqual([e['event'] for e in self.events], ['unknown'])
+        self.assertEqual(watcher.active(), 0)
+
+    def test_repeated_poll_errors_give_up(self) :
+        self.start(error_status=400)
+        self.stub.state.error_rate = 1.0
+        watcher = self.watcher(max_errors=3)
+        watcher.add('some-job')
+
+        states = watcher.run(timeout=10)
+
+        self.assertEqual(states['some-job'], cg_watch.UNKNOWN_STATE)
+        self.assertEqual([e['event'] for e in self.events],
+                        ['error', 'error', 'unknown'])
+
+    def test_error_count_resets_on_success(self) :
+        self.start(job_states=[('RUNNING', 0.3), ('FINISHED', 0)])
+        job_id = self.launch()
+        watcher = self.watcher(max_errors=2)
+        watcher.add(job_id)
+        job = watcher.jobs[job_id]
+
+        watcher._update(job, None, IOError('connection reset'), time.time())
+        watcher._update(job, {'status' : 'success',
+                            'result' : {'status' : 'RUNNING'}}, None,
+                        time.time())
+        watcher._update(job, None, IOError('connection reset'), time.time())
+
+        self.assertEqual(job.state, 'RUNNING')
+        self.assertEqual(job.errors, 2)
+        self.assertEqual(job.consecutive_errors, 1)
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Tests of cg_workflow runs and resumes against the local stub gateway
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import os
+import copy
+import json
+import shutil
+import tempfile
+import unittest
+
+# No ledger file is written by the tests.
+os.environ['CG_LEDGER'] = ''
+
+import cg_workflow
+from cg_stub import StubGateway
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STEPS = {
+    'token' : {'call' : 'issue_token', 'args' : {'lifetime' : 3600}},
+    'app' : {'call' : 'register_app', 'args' : {
+        'token' : '${token}', 'appname' : 'TEST',
+        'info_filename' : os.path.join(HERE, 'appinfo.json')}},
+    'configure' : {'call' : 'config_app', 'args' : {
+        'token' : '${token}', 'appname' : '${app}',
+        'config_filename' : os.path.join(HERE, 'appconfig.json')}},
+    'job' : {'call' : 'launch_job', 'args' : {
+        'token' : '${token}', 'appname' : '${app}', 'jobname' : 'TEST_JOB',
+        'config_filename' : os.path.join(HERE, 'jobconfig.json')},
+        'after' : ['configure']},
+    'wait' : {'call' : 'wait_job', 'args' : {
+        'token' : '${token}', 'job_id' : '${job}', 'min_interval' : 0.01}},
+}
+
+class RunnerTest(unittest.TestCase) :
+
+    def setUp(self) :
+        self.stub = StubGateway().start()
+        self.addCleanup(self.stub.stop)
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.path = os.path.join(workdir, 'workflow.state')
+        self.steps = copy.deepcopy(STEPS)
+        self.events = []
+
+    def run_workflow(self) :
+        workflow = cg_workflow.Workflow({'steps' : self.steps})
+        runner = cg_workflow.Runner(workflow, self.stub.url, 'test', 'test',
+                                    checkpoint=cg_workflow.Checkpoint(
+                                        self.path),
+                                    workers=4, emit=self.events.append)
+        return runner.run()
+
+    def saved(self) :
+        with open(self.path) as f :
+            return json.load(f)['steps']
+
+    def test_finished_steps_are_resumed(self) :
+        self.assertEqual(set(self.run_workflow().values()), set(['done']))
+        self.assertEqual(set(self.run_workflow().values()), set(['resumed']))
+        self.assertEqual(len(self.stub.state.jobs), 1)
+
+    def test_changed_step_reruns_its_dependents(self) :
+        self.run_workflow()
+        self.steps['job']['args']['jobname'] = 'OTHER_JOB'
+
+        status = self.run_workflow()
+
+        self.assertEqual(status, {'token' : 'resumed', 'app' : 'resumed',
+                                'configure' : 'resumed', 'job' : 'done',
+                                'wait' : 'done'})
+        self.assertEqual(len(self.stub.state.jobs), 2)
+
+    def test_failed_step_skips_its_dependents(self) :
+        self.steps['configure']['args']['config_filename'] = 'missing.json'
+
+        status = self.run_workflow()
+
+        self.assertEqual(status['configure'], 'failed')
+        self.assertEqual(status['job'], 'skipped')
+        self.assertEqual(status['wait'], 'skipped')
+        self.assertEqual(status['app'], 'done')
+        saved = self.saved()
+        self.assertEqual(saved['configure']['status'], 'failed')
+        self.assertEqual(saved['wait']['status'], 'skipped')
+        self.assertEqual(len(self.stub.state.jobs), 0)
+
+        # Fixed, the steps that did not finish run on resume.
+        self.steps['configure']['args']['config_filename'] = os.path.join(
+                                                HERE, 'appconfig.json')
+        status = self.run_workflow()
+        self.assertEqual(status['app'], 'resumed')
+        self.assertEqual(status['wait'], 'done')
+
+    def test_step_with_bad_arguments_blocks_its_dependents(self) :
+        # The token step's result is a string: '${token.name}' fails.
+        self.steps['job']['args']['jobname'] = '${token.name}'
+
+        status = self.run_workflow()
+
+        self.assertEqual(status['job'], 'failed')
+        self.assertEqual(status['wait'], 'skipped')
+        self.assertEqual(self.saved()['wait']['status'], 'skipped')
+        self.assertEqual([e['status'] for e in self.events
+                        if e['step'] == 'wait'], ['skipped'])
+
+    def test_expired_token_is_issued_again(self) :
+        self.run_workflow()
+        token = self.saved()['token']['result']
+        margin = cg_workflow.TOKEN_MARGIN
+        self.addCleanup(setattr, cg_workflow, 'TOKEN_MARGIN', margin)
+        # Every token has less than this left.
+        cg_workflow.TOKEN_MARGIN = 7200
+
+        status = self.run_workflow()
+
+        self.assertEqual(status, {'token' : 'done', 'app' : 'resumed',
+                                'configure' : 'resumed', 'job' : 'resumed',
+                                'wait' : 'resumed'})
+        self.assertNotEqual(self.saved()['token']['result'], token)
+        self.assertEqual(len(self.stub.state.jobs), 1)
+
+    def test_valid_token_is_resumed(self) :
+        self.run_workflow()
+        token = self.saved()['token']['result']
+
+        self.assertEqual(self.run_workflow()['token'], 'resumed')
+        self.assertEqual(self.saved()['token']['result'], token)
+
+if __name__ == '__main__' :
+    unittest.main()